@@ -0,0 +1,474 @@
+"""
+Query-count and latency benchmark for every API route in clap/urls.py and
+users/urls.py, run by `manage.py benchmark_api` and, at a small scale, by
+the test suite.
+
+Each endpoint has a query budget that must not depend on how much data is
+in the database, so an N+1 shows up as a budget violation even on a tiny
+dataset. The statements PostgresBroker sends to push live notifications are
+counted apart from the budget, and an endpoint may send at most one.
+Timings are only meaningful on the full-size dataset.
+
+serialization(), run by `manage.py benchmark_serialization`, times the
+large list bodies alone: ModelSerializer against clap.fastlist, and DRF's
+JSONRenderer against clap.renderers.
+"""
+import json
+import statistics
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+from unittest import mock
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.tokens import PasswordResetTokenGenerator
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import RefreshToken
+from users.models import UsersCustom
+from users.serializer import UserSerializer
+from users.views import CustomTokenObtainPairSerializer
+from . import delivery, dollar_rate, season
+from .fastlist import ValuesSerializer
+from .renderers import FastJSONRenderer
+from .serializers import CajaPersonaListSerializer, NotificationSerializer
+from .models import Community, caja, cajaPersona, Notification, BroadcastNotification, PagoMovilConfig, SupportConfig, SeasonRollover, SeasonArchive, ArchivedPayment
+
+PASSWORD = 'benchmark-password'
+
+
+@dataclass
+class Endpoint:
+    name: str
+    method: str
+    path: Callable
+    role: str  # 'admin', 'resident' or 'anonymous'
+    budget: int
+    data: Optional[Callable] = None
+    user: Optional[Callable] = None  # overrides role when each call needs its own user
+    status: int = 200
+    format: str = 'json'
+    revalidate: bool = False  # send the ETag of a previous response, as a polling browser does
+    settings: Optional[dict] = None  # overridden while the endpoint is called
+
+
+class OfflineRateClient:
+    def fetch(self):
+        return 36.5
+
+
+class Dataset:
+    """Seeds the database and hands out fresh targets for the write endpoints."""
+
+    def __init__(self, users, notifications_per_user, batch_size=2000):
+        password = make_password(PASSWORD)
+        # The residents belong to the first distribution point; the second one runs its own caja
+        self.community = Community.objects.create(name='Sector 1')
+        self.other_community = Community.objects.create(name='Sector 2')
+        residents = [
+            UsersCustom(
+                username=f'resident{n}', email=f'resident{n}@example.com', password=password,
+                cedula=f'V{n:08d}', phone=f'0414{n:07d}', fullname=f'Residente {n}', community=self.community,
+            )
+            for n in range(users)
+        ]
+        UsersCustom.objects.bulk_create(residents, batch_size=batch_size)
+        self.admin = UsersCustom.objects.create_superuser(
+            'benchadmin', 'admin@example.com', PASSWORD, cedula='V-ADMIN', phone='0000', community=self.community,
+        )
+        self.caja = caja.objects.create(price=10, stock=users * 2, community=self.community)
+        caja.objects.create(price=10, stock=users, community=self.other_community)
+        PagoMovilConfig.objects.create(id=1, cedula='12345678', telefono='04141234567', banco='Banco de Venezuela')
+        SupportConfig.objects.create(id=1, email='soporte@example.com', phone_number='04141234567')
+        SeasonRollover.objects.create(price=10, stock=users, status='DONE', new_caja=self.caja)
+
+        resident_ids = list(UsersCustom.objects.filter(is_staff=False).order_by('id').values_list('id', flat=True))
+        # A quarter of the residents have not paid yet, so they can create payments
+        paying = resident_ids[: len(resident_ids) * 3 // 4]
+        self.unpaid = iter(UsersCustom.objects.filter(id__in=resident_ids[len(paying):]).order_by('id'))
+        statuses = ['PENDING', 'APPROVED', 'APPROVED', 'REJECTED']
+        cajaPersona.objects.bulk_create([
+            cajaPersona(
+                cajaid=self.caja, user_id=user_id, payment_method=['Pago Movil', 'Efectivo'][n % 2],
+                amount=10, reference=f'{user_id:012d}', bank_name='Banco de Venezuela',
+                status=statuses[n % 4], delivered=n % 8 == 1,
+            )
+            for n, user_id in enumerate(paying)
+        ], batch_size=batch_size)
+        caja.objects.all().rebuild_counters()
+        # Last season, as the rollover left it
+        self.archive = SeasonArchive.objects.create(
+            caja_number=0, price=8, stock=len(paying), sold=len(paying), delivered_count=len(paying),
+            opened=timezone.now(), stats=self.caja.payment_stats(),
+        )
+        ArchivedPayment.objects.bulk_create([
+            ArchivedPayment(season=self.archive, user_id=user_id, date=timezone.now(), payment_method='Efectivo',
+                            amount=8, moneda='Bs', status='APPROVED', delivered=True)
+            for user_id in paying
+        ], batch_size=batch_size)
+        Notification.objects.bulk_create([
+            Notification(user_id=user_id, message=f'Mensaje {n}')
+            for user_id in resident_ids for n in range(notifications_per_user)
+        ], batch_size=batch_size)
+        BroadcastNotification.objects.create(message='Nueva temporada')
+
+        self.resident = UsersCustom.objects.get(id=paying[1])
+        self.payment = cajaPersona.objects.get(user=self.resident)
+        self.notification = Notification.objects.filter(user=self.resident).first()
+        self.pending = iter(cajaPersona.objects.filter(status='PENDING').order_by('id'))
+        self.approved = iter(cajaPersona.objects.filter(status='APPROVED', delivered=False).order_by('id'))
+        # Last in id order, so the single-payment iterators above never reach them
+        self.bulk_ids = list(cajaPersona.objects.order_by('-id').values_list('id', flat=True)[:20])
+        # Approved and not delivered, from the other end than self.approved so confirming never reaches it
+        self.collecting = cajaPersona.objects.select_related('user').filter(
+            status='APPROVED', delivered=False).exclude(id__in=self.bulk_ids).order_by('-id').first()
+        self.resettable = iter(UsersCustom.objects.filter(id__in=resident_ids[2:]).order_by('-id'))
+        self.registered = 0
+        self.communities = 0
+        self.admins = 0
+        self.price = 10
+        self.counts = {
+            'users': len(resident_ids),
+            'payments': len(paying),
+            'archived_payments': len(paying),
+            'notifications': len(resident_ids) * notifications_per_user,
+        }
+
+    def community_data(self):
+        self.communities += 1
+        return {'name': f'Punto {self.communities}', 'address': 'Calle 1'}
+
+    def new_admin(self):
+        """A staff user without a payment yet, so each call can pay for itself."""
+        self.admins += 1
+        return UsersCustom.objects.create_user(
+            f'benchadmin{self.admins}', password=PASSWORD, is_staff=True, cedula=f'A{self.admins:08d}',
+            phone=f'0412{self.admins:07d}', community=self.community,
+        )
+
+    def withdraw(self):
+        """The next pending payment, for its owner to delete."""
+        self.withdrawn = next(self.pending)
+        return self.withdrawn
+
+    def register_data(self):
+        self.registered += 1
+        n = self.registered
+        return {
+            'community': self.community.id,
+            'username': f'newresident{n}', 'email': f'new{n}@example.com', 'password': 'Clave-Segura-123',
+            'password2': 'Clave-Segura-123', 'cedula': f'N{n:08d}', 'phone': f'0424{n:07d}',
+        }
+
+    def bulk_targets(self, status):
+        """The same payments every call, put back in `status` so each call does the full work."""
+        cajaPersona.objects.filter(id__in=self.bulk_ids).update(status=status, delivered=False)
+        return {'ids': self.bulk_ids}
+
+    def next_price(self):
+        self.price += 1
+        return {'price': f'{self.price}.00'}
+
+    def reset_confirm_path(self):
+        user = next(self.resettable)
+        token = PasswordResetTokenGenerator().make_token(user)
+        return f'/users/api/v1/password-reset-confirm/{urlsafe_base64_encode(force_bytes(user.pk))}/{token}/'
+
+
+# Every route that needs a login runs as an admin and as a resident; where a role is refused,
+# its 403 is what gets measured. Routes open to anyone run anonymously only, as the caller's
+# role changes nothing there (/metrics has a token of its own). Of the notification stream
+# only the refused connection is measured: an accepted one never ends, so there is no response
+# to time, and the queries it runs on connecting are covered by NotificationStreamTests.
+ENDPOINTS = [
+    # clap
+    Endpoint('cajas list', 'get', lambda d: '/clap/cajas/', 'resident', 1),
+    Endpoint('cajas list (admin)', 'get', lambda d: '/clap/cajas/', 'admin', 1),
+    Endpoint('cajas detail', 'get', lambda d: f'/clap/cajas/{d.caja.id}/', 'resident', 1),
+    Endpoint('cajas detail (admin)', 'get', lambda d: f'/clap/cajas/{d.caja.id}/', 'admin', 1),
+    Endpoint('cajas payment-details', 'get', lambda d: '/clap/cajas/payment-details/', 'resident', 0),
+    Endpoint('cajas payment-details (admin)', 'get', lambda d: '/clap/cajas/payment-details/', 'admin', 0),
+    Endpoint('cajas list (unchanged)', 'get', lambda d: '/clap/cajas/', 'resident', 1, status=304, revalidate=True),
+    Endpoint('cajas payment-details (unchanged)', 'get', lambda d: '/clap/cajas/payment-details/', 'resident', 0,
+             status=304, revalidate=True),
+    Endpoint('cajas stats', 'get', lambda d: '/clap/cajas/stats/', 'admin', 0),
+    Endpoint('cajas stats (resident)', 'get', lambda d: '/clap/cajas/stats/', 'resident', 0, status=403),
+    Endpoint('cajas stats (other community)', 'get', lambda d: f'/clap/cajas/stats/?community={d.other_community.id}', 'admin', 0),
+    Endpoint('cajas list (admin, community)', 'get', lambda d: f'/clap/cajas/?community={d.other_community.id}', 'admin', 1),
+    Endpoint('communities list', 'get', lambda d: '/clap/communities/', 'anonymous', 1),
+    Endpoint('communities detail', 'get', lambda d: f'/clap/communities/{d.community.id}/', 'anonymous', 1),
+    Endpoint('communities create', 'post', lambda d: '/clap/communities/', 'admin', 2, status=201, data=lambda d: d.community_data()),
+    Endpoint('communities create (resident)', 'post', lambda d: '/clap/communities/', 'resident', 0, status=403,
+             data=lambda d: d.community_data()),
+    Endpoint('communities update', 'patch', lambda d: f'/clap/communities/{d.other_community.id}/', 'admin', 2,
+             data=lambda d: {'address': 'Calle 2'}),
+    Endpoint('communities update (resident)', 'patch', lambda d: f'/clap/communities/{d.other_community.id}/', 'resident', 0,
+             status=403, data=lambda d: {'address': 'Calle 3'}),
+    Endpoint('cajas season_rollover', 'get', lambda d: '/clap/cajas/season_rollover/', 'admin', 1),
+    Endpoint('cajas season_rollover (resident)', 'get', lambda d: '/clap/cajas/season_rollover/', 'resident', 0, status=403),
+    Endpoint('cajaspersona list (admin, page)', 'get', lambda d: '/clap/cajaspersona/?page_size=50', 'admin', 1),
+    Endpoint('cajaspersona list (admin, filtered page)', 'get', lambda d: '/clap/cajaspersona/?page_size=50&status=PENDING', 'admin', 1),
+    Endpoint('cajaspersona list (admin, all)', 'get', lambda d: '/clap/cajaspersona/', 'admin', 1),
+    Endpoint('cajaspersona export', 'get', lambda d: '/clap/cajaspersona/export/', 'admin', 1),
+    Endpoint('cajaspersona export (resident)', 'get', lambda d: '/clap/cajaspersona/export/', 'resident', 0, status=403),
+    Endpoint('cajaspersona list (resident)', 'get', lambda d: '/clap/cajaspersona/', 'resident', 1),
+    Endpoint('cajaspersona detail', 'get', lambda d: f'/clap/cajaspersona/{d.payment.id}/', 'resident', 3),
+    Endpoint('cajaspersona detail (admin)', 'get', lambda d: f'/clap/cajaspersona/{d.payment.id}/', 'admin', 3),
+    Endpoint('cajaspersona create', 'post', lambda d: '/clap/cajaspersona/', 'resident', 9, status=201,
+             data=lambda d: {'cajaid': d.caja.id, 'payment_method': 'Pago Movil', 'reference': '0001', 'amount': '10.00'},
+             user=lambda d: next(d.unpaid)),
+    Endpoint('cajaspersona create (admin)', 'post', lambda d: '/clap/cajaspersona/', 'admin', 9, status=201,
+             data=lambda d: {'cajaid': d.caja.id, 'payment_method': 'Efectivo', 'amount': '10.00'},
+             user=lambda d: d.new_admin()),
+    Endpoint('cajaspersona admin_create_payment', 'post', lambda d: '/clap/cajaspersona/admin_create_payment/', 'admin', 11, status=201,
+             data=lambda d: {'user_id': next(d.unpaid).id, 'payment_method': 'Efectivo'}),
+    Endpoint('cajaspersona admin_create_payment (resident)', 'post', lambda d: '/clap/cajaspersona/admin_create_payment/', 'resident', 0,
+             status=403, data=lambda d: {'user_id': d.resident.id, 'payment_method': 'Efectivo'}),
+    Endpoint('cajaspersona approve_payment', 'post', lambda d: f'/clap/cajaspersona/{next(d.pending).id}/approve_payment/', 'admin', 6),
+    Endpoint('cajaspersona approve_payment (resident)', 'post', lambda d: f'/clap/cajaspersona/{d.payment.id}/approve_payment/',
+             'resident', 0, status=403),
+    Endpoint('cajaspersona reject_payment', 'post', lambda d: f'/clap/cajaspersona/{next(d.pending).id}/reject_payment/', 'admin', 6),
+    Endpoint('cajaspersona reject_payment (resident)', 'post', lambda d: f'/clap/cajaspersona/{d.payment.id}/reject_payment/',
+             'resident', 0, status=403),
+    Endpoint('cajaspersona confirm_delivery', 'post', lambda d: f'/clap/cajaspersona/{next(d.approved).id}/confirm_delivery/', 'admin', 6),
+    Endpoint('cajaspersona confirm_delivery (resident)', 'post', lambda d: f'/clap/cajaspersona/{d.payment.id}/confirm_delivery/',
+             'resident', 0, status=403),
+    Endpoint('cajaspersona delivery_qr', 'get', lambda d: f'/clap/cajaspersona/{d.collecting.id}/delivery_qr/', 'resident', 1,
+             user=lambda d: d.collecting.user),
+    Endpoint('cajaspersona delivery_qr (admin)', 'get', lambda d: f'/clap/cajaspersona/{d.collecting.id}/delivery_qr/', 'admin', 1),
+    Endpoint('cajaspersona scan_delivery', 'post', lambda d: '/clap/cajaspersona/scan_delivery/', 'admin', 6,
+             data=lambda d: {'token': delivery.make_token(next(d.approved))}),
+    Endpoint('cajaspersona scan_delivery (resident)', 'post', lambda d: '/clap/cajaspersona/scan_delivery/', 'resident', 0,
+             status=403, data=lambda d: {'token': delivery.make_token(d.collecting)}),
+    Endpoint('cajaspersona bulk_approve', 'post', lambda d: '/clap/cajaspersona/bulk_approve/', 'admin', 6,
+             data=lambda d: d.bulk_targets('PENDING')),
+    Endpoint('cajaspersona bulk_reject', 'post', lambda d: '/clap/cajaspersona/bulk_reject/', 'admin', 6,
+             data=lambda d: d.bulk_targets('APPROVED')),
+    Endpoint('cajaspersona bulk_confirm_delivery', 'post', lambda d: '/clap/cajaspersona/bulk_confirm_delivery/', 'admin', 6,
+             data=lambda d: d.bulk_targets('APPROVED')),
+    Endpoint('cajaspersona bulk_approve (resident)', 'post', lambda d: '/clap/cajaspersona/bulk_approve/', 'resident', 0,
+             status=403, data=lambda d: {'ids': d.bulk_ids}),
+    Endpoint('cajaspersona bulk_reject (resident)', 'post', lambda d: '/clap/cajaspersona/bulk_reject/', 'resident', 0,
+             status=403, data=lambda d: {'ids': d.bulk_ids}),
+    Endpoint('cajaspersona bulk_confirm_delivery (resident)', 'post', lambda d: '/clap/cajaspersona/bulk_confirm_delivery/', 'resident', 0,
+             status=403, data=lambda d: {'ids': d.bulk_ids}),
+    Endpoint('cajaspersona delete', 'delete', lambda d: f'/clap/cajaspersona/{next(d.pending).id}/', 'admin', 3, status=204),
+    # Residents may withdraw their own payment
+    Endpoint('cajaspersona delete (resident)', 'delete', lambda d: f'/clap/cajaspersona/{d.withdrawn.id}/', 'resident', 3, status=204,
+             user=lambda d: d.withdraw().user),
+    Endpoint('seasons list', 'get', lambda d: '/clap/seasons/', 'admin', 1),
+    Endpoint('seasons list (resident)', 'get', lambda d: '/clap/seasons/', 'resident', 0, status=403),
+    Endpoint('seasons detail', 'get', lambda d: f'/clap/seasons/{d.archive.id}/', 'admin', 1),
+    Endpoint('seasons detail (resident)', 'get', lambda d: f'/clap/seasons/{d.archive.id}/', 'resident', 0, status=403),
+    Endpoint('archived-payments list (admin, page)', 'get', lambda d: f'/clap/archived-payments/?season={d.archive.id}', 'admin', 1),
+    Endpoint('archived-payments list (resident)', 'get', lambda d: '/clap/archived-payments/', 'resident', 1),
+    Endpoint('notifications list', 'get', lambda d: '/clap/notifications/', 'resident', 2),
+    Endpoint('notifications list (admin)', 'get', lambda d: '/clap/notifications/', 'admin', 2),
+    Endpoint('notifications list (unchanged)', 'get', lambda d: '/clap/notifications/', 'resident', 1, status=304, revalidate=True),
+    Endpoint('notifications detail', 'get', lambda d: f'/clap/notifications/{d.notification.id}/', 'resident', 1),
+    # Admins only have a feed of their own, so a resident's notification is not found
+    Endpoint('notifications detail (admin)', 'get', lambda d: f'/clap/notifications/{d.notification.id}/', 'admin', 1, status=404),
+    Endpoint('notifications unread_count', 'get', lambda d: '/clap/notifications/unread_count/', 'resident', 1),
+    Endpoint('notifications unread_count (admin)', 'get', lambda d: '/clap/notifications/unread_count/', 'admin', 1),
+    Endpoint('notifications mark_as_read', 'post', lambda d: f'/clap/notifications/{d.notification.id}/mark_as_read/', 'resident', 1),
+    Endpoint('notifications mark_as_read (admin)', 'post', lambda d: f'/clap/notifications/{d.notification.id}/mark_as_read/', 'admin', 1,
+             status=404),
+    Endpoint('notifications mark_read', 'post', lambda d: '/clap/notifications/mark_read/', 'resident', 1,
+             data=lambda d: {'ids': [d.notification.id]}),
+    Endpoint('notifications mark_read (admin)', 'post', lambda d: '/clap/notifications/mark_read/', 'admin', 1,
+             data=lambda d: {'ids': [d.notification.id]}),
+    Endpoint('notifications mark_all_read', 'post', lambda d: '/clap/notifications/mark_all_read/', 'resident', 1),
+    Endpoint('notifications mark_all_read (admin)', 'post', lambda d: '/clap/notifications/mark_all_read/', 'admin', 1),
+    Endpoint('notifications stream (no token)', 'get', lambda d: '/clap/notifications/stream/', 'anonymous', 0, status=401),
+    Endpoint('pago-movil-config list', 'get', lambda d: '/clap/pago-movil-config/', 'admin', 0),
+    Endpoint('pago-movil-config list (resident)', 'get', lambda d: '/clap/pago-movil-config/', 'resident', 0, status=403),
+    Endpoint('pago-movil-config update', 'put', lambda d: '/clap/pago-movil-config/1/', 'admin', 2,
+             data=lambda d: {'cedula': '12345678', 'telefono': '04141234567', 'banco': 'Banesco'}),
+    Endpoint('pago-movil-config update (resident)', 'put', lambda d: '/clap/pago-movil-config/1/', 'resident', 0, status=403,
+             data=lambda d: {'cedula': '12345678', 'telefono': '04141234567', 'banco': 'Banesco'}),
+    Endpoint('support-config list', 'get', lambda d: '/clap/support-config/', 'admin', 0),
+    Endpoint('support-config list (resident)', 'get', lambda d: '/clap/support-config/', 'resident', 0, status=403),
+    Endpoint('support-config list (unchanged)', 'get', lambda d: '/clap/support-config/', 'admin', 0, status=304, revalidate=True),
+    Endpoint('support-config update', 'put', lambda d: '/clap/support-config/1/', 'admin', 2,
+             data=lambda d: {'email': 'soporte@example.com', 'phone_number': '04140000000'}),
+    Endpoint('support-config update (resident)', 'put', lambda d: '/clap/support-config/1/', 'resident', 0, status=403,
+             data=lambda d: {'email': 'soporte@example.com', 'phone_number': '04140000000'}),
+    Endpoint('dollar-rate', 'get', lambda d: '/clap/dollar-rate/', 'anonymous', 0),
+    Endpoint('cajas update', 'patch', lambda d: f'/clap/cajas/{d.caja.id}/', 'admin', 6,
+             data=lambda d: d.next_price()),
+    Endpoint('cajas update (resident)', 'patch', lambda d: f'/clap/cajas/{d.caja.id}/', 'resident', 0, status=403,
+             data=lambda d: {'price': '1.00'}),
+    Endpoint('metrics', 'get', lambda d: '/metrics', 'anonymous', 0, settings={'METRICS_ENABLED': True}),
+    # users
+    Endpoint('users list', 'get', lambda d: '/users/api/v1/users/', 'admin', 3),
+    Endpoint('users list (resident)', 'get', lambda d: '/users/api/v1/users/', 'resident', 0, status=403),
+    Endpoint('users detail', 'get', lambda d: f'/users/api/v1/users/{d.resident.id}/', 'admin', 3),
+    Endpoint('users detail (resident)', 'get', lambda d: f'/users/api/v1/users/{d.resident.id}/', 'resident', 0, status=403),
+    Endpoint('users update', 'patch', lambda d: f'/users/api/v1/users/{d.resident.id}/', 'admin', 6,
+             data=lambda d: {'address': 'Calle 1'}),
+    Endpoint('users update (resident)', 'patch', lambda d: f'/users/api/v1/users/{d.resident.id}/', 'resident', 0, status=403,
+             data=lambda d: {'address': 'Calle 2'}),
+    # The user's row, read fresh rather than trusted from the token, and its groups and permissions
+    Endpoint('me', 'get', lambda d: '/users/api/v1/me/', 'resident', 3),
+    Endpoint('me (admin)', 'get', lambda d: '/users/api/v1/me/', 'admin', 3),
+    Endpoint('me update', 'patch', lambda d: '/users/api/v1/me/', 'resident', 4, data=lambda d: {'fullname': 'Residente'}),
+    Endpoint('me update (admin)', 'patch', lambda d: '/users/api/v1/me/', 'admin', 4, data=lambda d: {'fullname': 'Administrador'}),
+    Endpoint('register', 'post', lambda d: '/users/api/v1/register/', 'anonymous', 5, status=201, data=lambda d: d.register_data()),
+    Endpoint('login', 'post', lambda d: '/users/api/v1/login/', 'anonymous', 1,
+             data=lambda d: {'username': d.resident.username, 'password': PASSWORD}),
+    Endpoint('token refresh', 'post', lambda d: '/users/api/v1/token/refresh/', 'anonymous', 1,
+             data=lambda d: {'refresh': str(RefreshToken.for_user(d.resident))}),
+    Endpoint('password-reset', 'post', lambda d: '/users/api/v1/password-reset/', 'anonymous', 2,
+             data=lambda d: {'email': d.resident.email}),
+    Endpoint('password-reset-confirm', 'post', lambda d: d.reset_confirm_path(), 'anonymous', 2,
+             data=lambda d: {'password': 'Otra-Clave-456'}),
+    # Destructive: they replace the current caja, so they run last
+    Endpoint('cajas create (resident)', 'post', lambda d: '/clap/cajas/', 'resident', 0, status=403,
+             data=lambda d: {'price': '12.00', 'stock': 100, 'community': d.community.id}),
+    Endpoint('cajas clear_season_data (resident)', 'post', lambda d: '/clap/cajas/clear_season_data/', 'resident', 0, status=403,
+             data=lambda d: {'price': '12.00', 'stock': 100}),
+    Endpoint('cajas create', 'post', lambda d: '/clap/cajas/', 'admin', 2, status=201,
+             data=lambda d: {'price': '12.00', 'stock': 100, 'community': d.community.id}),
+    Endpoint('cajas clear_season_data', 'post', lambda d: '/clap/cajas/clear_season_data/', 'admin', 5, status=202,
+             data=lambda d: {'price': '12.00', 'stock': 100}),
+]
+
+
+def _finish_rollover(job):
+    # Only the request is measured; the rollover itself would wipe the dataset
+    SeasonRollover.objects.filter(pk=job.pk).update(status='DONE')
+
+
+def _percentile(samples, percent):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))]
+
+
+def _client(dataset, endpoint):
+    client = APIClient()
+    user = endpoint.user(dataset) if endpoint.user else {'admin': dataset.admin, 'resident': dataset.resident}.get(endpoint.role)
+    if user is not None:
+        # The token login hands out, so authentication costs what it costs in production
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {CustomTokenObtainPairSerializer.get_token(user).access_token}')
+    return client
+
+
+def _call(dataset, endpoint):
+    client = _client(dataset, endpoint)
+    path = endpoint.path(dataset)
+    data = endpoint.data(dataset) if endpoint.data else None
+    headers = {}
+    if endpoint.revalidate:
+        headers['HTTP_IF_NONE_MATCH'] = getattr(client, endpoint.method)(path)['ETag']
+    with override_settings(**endpoint.settings or {}), CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        response = getattr(client, endpoint.method)(path, data, format=endpoint.format, **headers)
+        if response.streaming:
+            b''.join(response.streaming_content)  # The queries run while the body streams
+        elapsed = (time.perf_counter() - started) * 1000
+    if response.status_code != endpoint.status:
+        raise AssertionError(f'{endpoint.name}: expected HTTP {endpoint.status}, got {response.status_code}: {getattr(response, "data", "")}')
+    notifies = sum('pg_notify' in query['sql'] for query in queries.captured_queries)
+    return len(queries) - notifies, notifies, elapsed
+
+
+def run(users=20000, notifications_per_user=3, iterations=10, endpoints=None):
+    """Seeds the current (test) database, calls every endpoint and returns the report as a dict."""
+    cache.clear()
+    dataset = Dataset(users, notifications_per_user)
+    results, violations = [], []
+
+    with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'), \
+            mock.patch.object(dollar_rate, '_service', dollar_rate.DollarRateService(OfflineRateClient(), ttl=10 ** 9)), \
+            mock.patch.object(season, 'run_in_background', _finish_rollover):
+        for endpoint in endpoints or ENDPOINTS:
+            _call(dataset, endpoint)  # Warm caches the way a running server would have them
+            samples = [_call(dataset, endpoint) for _ in range(iterations)]
+            queries = max(count for count, _, _ in samples)
+            notifies = max(count for _, count, _ in samples)
+            timings = [elapsed for _, _, elapsed in samples]
+            results.append({
+                'name': endpoint.name,
+                'method': endpoint.method.upper(),
+                'role': endpoint.role,
+                'queries': queries,
+                'budget': endpoint.budget,
+                'notifies': notifies,
+                'p50_ms': round(statistics.median(timings), 2),
+                'p90_ms': round(_percentile(timings, 90), 2),
+                'p99_ms': round(_percentile(timings, 99), 2),
+                'max_ms': round(max(timings), 2),
+            })
+            if queries > endpoint.budget:
+                violations.append(f'{endpoint.name}: {queries} queries, budget {endpoint.budget}')
+            if notifies > 1:
+                violations.append(f'{endpoint.name}: {notifies} NOTIFY statements, expected one batch')
+
+    return {
+        'database': connection.vendor,
+        'dataset': dataset.counts,
+        'iterations': iterations,
+        'endpoints': results,
+        'violations': violations,
+    }
+
+
+# The large lists served through clap.fastlist: (name, list serializer, queryset as the view builds it)
+SERIALIZED_LISTS = [
+    ('users', UserSerializer, lambda: UsersCustom.objects.prefetch_related('groups', 'user_permissions').order_by('id')),
+    ('payments', CajaPersonaListSerializer, lambda: cajaPersona.objects.select_related('user', 'cajaid').order_by('-id')),
+    ('notifications', NotificationSerializer, lambda: Notification.objects.order_by('-timestamp', '-id')),
+]
+
+
+def _render(serializer_class, queryset, rows, context, renderer, values):
+    if values:
+        fast = ValuesSerializer(serializer_class, context)
+        data = fast.to_representation(fast.values(queryset)[:rows])
+    else:
+        data = serializer_class(queryset[:rows], many=True, context=context).data
+    return renderer.render(data)
+
+
+def serialization(rows=10000, iterations=5):
+    """
+    Seeds the current (test) database and times building the JSON body of
+    `rows` rows of each large list three ways: the ModelSerializer with DRF's
+    JSONRenderer (the old path), .values() rows with JSONRenderer, and .values()
+    rows with FastJSONRenderer (what the views do now). The queries are
+    included, since building model instances is part of what the fast path saves.
+    """
+    cache.clear()
+    Dataset(users=rows * 4 // 3 + 1, notifications_per_user=1)  # A quarter of the residents have no payment
+    context = {'request': APIRequestFactory().get('/')}
+    paths = [
+        ('serializer+json', False, JSONRenderer()),
+        ('values+json', True, JSONRenderer()),
+        ('values+orjson', True, FastJSONRenderer()),
+    ]
+    results = []
+    for name, serializer_class, queryset in SERIALIZED_LISTS:
+        bodies, timings = {}, {}
+        for path, values, renderer in paths:
+            samples = []
+            for _ in range(iterations):
+                started = time.perf_counter()
+                bodies[path] = _render(serializer_class, queryset(), rows, context, renderer, values)
+                samples.append((time.perf_counter() - started) * 1000)
+            timings[path] = statistics.median(samples)
+        baseline = timings['serializer+json']
+        results.append({
+            'name': name,
+            'rows': len(json.loads(bodies['serializer+json'])),
+            'identical': len(set(bodies.values())) == 1,
+            'paths': [
+                {'path': path, 'p50_ms': round(ms, 1), 'rows_per_s': round(rows / ms * 1000), 'speedup': round(baseline / ms, 2)}
+                for path, ms in timings.items()
+            ],
+        })
+    return {'database': connection.vendor, 'iterations': iterations, 'lists': results}
@@ -0,0 +1,66 @@
+"""
+Read-through cache for values that almost every request needs but that only
+change a few times per season (the current caja of each community and the
+singleton configs).
+
+Each entry is stored under a versioned key. Invalidating bumps the version
+instead of deleting the entry, so with a shared cache backend (required by
+the production profile) every worker process sees the change at once. With
+the local-memory backend of development the other processes converge after
+CLAP_CACHE_TIMEOUT seconds.
+"""
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+CURRENT_CAJA = 'current_caja'
+PAGO_MOVIL_CONFIG = 'pago_movil_config'
+SUPPORT_CONFIG = 'support_config'
+LATEST_BROADCAST = 'latest_broadcast'
+PAYMENT_STATS = 'payment_stats'
+
+_MISSING = object()
+
+
+def _version_key(name):
+    return f'clap:{name}:version'
+
+
+def _version(name):
+    version = cache.get(_version_key(name))
+    if version is None:
+        # Start from the clock so a version lost to eviction never reuses an old key
+        cache.add(_version_key(name), time.time_ns(), None)
+        version = cache.get(_version_key(name))
+    return version
+
+
+def get_or_load(name, loader, scope=None):
+    """
+    The cached value of `name`, loaded on a miss. A scope keeps one value per
+    scope (e.g. per community) under the same version, so invalidate(name)
+    drops all of them.
+    """
+    key = f'clap:{name}:{_version(name)}'
+    if scope is not None:
+        key = f'{key}:{scope}'
+    value = cache.get(key, _MISSING)
+    if value is _MISSING:
+        value = loader()
+        cache.set(key, value, settings.CLAP_CACHE_TIMEOUT)
+    return value
+
+
+def _bump(name):
+    try:
+        cache.incr(_version_key(name))
+    except ValueError:
+        cache.add(_version_key(name), time.time_ns(), None)
+
+
+def invalidate(name):
+    _bump(name)
+    # A reader could cache the old row again before the writer commits
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _bump(name))
@@ -0,0 +1,37 @@
+"""
+Conditional GET for the endpoints the frontend polls.
+
+Each view computes a validator from data it has at hand anyway (cached
+objects, or one small aggregate) and hands respond() a callable that builds
+the real response. When the client's If-None-Match still matches, that
+callable never runs: no serializer, no JSON, just a 304.
+
+Validators are derived from the data itself rather than from the version
+counters in clap.caching, which live in each process's cache and would let
+one worker answer 304 after another one changed the data.
+"""
+import hashlib
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
+
+
+def fingerprint(*instances):
+    """A short hash of the field values of the given model instances (None stands for a missing one)."""
+    digest = hashlib.blake2b(digest_size=12)
+    for instance in instances:
+        values = None if instance is None else [getattr(instance, field.attname) for field in instance._meta.concrete_fields]
+        digest.update(repr(values).encode())
+    return digest.hexdigest()
+
+
+def respond(request, validator, build):
+    etag = quote_etag(validator)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = build()
+    if response.status_code in (200, 304):
+        response['ETag'] = etag
+        # Browsers keep the copy but ask every time, so polling costs a 304
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization'])
+    return response
@@ -0,0 +1,47 @@
+"""
+Delivery tokens for the QR code a resident shows at the distribution point.
+
+A token is "<payment id>:<nonce>" signed with SECRET_KEY. The signature is
+checked before touching the database, so forged or mistyped codes cost no
+query. The random nonce, stored on the payment, keeps a code from matching
+another payment that later reuses the same id (SQLite reuses ids once a
+season rollover has deleted the table).
+
+Marking the delivery is a single conditional UPDATE on the primary key, so
+when several scanners read the same code at once exactly one of them wins
+and every later scan of it is reported as a replay.
+"""
+import secrets
+from io import BytesIO
+import qrcode
+from django.core import signing
+
+SALT = 'clap.delivery'
+
+
+def new_nonce():
+    return secrets.token_urlsafe(16)
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def make_token(payment):
+    return signing.Signer(salt=SALT).sign(f'{payment.pk}:{payment.delivery_nonce}')
+
+
+def read_token(token):
+    """Returns (payment id, nonce), or raises InvalidToken."""
+    try:
+        pk, nonce = signing.Signer(salt=SALT).unsign(token).split(':')
+        return int(pk), nonce
+    except (signing.BadSignature, ValueError):
+        raise InvalidToken
+
+
+def qr_png(token):
+    image = qrcode.make(token, border=2)
+    buffer = BytesIO()
+    image.save(buffer)
+    return buffer.getvalue()
@@ -0,0 +1,93 @@
+"""
+Official dollar rate from dolarapi.com, cached so page loads never wait on it.
+
+The last good rate is kept in Django's cache. Once it is older than
+DOLLAR_RATE_TTL it is still served, while a single background thread fetches
+a new one. Only the very first request (nothing cached yet) calls upstream
+inline, and even then with a strict timeout.
+"""
+import threading
+import time
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+RATE_KEY = 'clap:dollar_rate'
+REFRESH_LOCK_KEY = 'clap:dollar_rate:refreshing'
+
+
+class RateUnavailable(Exception):
+    pass
+
+
+class DolarApiClient:
+    """Fetches the rate over a pooled session, so refreshes reuse the TLS connection."""
+
+    def __init__(self, url=None, timeout=None):
+        self.url = url or settings.DOLLAR_RATE_URL
+        self.timeout = timeout or settings.DOLLAR_RATE_TIMEOUT
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+    def fetch(self):
+        try:
+            response = self.session.get(self.url, timeout=self.timeout)
+            response.raise_for_status()
+            rate = response.json().get('promedio')
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise RateUnavailable(str(e)) from e
+        if rate is None:
+            raise RateUnavailable("La respuesta no incluye 'promedio'.")
+        return rate
+
+
+class DollarRateService:
+
+    def __init__(self, client, ttl=None):
+        self.client = client
+        self.ttl = settings.DOLLAR_RATE_TTL if ttl is None else ttl
+
+    def get(self):
+        """Returns (rate, age in seconds). Raises RateUnavailable only if no rate was ever fetched."""
+        cached = cache.get(RATE_KEY)
+        if cached is None:
+            cached = self.refresh()
+        elif time.time() - cached['fetched_at'] > self.ttl:
+            self.refresh_in_background()
+        return cached['rate'], time.time() - cached['fetched_at']
+
+    def refresh(self):
+        cached = {'rate': self.client.fetch(), 'fetched_at': time.time()}
+        cache.set(RATE_KEY, cached, None)
+        return cached
+
+    def refresh_in_background(self):
+        # cache.add is atomic, so only one refresh runs even across worker processes
+        if not cache.add(REFRESH_LOCK_KEY, True, int(settings.DOLLAR_RATE_TIMEOUT * 2) + 1):
+            return None
+
+        def run():
+            try:
+                self.refresh()
+            except RateUnavailable:
+                pass  # Keep serving the last good rate
+            finally:
+                cache.delete(REFRESH_LOCK_KEY)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = DollarRateService(import_string(settings.DOLLAR_RATE_CLIENT)())
+        return _service
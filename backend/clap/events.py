@@ -0,0 +1,164 @@
+"""
+Pub/sub used to push notifications to connected clients (see
+views.notification_stream).
+
+InProcessBroker only reaches clients connected to the same process.
+PostgresBroker relays events through PostgreSQL LISTEN/NOTIFY, so the API
+workers can reach clients held by the separate stream server. Any class with
+the same subscribe / unsubscribe / publish / publish_many / broadcast methods
+can replace them through NOTIFICATION_BROKER.
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, user_id, is_staff, loop, community_id=None):
+        self.user_id = user_id
+        self.is_staff = is_staff
+        self.community_id = community_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=settings.NOTIFICATION_STREAM_QUEUE_SIZE)
+
+    def push(self, event):
+        # Publishers run on request threads, the queue belongs to the connection's event loop
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass  # A client this far behind reloads its feed on reconnect anyway
+
+
+class InProcessBroker:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def subscribe(self, user_id, is_staff=False, community_id=None):
+        subscription = Subscription(user_id, is_staff, asyncio.get_running_loop(), community_id)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.user_id, None)
+
+    def publish(self, user_id, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.push(event)
+
+    def publish_many(self, events):
+        """Publishes (user_id, event) pairs, e.g. the notifications of a bulk action."""
+        for user_id, event in events:
+            self.publish(user_id, event)
+
+    def broadcast(self, event, scoped=False, community_id=None):
+        """Sends to every connected non-admin user, or with scoped to those of community_id, like BroadcastNotification."""
+        with self._lock:
+            subscriptions = [
+                s for group in self._subscriptions.values() for s in group
+                if not s.is_staff and (not scoped or s.community_id == community_id)
+            ]
+        for subscription in subscriptions:
+            subscription.push(event)
+
+
+class PostgresBroker(InProcessBroker):
+    """
+    Publishing sends a NOTIFY; every process with subscribers runs one thread
+    that LISTENs on its own connection and hands the events to its local
+    subscriptions. Events are dropped while that connection is down, which the
+    clients' reload-on-reconnect already tolerates.
+    """
+    CHANNEL = 'clap_events'
+
+    def __init__(self):
+        super().__init__()
+        self._listener = None
+
+    def subscribe(self, user_id, is_staff=False, community_id=None):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, daemon=True)
+                self._listener.start()
+        return super().subscribe(user_id, is_staff, community_id)
+
+    def publish(self, user_id, event):
+        self._notify({'user_id': user_id, 'event': event})
+
+    def publish_many(self, events):
+        self._notify(*[{'user_id': user_id, 'event': event} for user_id, event in events])
+
+    def broadcast(self, event, scoped=False, community_id=None):
+        self._notify({'user_id': None, 'event': event, 'scoped': scoped, 'community_id': community_id})
+
+    def _notify(self, *messages):
+        # One statement however many there are; each one is a NOTIFY of its own, since
+        # payloads are limited to 8000 bytes and a notification is a few hundred
+        if not messages:
+            return
+        payloads = [json.dumps(message, cls=DjangoJSONEncoder) for message in messages]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) WITH ORDINALITY AS sent(payload, n) ORDER BY n',
+                [self.CHANNEL, payloads],
+            )
+
+    def _dispatch(self, payload):
+        message = json.loads(payload)
+        if message['user_id'] is None:
+            InProcessBroker.broadcast(self, message['event'], message['scoped'], message['community_id'])
+        else:
+            InProcessBroker.publish(self, message['user_id'], message['event'])
+
+    def _listen(self):
+        database = connections['default']
+        while True:
+            listener = None
+            try:
+                # A connection of its own, outside Django's per-thread handling
+                listener = database.get_new_connection(database.get_connection_params())
+                listener.autocommit = True
+                with listener.cursor() as cursor:
+                    cursor.execute(f'LISTEN {self.CHANNEL}')
+                while True:
+                    if select.select([listener], [], [], 60)[0]:
+                        listener.poll()
+                        while listener.notifies:
+                            self._dispatch(listener.notifies.pop(0).payload)
+            except Exception:
+                logger.exception('Notification listener lost its connection; reconnecting')
+                if listener is not None:
+                    listener.close()
+                time.sleep(5)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(settings.NOTIFICATION_BROKER)()
+        return _broker
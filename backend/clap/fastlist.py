@@ -0,0 +1,185 @@
+"""
+Read-only fast path for large list endpoints.
+
+A ModelSerializer builds a model instance per row and then, for every field
+of every row, looks the attribute up, checks it for None and calls the
+field's to_representation. ValuesSerializer works out once per request, from
+the same serializer class, which .values() column feeds each output key and
+how to convert it, then builds the dicts straight from .values() rows.
+Fields whose representation is the database value itself (text, integers,
+booleans, string choices, primary keys) are copied as they are; the rest
+still go through the field's own to_representation, so the JSON comes out
+the same as the serializer's.
+
+Supported: model fields, foreign keys as primary keys, nested serializers
+over foreign keys, and many-to-many primary key lists (one extra query each,
+like the prefetch they replace). Anything else (SerializerMethodField,
+dotted sources, nested lists) raises ImproperlyConfigured instead of
+quietly rendering something different.
+"""
+from collections import defaultdict
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db import models
+from rest_framework import ISO_8601, serializers
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+# to_representation methods that hand back what the database returns for the field
+_COPIED = {
+    serializers.CharField.to_representation,
+    serializers.IntegerField.to_representation,
+    serializers.BooleanField.to_representation,
+}
+
+
+def _file_url(field, model_field):
+    # FileField.to_representation without the FieldFile: the .values() row only has the name
+    use_url = getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL)
+    request = field.context.get('request')
+    storage = model_field.storage
+
+    def convert(name):
+        if not name:
+            return None
+        if not use_url:
+            return name
+        url = storage.url(name)
+        return request.build_absolute_uri(url) if request is not None else url
+    return convert
+
+
+def _datetime(field):
+    # DateTimeField.to_representation with the timezone looked up once rather than per row
+    field_timezone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+    if field_timezone is None:
+        return field.to_representation
+
+    def convert(value):
+        if value.utcoffset() is None:
+            return field.to_representation(value)
+        try:
+            text = value.astimezone(field_timezone).isoformat()
+        except OverflowError:
+            return field.to_representation(value)
+        return text[:-6] + 'Z' if text.endswith('+00:00') else text
+    return convert
+
+
+def _converter(field, model_field):
+    """None when the value is copied as it is, otherwise the function that converts it."""
+    represent = type(field).to_representation
+    if represent in _COPIED:
+        return None
+    if represent is serializers.ChoiceField.to_representation and all(
+        isinstance(key, str) for key in field.choice_strings_to_values.values()
+    ):
+        return None
+    if represent is PrimaryKeyRelatedField.to_representation and field.pk_field is None:
+        return None
+    if represent is serializers.FileField.to_representation:
+        return _file_url(field, model_field)
+    if (represent is serializers.DateTimeField.to_representation
+            and type(field).enforce_timezone is serializers.DateTimeField.enforce_timezone
+            and getattr(field, 'format', api_settings.DATETIME_FORMAT) == ISO_8601):
+        return _datetime(field)
+    if isinstance(field, serializers.RelatedField):
+        raise ImproperlyConfigured(f'{field.field_name}: {type(field).__name__} needs the related object.')
+    return field.to_representation
+
+
+def _plan(serializer, prefix=''):
+    """Returns (columns, entries): the .values() columns to select and, per output key, (key, column, converter)."""
+    model = serializer.Meta.model
+    columns, entries = [], []
+    for key, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if field.source == '*' or '.' in field.source:
+            raise ImproperlyConfigured(f'{key}: source {field.source!r} has no .values() column.')
+        try:
+            model_field = model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            model_field = None  # An annotation; only plain values can come from one
+        column = prefix + field.source
+        if isinstance(field, serializers.ListSerializer):
+            raise ImproperlyConfigured(f'{key}: nested lists are not supported.')
+        if isinstance(field, serializers.BaseSerializer):
+            nested_columns, nested_entries = _plan(field, column + '__')
+            # A null foreign key shows up as a null primary key on the other side
+            pk = f'{column}__{model_field.related_model._meta.pk.name}'
+            columns += nested_columns + [pk]
+            entries.append((key, pk, nested_entries))
+        elif isinstance(field, ManyRelatedField):
+            child = field.child_relation
+            if prefix or type(child).to_representation is not PrimaryKeyRelatedField.to_representation or child.pk_field is not None:
+                raise ImproperlyConfigured(f'{key}: only top-level primary key lists are supported.')
+            # Filled in per page by ValuesSerializer.to_representation
+            columns.append(model._meta.pk.name)
+            entries.append((key, model._meta.pk.name, model_field))
+        else:
+            columns.append(column)
+            entries.append((key, column, _converter(field, model_field)))
+    return columns, entries
+
+
+def _build(row, entries):
+    data = {}
+    for key, column, convert in entries:
+        value = row[column]
+        if value is None or convert is None:
+            data[key] = value
+        elif type(convert) is list:
+            data[key] = _build(row, convert)
+        else:
+            data[key] = convert(value)
+    return data
+
+
+class ValuesSerializer:
+    """Renders .values() rows the way serializer_class(rows, many=True).data renders model instances."""
+
+    def __init__(self, serializer_class, context=None):
+        serializer = serializer_class(context=context or {})
+        columns, self.entries = _plan(serializer)
+        self.columns = list(dict.fromkeys(columns))
+        self.many = [convert for _, _, convert in self.entries if isinstance(convert, models.ManyToManyField)]
+        self.pk = serializer.Meta.model._meta.pk.name
+
+    def values(self, queryset):
+        return queryset.prefetch_related(None).values(*self.columns)
+
+    def _related(self, model_field, pks):
+        # What prefetch_related() would fetch, in the related model's default ordering
+        lookup = model_field.related_query_name()
+        related = defaultdict(list)
+        if pks:
+            for owner, pk in model_field.related_model._default_manager.filter(**{f'{lookup}__in': pks}).values_list(lookup, 'pk'):
+                related[owner].append(pk)
+        return lambda pk: related.get(pk, [])
+
+    def to_representation(self, rows):
+        rows = list(rows)
+        entries = self.entries
+        if self.many:
+            pks = [row[self.pk] for row in rows]
+            entries = [
+                (key, column, self._related(convert, pks) if isinstance(convert, models.ManyToManyField) else convert)
+                for key, column, convert in entries
+            ]
+        return [_build(row, entries) for row in rows]
+
+
+class ValuesListMixin:
+    """
+    Serves list() through ValuesSerializer, keeping the view's filtering and
+    pagination. The list serializer must only use what ValuesSerializer supports.
+    """
+
+    def list(self, request, *args, **kwargs):
+        fast = ValuesSerializer(self.get_serializer_class(), self.get_serializer_context())
+        rows = fast.values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(fast.to_representation(page))
+        return Response(fast.to_representation(rows))
@@ -0,0 +1 @@
+# This file is required for Django to recognize this as a package.
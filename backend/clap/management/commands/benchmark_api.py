@@ -0,0 +1,36 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from clap import benchmarks
+
+class Command(BaseCommand):
+    help = (
+        'Seeds a throwaway test database, calls every API endpoint and reports query counts '
+        'and latency percentiles as JSON. Fails if an endpoint goes over its query budget.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20000)
+        parser.add_argument('--notifications-per-user', type=int, default=3)
+        parser.add_argument('--iterations', type=int, default=10)
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            report = benchmarks.run(options['users'], options['notifications_per_user'], options['iterations'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if report['violations']:
+            raise CommandError('Query budget exceeded:\n' + '\n'.join(report['violations']))
@@ -0,0 +1,37 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from clap import benchmarks
+
+class Command(BaseCommand):
+    help = (
+        'Seeds a throwaway test database and compares how fast the users, payments and notifications '
+        'lists are turned into JSON: ModelSerializer against .values() rows, JSONRenderer against orjson. '
+        'Fails if the paths produce different bytes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--iterations', type=int, default=5)
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            report = benchmarks.serialization(options['rows'], options['iterations'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        different = [result['name'] for result in report['lists'] if not result['identical']]
+        if different:
+            raise CommandError(f'Output differs from the serializer for: {", ".join(different)}')
@@ -0,0 +1,76 @@
+import json
+import statistics
+import threading
+import time
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+DEFAULT_PATHS = [
+    '/clap/cajas/',
+    '/clap/cajaspersona/',
+    '/clap/notifications/',
+    '/clap/notifications/unread_count/',
+    '/users/api/v1/me/',
+]
+
+
+class Command(BaseCommand):
+    help = (
+        'Sends GET requests to a running server from several threads for a fixed time and '
+        'reports throughput and latency as JSON. Used to compare serving setups on the same machine.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--username', required=True)
+        parser.add_argument('--password', required=True)
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--duration', type=float, default=20, help='Seconds of load per path.')
+        parser.add_argument('--path', action='append', dest='paths', help='Path to load; repeatable.')
+
+    def handle(self, *args, **options):
+        base = options['url'].rstrip('/')
+        response = requests.post(f'{base}/users/api/v1/login/', json={
+            'username': options['username'], 'password': options['password'],
+        }, timeout=10)
+        if response.status_code != 200:
+            raise CommandError(f'Login failed: HTTP {response.status_code}')
+        headers = {'Authorization': f"Bearer {response.json()['access']}"}
+
+        results = [
+            self.load(f'{base}{path}', headers, options['concurrency'], options['duration'])
+            for path in options['paths'] or DEFAULT_PATHS
+        ]
+        self.stdout.write(json.dumps({'url': base, 'concurrency': options['concurrency'], 'paths': results}, indent=2))
+
+    def load(self, url, headers, concurrency, duration):
+        timings, errors = [], []
+        deadline = time.perf_counter() + duration
+
+        def worker():
+            session = requests.Session()  # Keep-alive, like a browser
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    ok = session.get(url, headers=headers, timeout=30).status_code == 200
+                except requests.exceptions.RequestException:
+                    ok = False
+                (timings if ok else errors).append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        ordered = sorted(timings) or [0]
+        return {
+            'path': url,
+            'requests': len(timings),
+            'errors': len(errors),
+            'rps': round(len(timings) / elapsed, 1),
+            'p50_ms': round(statistics.median(ordered) * 1000, 1),
+            'p99_ms': round(ordered[int(0.99 * (len(ordered) - 1))] * 1000, 1),
+        }
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from clap.models import caja
+
+class Command(BaseCommand):
+    help = 'Recomputes the sold and delivered counters of every caja from its payments.'
+
+    def handle(self, *args, **options):
+        updated = caja.objects.all().rebuild_counters()
+        self.stdout.write(self.style.SUCCESS(f'Counters rebuilt for {updated} caja(s).'))
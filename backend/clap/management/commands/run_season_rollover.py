@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from clap import season
+from clap.models import SeasonRollover
+
+class Command(BaseCommand):
+    help = 'Runs or resumes the latest unfinished season rollover in the foreground.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', type=int, help='Rollover id; defaults to the latest unfinished one.')
+        parser.add_argument('--force', action='store_true', help='Take over a RUNNING rollover before its heartbeat lapses.')
+
+    def handle(self, *args, **options):
+        jobs = SeasonRollover.objects.exclude(status='DONE').order_by('-created')
+        if options['job']:
+            jobs = jobs.filter(pk=options['job'])
+        job = jobs.first()
+        if not job:
+            raise CommandError('No unfinished season rollover found.')
+
+        # A RUNNING job whose heartbeat lapsed is taken over by season.run() itself
+        if job.status == 'RUNNING' and not season.lease_expired(job):
+            if not options['force']:
+                raise CommandError(f'Rollover {job.id} is already running; use --force if its worker died.')
+            SeasonRollover.objects.filter(pk=job.pk).update(status='PENDING')
+
+        season.run(job)
+        job.refresh_from_db()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rollover {job.id} finished: {job.payments_deleted} payments and '
+            f'{job.notifications_deleted} notifications deleted, new caja {job.new_caja_id}.'
+        ))
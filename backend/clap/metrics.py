@@ -0,0 +1,200 @@
+"""
+Per-request performance metrics, served in Prometheus text format at /metrics.
+
+MetricsMiddleware records, for every view, the latency, number of SQL
+queries, time spent in SQL and response size. Requests slower than
+METRICS_SLOW_REQUEST_MS are logged to 'clap.metrics' together with their
+slowest queries.
+
+With METRICS_ENABLED off the middleware removes itself from the stack when
+the server starts (MiddlewareNotUsed), so requests pay nothing for it.
+
+Aggregates live in the process, like the notification broker: with several
+workers each one exposes its own numbers, which Prometheus sums per target.
+"""
+import heapq
+import logging
+import threading
+import time
+from contextlib import ExitStack
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger('clap.metrics')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_labels(labels, le=bound)} {cumulative}'
+        yield f'{name}_sum{_labels(labels)} {_number(self.sum)}'
+        yield f'{name}_count{_labels(labels)} {cumulative}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+class Registry:
+    HISTOGRAMS = (
+        ('clap_http_request_duration_seconds', 'Time spent producing the response.', LATENCY_BUCKETS),
+        ('clap_http_db_queries', 'SQL queries run per request.', QUERY_BUCKETS),
+        ('clap_http_response_size_bytes', 'Size of non-streaming response bodies.', SIZE_BUCKETS),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._views = {}
+
+    def record(self, view, method, status, duration, queries, db_time, size):
+        with self._lock:
+            entry = self._views.get((view, method))
+            if entry is None:
+                entry = self._views[(view, method)] = {
+                    'histograms': {name: Histogram(buckets) for name, _, buckets in self.HISTOGRAMS},
+                    'statuses': {},
+                    'db_seconds': 0,
+                }
+            histograms = entry['histograms']
+            histograms['clap_http_request_duration_seconds'].observe(duration)
+            if queries is not None:
+                histograms['clap_http_db_queries'].observe(queries)
+                entry['db_seconds'] += db_time
+            if size is not None:
+                histograms['clap_http_response_size_bytes'].observe(size)
+            entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+
+    def render(self):
+        with self._lock:
+            views = sorted(self._views.items())
+            lines = ['# HELP clap_http_requests_total Requests handled, by view, method and status.',
+                     '# TYPE clap_http_requests_total counter']
+            for (view, method), entry in views:
+                for status, count in sorted(entry['statuses'].items()):
+                    lines.append(f'clap_http_requests_total{_labels([("view", view), ("method", method), ("status", status)])} {count}')
+            lines += ['# HELP clap_http_db_duration_seconds_total Time spent waiting on SQL queries.',
+                      '# TYPE clap_http_db_duration_seconds_total counter']
+            for (view, method), entry in views:
+                lines.append(f'clap_http_db_duration_seconds_total{_labels([("view", view), ("method", method)])} {_number(entry["db_seconds"])}')
+            for name, help_text, _ in self.HISTOGRAMS:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for (view, method), entry in views:
+                    histogram = entry['histograms'][name]
+                    if any(histogram.counts):
+                        lines.extend(histogram.samples(name, [('view', view), ('method', method)]))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class QueryTimer:
+    """execute_wrapper that counts queries and keeps the slowest ones."""
+
+    def __init__(self, keep):
+        self.keep = keep
+        self.count = 0
+        self.total = 0
+        self.slowest = []  # Min-heap of (duration, sql)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.total += elapsed
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, (elapsed, sql))
+            elif elapsed > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (elapsed, sql))
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    # Never the raw path: ids in URLs would create a series per object
+    return match.view_name if match is not None else 'unmatched'
+
+
+def _response_size(response):
+    return None if response.streaming else len(response.content)
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_threshold = settings.METRICS_SLOW_REQUEST_MS / 1000
+        self.slow_queries = settings.METRICS_SLOW_QUERIES_LOGGED
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = QueryTimer(self.slow_queries)
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timer))
+            response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - started, timer)
+        return response
+
+    async def __acall__(self, request):
+        # Under ASGI, sync views run their queries on other threads: only the latency is measured
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, time.perf_counter() - started, None)
+        return response
+
+    def _record(self, request, response, duration, timer):
+        view = _view_name(request)
+        registry.record(
+            view, request.method, response.status_code, duration,
+            timer.count if timer else None, timer.total if timer else 0, _response_size(response),
+        )
+        if duration >= self.slow_threshold:
+            slowest = sorted(timer.slowest, reverse=True) if timer else []
+            logger.warning(
+                'Slow request: %s %s (%s) took %.0f ms, %s queries in %.0f ms%s',
+                request.method, request.path, view, duration * 1000,
+                timer.count if timer else '?', (timer.total if timer else 0) * 1000,
+                ''.join(f'\n  {elapsed * 1000:.1f} ms: {sql}' for elapsed, sql in slowest),
+            )
@@ -1,8 +1,56 @@
 from django.db import models
+from django.core.cache import cache
+from django.db.models import Count, Max, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from users.models import UsersCustom
+from . import caching
+from .delivery import new_nonce
 # Create your models here.
 
 
+class Community(models.Model):
+    """
+    A community or distribution point. Each one runs its own caja, with its own
+    stock, and its residents (UsersCustom.community) pay for that caja.
+    Residents without a community use the cajas that have none.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    address = models.CharField(max_length=200, blank=True, null=True)
+
+    def __str__(self):
+        return self.name
+
+
+class CajaQuerySet(models.QuerySet):
+
+        def update(self, **kwargs):
+                # Stock and counter updates bypass save(), so the post_save invalidation never sees them
+                updated = super().update(**kwargs)
+                caching.invalidate(caching.CURRENT_CAJA)
+                return updated
+
+        def reserve_stock(self, enabled_only=False):
+                """
+                Takes one unit of stock with a single conditional UPDATE.
+                Returns False when the caja is sold out, so it can never go negative,
+                and with enabled_only also when its payments are disabled, whatever a
+                cached copy of the caja said.
+                """
+                queryset = self.filter(stock__gt=0)
+                if enabled_only:
+                        queryset = queryset.filter(payments_enabled=True)
+                return queryset.update(stock=models.F('stock') - 1) > 0
+
+        def rebuild_counters(self):
+                """Recomputes sold and delivered_count from cajaPersona in a single UPDATE."""
+                def count_of(**filters):
+                        payments = cajaPersona.objects.filter(cajaid=OuterRef('pk'), **filters)
+                        return Coalesce(Subquery(payments.values('cajaid').annotate(total=Count('id')).values('total')), 0)
+
+                return self.update(sold=count_of(status='APPROVED'), delivered_count=count_of(delivered=True))
+
+
 class caja(models.Model):
      
         id = models.AutoField(primary_key=True)
@@ -10,23 +58,101 @@ class caja(models.Model):
         stock = models.IntegerField(default=0)
         date = models.DateTimeField(auto_now_add=True)
         payments_enabled = models.BooleanField(default=True)
+        # Covered by caja_community_date_idx, which current() looks the caja up with
+        community = models.ForeignKey(Community, on_delete=models.PROTECT, blank=True, null=True, related_name='cajas', db_index=False)
+        # Denormalized from cajaPersona; kept in sync by the payment actions
+        sold = models.IntegerField(default=0, editable=False)
+        delivered_count = models.IntegerField(default=0, editable=False)
+
+        objects = CajaQuerySet.as_manager()
+
+        COUNTER_FIELDS = ('sold', 'delivered_count')
+
+        class Meta:
+                indexes = [
+                        models.Index(fields=['community', '-date'], name='caja_community_date_idx'),
+                ]
+
+        @classmethod
+        def current(cls, community=None):
+                """
+                The caja of the running season at a community (its newest one), served from the cache.
+                Takes a Community or its id; None means the cajas without a community.
+                """
+                community_id = getattr(community, 'pk', community)
+                return caching.get_or_load(
+                        caching.CURRENT_CAJA,
+                        lambda: cls.objects.filter(community_id=community_id).order_by('-date').first(),
+                        scope=community_id,
+                )
 
-        @property
-        def sold(self):
-                return cajaPersona.objects.filter(cajaid=self, status='APPROVED').count()
+        def save(self, *args, **kwargs):
+                # Never write back counters read earlier; they only move through F() updates
+                if not self._state.adding and kwargs.get('update_fields') is None:
+                        kwargs['update_fields'] = [
+                                field.name for field in self._meta.concrete_fields
+                                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+                        ]
+                super().save(*args, **kwargs)
 
-        @property
-        def delivered_count(self):
-                return cajaPersona.objects.filter(cajaid=self, delivered=True).count()
+        def payment_stats(self):
+                """Dashboard totals of this caja's payments, computed in one aggregate query."""
+                approved = Q(status='APPROVED')
+                # Aliases must not shadow field names, hence the total_ prefix
+                aggregates = {
+                        'total_payments': Count('id'),
+                        'total_residents': Count('user', distinct=True),
+                        'total_delivered': Count('id', filter=Q(delivered=True)),
+                        'total_pending_delivery': Count('id', filter=approved & Q(delivered=False)),
+                }
+                for value, _ in cajaPersona.PAYMENT_STATUS_CHOICES:
+                        aggregates[f'status_{value}'] = Count('id', filter=Q(status=value))
+                # Amounts are only summed within a currency, never across
+                groups = {'by_moneda': ('moneda', cajaPersona.MONEDA_CHOICES), 'by_payment_method': ('payment_method', cajaPersona.PAYMENT_METHOD_CHOICES)}
+                for group, (field, choices) in groups.items():
+                        for i, (value, _) in enumerate(choices):
+                                aggregates[f'{group}_{i}_count'] = Count('id', filter=Q(**{field: value}))
+                                aggregates[f'{group}_{i}_approved'] = Sum('amount', filter=approved & Q(**{field: value}))
+                row = self.cajapersona_set.aggregate(**aggregates)
+
+                stats = {key: row[f'total_{key}'] for key in ('payments', 'residents', 'delivered', 'pending_delivery')}
+                stats['caja'] = self.pk
+                stats['by_status'] = {value: row[f'status_{value}'] for value, _ in cajaPersona.PAYMENT_STATUS_CHOICES}
+                for group, (field, choices) in groups.items():
+                        stats[group] = {
+                                value: {'count': row[f'{group}_{i}_count'], 'approved_amount': f"{row[f'{group}_{i}_approved'] or 0:.2f}"}
+                                for i, (value, _) in enumerate(choices)
+                        }
+                return stats
 
         def __str__(self):
                 return str(self.id)
         
+class CajaPersonaQuerySet(models.QuerySet):
+
+        # Bulk writes skip the signals, so they invalidate the cached stats themselves
+        def update(self, **kwargs):
+                updated = super().update(**kwargs)
+                caching.invalidate(caching.PAYMENT_STATS)
+                return updated
+
+        def delete(self):
+                deleted = super().delete()
+                caching.invalidate(caching.PAYMENT_STATS)
+                return deleted
+
+        def bulk_create(self, *args, **kwargs):
+                created = super().bulk_create(*args, **kwargs)
+                caching.invalidate(caching.PAYMENT_STATS)
+                return created
+
+
 class cajaPersona(models.Model):
     
         id = models.AutoField(primary_key=True)
-        cajaid = models.ForeignKey(caja, on_delete=models.CASCADE)
-        user = models.ForeignKey(UsersCustom, on_delete=models.CASCADE)
+        # No single-column indexes: the composite ones in Meta start with these columns
+        cajaid = models.ForeignKey(caja, on_delete=models.CASCADE, db_index=False)
+        user = models.ForeignKey(UsersCustom, on_delete=models.CASCADE, db_index=False)
         date = models.DateTimeField(auto_now_add=True)
         delivered = models.BooleanField(default=False)
         payment_method = models.CharField(max_length=50, blank=True, null=True)
@@ -35,7 +161,10 @@ class cajaPersona(models.Model):
         bank_name = models.CharField(max_length=100, blank=True, null=True)
         sender_phone = models.CharField(max_length=20, blank=True, null=True)
         img = models.ImageField(upload_to='caja_images/', blank=True, null=True)
+        thumbnail = models.ImageField(upload_to='caja_images/thumbnails/', blank=True, null=True, editable=False)
         moneda = models.CharField(max_length=10, default='Bs')
+        # Part of the signed QR code used to confirm the delivery (see clap.delivery)
+        delivery_nonce = models.CharField(max_length=32, default=new_nonce, editable=False)
         PAYMENT_STATUS_CHOICES = [
                 ('PENDING', 'Pending'),
                 ('APPROVED', 'Approved'),
@@ -46,15 +175,92 @@ class cajaPersona(models.Model):
                 choices=PAYMENT_STATUS_CHOICES,
                 default='PENDING',
         )
-        
+        PAYMENT_METHOD_CHOICES = [
+                ('Efectivo', 'Efectivo'),
+                ('Pago Movil', 'Pago Movil'),
+        ]
+        MONEDA_CHOICES = [
+                ('Bs', 'Bolivares'),
+                ('USD', 'Dolar'),
+                ('EUR', 'Euro'),
+                ('Peso', 'Peso'),
+        ]
+
+        objects = CajaPersonaQuerySet.as_manager()
+
+        class Meta:
+                indexes = [
+                        models.Index(fields=['cajaid', 'status'], name='payment_caja_status_idx'),
+                        models.Index(fields=['cajaid', 'delivered'], name='payment_caja_delivered_idx'),
+                        models.Index(fields=['user', 'cajaid'], name='payment_user_caja_idx'),
+                        models.Index(fields=['reference', 'bank_name'], name='payment_reference_idx'),
+                ]
+                constraints = [
+                        # A resident has at most one live payment per season; rejected ones may pile up
+                        models.UniqueConstraint(
+                                fields=['user', 'cajaid'], condition=Q(status__in=['PENDING', 'APPROVED']),
+                                name='one_active_payment_per_caja',
+                        ),
+                ]
+
+        def delete(self, *args, **kwargs):
+                # Not a post_delete receiver: that would stop QuerySet.delete() from deleting in bulk
+                deleted = super().delete(*args, **kwargs)
+                caching.invalidate(caching.PAYMENT_STATS)
+                return deleted
+
         def __str__(self):
                 return f"{self.user.username} - {self.cajaid.id} - {self.date}"
 
+class BroadcastNotification(models.Model):
+    """
+    A message addressed to every non-admin user, stored once.
+    Each user gets their own Notification row (their read state) the first
+    time they load their feed after the broadcast was sent.
+    A scoped broadcast, such as a caja's price change, only reaches the
+    residents of its community (those without one when it has none).
+    """
+    message = models.CharField(max_length=255)
+    timestamp = models.DateTimeField(auto_now_add=True)
+    scoped = models.BooleanField(default=False)
+    community = models.ForeignKey(Community, on_delete=models.CASCADE, blank=True, null=True, related_name='broadcasts')
+
+    @classmethod
+    def deliver_pending(cls, user):
+        if user.is_staff:
+            return
+        # Skip the lookup entirely when nothing was broadcast since this user's last sync
+        latest = caching.get_or_load(caching.LATEST_BROADCAST, lambda: cls.objects.aggregate(latest=Max('id'))['latest'])
+        synced_key = f'clap:broadcast_synced:{user.pk}'
+        if latest is None or cache.get(synced_key) == latest:
+            return
+        pending = cls.objects.filter(
+            Q(scoped=False) | Q(community=user.community_id), timestamp__gte=user.date_joined,
+        ).exclude(deliveries__user=user)
+        Notification.objects.bulk_create([
+            Notification(user=user, broadcast=broadcast, message=broadcast.message, timestamp=broadcast.timestamp)
+            for broadcast in pending
+        ], ignore_conflicts=True)
+        cache.set(synced_key, latest, None)
+
+    def __str__(self):
+        return f"Broadcast: {self.message}"
+
 class Notification(models.Model):
     user = models.ForeignKey(UsersCustom, on_delete=models.CASCADE, related_name='notifications')
+    broadcast = models.ForeignKey(BroadcastNotification, on_delete=models.CASCADE, related_name='deliveries', blank=True, null=True)
     message = models.CharField(max_length=255)
     read = models.BooleanField(default=False)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'broadcast'], name='unique_broadcast_delivery'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-timestamp'], name='notification_feed_idx'),
+            models.Index(fields=['user', 'read', 'timestamp'], name='notification_unread_idx'),
+        ]
 
     def __str__(self):
         return f"Notification for {self.user.username}: {self.message}"
@@ -64,6 +270,13 @@ class PagoMovilConfig(models.Model):
     telefono = models.CharField(max_length=20)
     banco = models.CharField(max_length=100)
 
+    @classmethod
+    def load(cls):
+        return caching.get_or_load(caching.PAGO_MOVIL_CONFIG, lambda: cls.objects.get_or_create(
+            id=1,
+            defaults={'cedula': '', 'telefono': '', 'banco': ''}
+        )[0])
+
     def __str__(self):
         return f"Configuración de Pago Móvil ({self.banco})"
 
@@ -71,5 +284,90 @@ class SupportConfig(models.Model):
     email = models.EmailField()
     phone_number = models.CharField(max_length=20, blank=True, null=True)
 
+    @classmethod
+    def load(cls):
+        return caching.get_or_load(caching.SUPPORT_CONFIG, lambda: cls.objects.get_or_create(
+            id=1,
+            defaults={'email': 'support@example.com', 'phone_number': '1234567890'}
+        )[0])
+
+    def __str__(self):
+        return f"Configuración de Soporte ({self.email})"
+
+class SeasonRollover(models.Model):
+    """
+    A request to close the season: archive every payment, delete the receipt
+    images and notifications, then open a new caja at every distribution point
+    that had one (all with the same price and stock; new_caja is the first). Worked through in
+    batches by clap.season so it can run in the background and resume after
+    a crash, even one that left it RUNNING (see heartbeat).
+    """
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('RUNNING', 'Running'),
+        ('DONE', 'Done'),
+        ('FAILED', 'Failed'),
+    ]
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    stock = models.IntegerField()
+    new_caja = models.ForeignKey(caja, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    # Moved forward by the worker after every batch; once it is SEASON_ROLLOVER_LEASE seconds old,
+    # the worker is taken for dead and another process may take the job over
+    heartbeat = models.DateTimeField(default=timezone.now)
+    payments_total = models.IntegerField(default=0)
+    payments_deleted = models.IntegerField(default=0)
+    notifications_deleted = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"Season rollover {self.id} ({self.status})"
+
+
+class SeasonArchive(models.Model):
+    """
+    A closed season: its caja and the totals of its payments, kept after the
+    rollover removed both from the live tables.
+    """
+    rollover = models.ForeignKey(SeasonRollover, on_delete=models.SET_NULL, blank=True, null=True, related_name='archives')
+    # The caja is deleted by the rollover, so only its values are kept
+    caja_number = models.IntegerField()
+    community = models.ForeignKey(Community, on_delete=models.SET_NULL, blank=True, null=True, related_name='archives')
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    stock = models.IntegerField()
+    sold = models.IntegerField()
+    delivered_count = models.IntegerField()
+    opened = models.DateTimeField()
+    archived = models.DateTimeField(auto_now_add=True)
+    stats = models.JSONField()  # caja.payment_stats() of the closed season
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['rollover', 'caja_number'], name='unique_season_archive'),
+        ]
+
+    def __str__(self):
+        return f"Season {self.caja_number} ({self.opened:%Y-%m-%d})"
+
+class ArchivedPayment(models.Model):
+    """A past season's payment, without the receipt images and the sender's bank details."""
+    season = models.ForeignKey(SeasonArchive, on_delete=models.CASCADE, related_name='payments')
+    user = models.ForeignKey(UsersCustom, on_delete=models.CASCADE, related_name='archived_payments')
+    date = models.DateTimeField()
+    payment_method = models.CharField(max_length=50, blank=True, null=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    moneda = models.CharField(max_length=10)
+    reference = models.CharField(max_length=100, blank=True, null=True)
+    status = models.CharField(max_length=10, choices=cajaPersona.PAYMENT_STATUS_CHOICES)
+    delivered = models.BooleanField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-id'], name='archived_payment_user_idx'),
+            models.Index(fields=['season', '-id'], name='archived_payment_season_idx'),
+        ]
+
     def __str__(self):
-        return f"Configuración de Soporte ({self.email})"
\ No newline at end of file
+        return f"{self.user_id} - season {self.season_id} - {self.status}"
@@ -0,0 +1,32 @@
+from rest_framework.pagination import CursorPagination
+
+
+class NotificationCursorPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('-timestamp', '-id')
+
+
+class PaymentCursorPagination(CursorPagination):
+    """
+    Keyset pagination over the payment id. Only applied when the client asks
+    for it with ?page_size= or ?cursor=, so existing callers keep getting a plain list.
+    """
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    ordering = '-id'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.page_size_query_param not in request.query_params and self.cursor_query_param not in request.query_params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+
+class ArchiveCursorPagination(CursorPagination):
+    """Always on: the archive grows by a whole season every rollover."""
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    ordering = '-id'
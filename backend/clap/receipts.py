@@ -0,0 +1,41 @@
+"""
+Shrinks uploaded payment receipts before they are stored.
+
+Phones upload multi-megabyte photos; admins only need a readable receipt.
+JPEGs are decoded straight at a reduced scale (Image.draft), so even a large
+photo never expands to full resolution in memory. The result is rotated
+upright, stripped of EXIF, downscaled and re-encoded, plus a small thumbnail
+for the admin list.
+"""
+import os
+from io import BytesIO
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, features
+
+MAX_SIZE = (1600, 1600)
+THUMBNAIL_SIZE = (320, 320)
+QUALITY = 80
+THUMBNAIL_QUALITY = 70
+FORMAT, EXTENSION = ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+
+
+def _encode(image, quality):
+    buffer = BytesIO()
+    # No exif= argument, so none of the phone's metadata (GPS included) is written back
+    image.save(buffer, FORMAT, quality=quality)
+    return buffer.getvalue()
+
+
+def process_receipt(upload):
+    """Returns (image, thumbnail) as ContentFiles ready to assign to cajaPersona."""
+    upload.seek(0)
+    with Image.open(upload) as original:
+        original.draft('RGB', MAX_SIZE)
+        image = ImageOps.exif_transpose(original).convert('RGB')
+    image.thumbnail(MAX_SIZE)
+    content = _encode(image, QUALITY)
+    image.thumbnail(THUMBNAIL_SIZE)
+    thumbnail = _encode(image, THUMBNAIL_QUALITY)
+
+    stem = os.path.splitext(os.path.basename(upload.name))[0]
+    return ContentFile(content, name=f'{stem}.{EXTENSION}'), ContentFile(thumbnail, name=f'{stem}.{EXTENSION}')
@@ -0,0 +1,38 @@
+"""
+JSON renderer backed by orjson, which encodes large lists several times
+faster than the standard library encoder behind DRF's JSONRenderer.
+
+It writes the same bytes JSONRenderer writes with the default settings
+(compact, UTF-8, U+2028 and U+2029 escaped): dates, times and anything else
+orjson does not know go through DRF's encoder, and whatever orjson refuses
+(non-string keys, integers over 64 bits) is rendered by JSONRenderer itself,
+as is any indented or non-default output. What is left concerns floats
+only: those Python writes in exponent form (1e-05, 1e+16) are spelled
+0.00001 and 1e16, and NaN becomes null instead of an error. The API sends
+decimals as strings and no floats.
+
+Selected through REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES']; putting
+rest_framework.renderers.JSONRenderer back there restores the stdlib encoder.
+"""
+import orjson
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+
+OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+
+class FastJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        renderer_context = renderer_context or {}
+        if (self.get_indent(accepted_media_type, renderer_context) or self.encoder_class is not JSONRenderer.encoder_class
+                or not (api_settings.COMPACT_JSON and api_settings.UNICODE_JSON and api_settings.STRICT_JSON)):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=OPTIONS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escaped by JSONRenderer too: valid in JSON, line terminators in JavaScript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
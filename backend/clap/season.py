@@ -0,0 +1,160 @@
+"""
+Season rollover worker.
+
+Each caja being closed is first summed up into a SeasonArchive. Its
+payments are then moved into ArchivedPayment, so the live tables only ever
+hold the running season while the history stays queryable.
+
+Every step can be repeated safely: rows are moved or deleted in keyset
+batches (id > last seen id), each batch in its own short transaction, and
+the archives and the new cajas are only created once. A rollover
+interrupted halfway is finished by running it again, e.g. with
+`manage.py run_season_rollover`.
+
+The worker beats the job's heartbeat after every batch. A job still RUNNING
+whose heartbeat is older than SEASON_ROLLOVER_LEASE lost its worker (a
+recycled or restarted gunicorn worker takes its threads along), so run()
+takes it over.
+"""
+import logging
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import caja, cajaPersona, Notification, BroadcastNotification, SeasonRollover, SeasonArchive, ArchivedPayment
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+# Copied from each payment into ArchivedPayment; receipts and bank details are not kept
+ARCHIVED_FIELDS = ('user_id', 'date', 'payment_method', 'amount', 'moneda', 'reference', 'status', 'delivered')
+
+
+def _lease_start():
+    return timezone.now() - timedelta(seconds=settings.SEASON_ROLLOVER_LEASE)
+
+
+def lease_expired(job):
+    """True when no worker has shown signs of life on this job for SEASON_ROLLOVER_LEASE seconds."""
+    return job.heartbeat < _lease_start()
+
+
+def _beat(job, **changes):
+    SeasonRollover.objects.filter(pk=job.pk).update(heartbeat=timezone.now(), **changes)
+
+
+def _batches(queryset, *fields):
+    """Yields lists of (id, *fields) rows in id order without keeping a cursor open."""
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', *fields)[:BATCH_SIZE])
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def _archive_seasons(job):
+    """Creates the archive of every caja being closed, before any of its payments move. Returns them by caja id."""
+    archives = {archive.caja_number: archive for archive in job.archives.all()}
+    for box in caja.objects.exclude(pk__in=list(archives)).order_by('id'):
+        archives[box.pk] = SeasonArchive.objects.create(
+            rollover=job, caja_number=box.pk, community_id=box.community_id, price=box.price, stock=box.stock, sold=box.sold,
+            delivered_count=box.delivered_count, opened=box.date, stats=box.payment_stats(),
+        )
+        _beat(job)
+    return archives
+
+
+def _delete_files(names):
+    # The rows are gone, so no later run would find a file left behind here again
+    for name in names:
+        try:
+            default_storage.delete(name)
+        except OSError:
+            logger.exception('Could not delete the archived receipt %s', name)
+
+
+def _archive_payments(job, archives):
+    for rows in _batches(cajaPersona.objects.all(), 'cajaid_id', *ARCHIVED_FIELDS):
+        with transaction.atomic():
+            # A worker taken for dead may still be finishing this batch; only what it left is moved
+            remaining = {
+                payment_id: (img, thumbnail)
+                for payment_id, img, thumbnail in cajaPersona.objects.select_for_update().filter(
+                    id__in=[row[0] for row in rows]).values_list('id', 'img', 'thumbnail')
+            }
+            ArchivedPayment.objects.bulk_create([
+                ArchivedPayment(season=archives[caja_id], **dict(zip(ARCHIVED_FIELDS, values)))
+                for payment_id, caja_id, *values in rows if payment_id in remaining
+            ])
+            deleted, _ = cajaPersona.objects.filter(id__in=remaining).delete()
+            _beat(job, payments_deleted=F('payments_deleted') + deleted)
+            # Receipts go once their rows are gone for good: a rolled back batch keeps payments that still show them
+            names = [name for files in remaining.values() for name in files if name]
+            transaction.on_commit(lambda names=names: _delete_files(names))
+
+
+def _delete_notifications(job):
+    for rows in _batches(Notification.objects.all()):
+        with transaction.atomic():
+            deleted, _ = Notification.objects.filter(id__in=[row[0] for row in rows]).delete()
+            _beat(job, notifications_deleted=F('notifications_deleted') + deleted)
+
+
+def run(job):
+    # Claim the job so two workers never run the same rollover at once, unless the one running it stopped beating
+    claimable = Q(status__in=['PENDING', 'FAILED']) | Q(status='RUNNING', heartbeat__lt=_lease_start())
+    if not SeasonRollover.objects.filter(claimable, pk=job.pk).update(status='RUNNING', heartbeat=timezone.now()):
+        return
+    try:
+        # Stop residents' payments from arriving while the old ones are being removed
+        caja.objects.update(payments_enabled=False)
+        SeasonRollover.objects.filter(pk=job.pk).update(payments_total=F('payments_deleted') + cajaPersona.objects.count())
+
+        _archive_payments(job, _archive_seasons(job))
+        _delete_notifications(job)
+
+        with transaction.atomic():
+            job = SeasonRollover.objects.select_for_update().get(pk=job.pk)
+            if job.new_caja_id is None:
+                # Locked, no payment can join the old cajas any more. Those that did after the batches
+                # above (admins may still register one) are archived here instead of cascading away with them.
+                communities = set(caja.objects.select_for_update().values_list('community_id', flat=True))
+                late = cajaPersona.objects.count()
+                if late:
+                    SeasonRollover.objects.filter(pk=job.pk).update(payments_total=F('payments_total') + late)
+                    _archive_payments(job, _archive_seasons(job))
+                # Every distribution point that ran a caja this season opens the next one
+                communities = sorted(communities, key=lambda c: (c is not None, c)) or [None]
+                caja.objects.all().delete()
+                BroadcastNotification.objects.all().delete()
+                job.new_caja = [
+                    caja.objects.create(price=job.price, stock=job.stock, payments_enabled=True, community_id=community)
+                    for community in communities
+                ][0]
+                BroadcastNotification.objects.create(
+                    message="¡Nueva temporada de cajas disponible! Ya puedes realizar tu pago."
+                )
+            job.status = 'DONE'
+            job.finished = timezone.now()
+            # The counters may have moved since the row was read
+            job.save(update_fields=['new_caja', 'status', 'finished'])
+    except Exception as e:
+        SeasonRollover.objects.filter(pk=job.pk).update(status='FAILED', error=str(e))
+        raise
+
+
+def run_in_background(job):
+    def target():
+        try:
+            run(job)
+        except Exception:
+            pass  # Recorded on the job as FAILED
+        finally:
+            connection.close()
+
+    threading.Thread(target=target, daemon=True).start()
@@ -1,51 +1,43 @@
 from rest_framework import serializers
-from .models import caja, cajaPersona, Notification, PagoMovilConfig, SupportConfig
-from users.serializer import UserSerializer
+from .models import Community, caja, cajaPersona, Notification, PagoMovilConfig, SupportConfig, SeasonRollover, SeasonArchive, ArchivedPayment
+from users.serializer import UserSerializer, UserSummarySerializer
+from .receipts import process_receipt
 
 class SupportConfigSerializer(serializers.ModelSerializer):
     class Meta:
         model = SupportConfig
         fields = '__all__'
 
+class CommunitySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Community
+        fields = ['id', 'name', 'address']
+
 class CajaSerializer(serializers.ModelSerializer):
     sold = serializers.IntegerField(read_only=True)
     delivered_count = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = caja
-        fields = ['id', 'price', 'stock', 'date', 'payments_enabled', 'sold', 'delivered_count']
+        fields = ['id', 'community', 'price', 'stock', 'date', 'payments_enabled', 'sold', 'delivered_count']
 
 class CajaPersonaSerializer(serializers.ModelSerializer):
-    PAYMENT_METHOD_CHOICES = [
-        ('Efectivo', 'Efectivo'),
-        ('Pago Movil', 'Pago Movil'),
-    ]
-    
-    MONEDA_CHOICES = [
-        ('Bs', 'Bolivares'),
-        ('USD', 'Dolar'),
-        ('EUR', 'Euro'),
-        ('Peso', 'Peso'),
-    ]
-    
-    payment_method = serializers.ChoiceField(choices=PAYMENT_METHOD_CHOICES)
-    moneda = serializers.ChoiceField(choices=MONEDA_CHOICES, default='Bs')
+    payment_method = serializers.ChoiceField(choices=cajaPersona.PAYMENT_METHOD_CHOICES)
+    moneda = serializers.ChoiceField(choices=cajaPersona.MONEDA_CHOICES, default='Bs')
     user = UserSerializer(read_only=True)
     
     class Meta:
         model = cajaPersona
-        fields = ['id', 'cajaid', 'user', 'date', 'delivered', 'payment_method', 'amount', 'reference', 'bank_name', 'sender_phone', 'img', 'moneda', 'status']
+        fields = ['id', 'cajaid', 'user', 'date', 'delivered', 'payment_method', 'amount', 'reference', 'bank_name', 'sender_phone', 'img', 'thumbnail', 'moneda', 'status']
         read_only_fields = ('status',)
 
-    def create(self, validated_data):
-        caja_instance = validated_data['cajaid']
-        if caja_instance.stock > 0:
-            caja_instance.stock -= 1
-            validated_data['user'] = self.context['request'].user
-            caja_instance.save()
-            return super().create(validated_data)
-        else:
-            raise serializers.ValidationError("No hay cajas disponibles en stock.")
+    def validate(self, data):
+        if data.get('img'):
+            data['img'], data['thumbnail'] = process_receipt(data['img'])
+        return data
+
+class CajaPersonaListSerializer(CajaPersonaSerializer):
+    user = UserSummarySerializer(read_only=True)
 
 class NotificationSerializer(serializers.ModelSerializer):
     class Meta:
@@ -57,3 +49,22 @@ class PagoMovilConfigSerializer(serializers.ModelSerializer):
     class Meta:
         model = PagoMovilConfig
         fields = '__all__'
+
+class SeasonRolloverSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SeasonRollover
+        fields = ['id', 'status', 'price', 'stock', 'new_caja', 'heartbeat', 'payments_total', 'payments_deleted', 'notifications_deleted', 'error', 'created', 'finished']
+        read_only_fields = ('status', 'new_caja', 'heartbeat', 'payments_total', 'payments_deleted', 'notifications_deleted', 'error', 'created', 'finished')
+
+class SeasonArchiveSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SeasonArchive
+        fields = ['id', 'caja_number', 'community', 'price', 'stock', 'sold', 'delivered_count', 'opened', 'archived', 'stats']
+
+class ArchivedPaymentSerializer(serializers.ModelSerializer):
+    user = UserSummarySerializer(read_only=True)
+    season_opened = serializers.DateTimeField(source='season.opened', read_only=True)
+
+    class Meta:
+        model = ArchivedPayment
+        fields = ['id', 'season', 'season_opened', 'user', 'date', 'payment_method', 'amount', 'moneda', 'reference', 'status', 'delivered']
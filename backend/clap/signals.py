@@ -0,0 +1,54 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from . import caching
+from .events import get_broker
+from .models import caja, cajaPersona, BroadcastNotification, Notification, PagoMovilConfig, SupportConfig
+
+CACHED_MODELS = {
+    caja: caching.CURRENT_CAJA,
+    PagoMovilConfig: caching.PAGO_MOVIL_CONFIG,
+    SupportConfig: caching.SUPPORT_CONFIG,
+    BroadcastNotification: caching.LATEST_BROADCAST,
+}
+
+
+def invalidate_cached_model(sender, **kwargs):
+    caching.invalidate(CACHED_MODELS[sender])
+
+
+for model in CACHED_MODELS:
+    post_save.connect(invalidate_cached_model, sender=model)
+    post_delete.connect(invalidate_cached_model, sender=model)
+
+
+def invalidate_payment_stats(sender, **kwargs):
+    caching.invalidate(caching.PAYMENT_STATS)
+
+
+# Payment deletes and bulk writes invalidate from cajaPersona and its queryset
+post_save.connect(invalidate_payment_stats, sender=cajaPersona)
+# A new caja starts a new season's stats
+post_save.connect(invalidate_payment_stats, sender=caja)
+post_delete.connect(invalidate_payment_stats, sender=caja)
+
+
+def push_notifications(notifications):
+    """Pushes new notifications once committed. bulk_create skips post_save, so it has to call this itself."""
+    from .serializers import NotificationSerializer
+    events = [(n.user_id, {'type': 'notification', 'data': NotificationSerializer(n).data}) for n in notifications]
+
+    transaction.on_commit(lambda: get_broker().publish_many(events))
+
+
+@receiver(post_save, sender=Notification)
+def push_notification(sender, instance, created, **kwargs):
+    if created:
+        push_notifications([instance])
+
+
+@receiver(post_save, sender=BroadcastNotification)
+def push_broadcast(sender, instance, created, **kwargs):
+    if created:
+        event = {'type': 'broadcast', 'data': {'message': instance.message, 'timestamp': instance.timestamp.isoformat()}}
+        transaction.on_commit(lambda: get_broker().broadcast(event, instance.scoped, instance.community_id))
@@ -1,3 +1,1154 @@
-from django.test import TestCase
+import asyncio
+import csv
+import datetime
+import json
+import logging
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from unittest import mock, skipUnless
+from PIL import Image
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from asgiref.sync import sync_to_async
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.exceptions import ErrorDetail
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from . import benchmarks, caching, delivery, metrics, season
+from .exports import payment_csv
+from .renderers import FastJSONRenderer
+from .serializers import CajaPersonaListSerializer, NotificationSerializer
+from .views import notification_stream
+from .events import PostgresBroker, get_broker
+from .dollar_rate import RATE_KEY, REFRESH_LOCK_KEY, DolarApiClient, DollarRateService, RateUnavailable
+from .models import Community, caja, cajaPersona, Notification, BroadcastNotification, PagoMovilConfig, SupportConfig, SeasonRollover, SeasonArchive, ArchivedPayment
+from users.models import UsersCustom
+from users.views import CustomTokenObtainPairSerializer
 
 # Create your tests here.
+
+
+def make_user(n, **extra):
+    return UsersCustom.objects.create_user(
+        username=f'user{n}', cedula=f'V{n}', phone=f'0414{n:07d}', **extra
+    )
+
+
+class ClearCacheMixin:
+    def _pre_setup(self):
+        super()._pre_setup()
+        cache.clear()
+
+
+class BroadcastNotificationTests(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.admin = make_user(0, is_staff=True)
+        self.residents = [make_user(n) for n in range(1, 4)]
+        self.caja = caja.objects.create(price=10, stock=5)
+        self.client = APIClient()
+
+    def test_price_update_writes_a_single_row(self):
+        self.client.force_authenticate(self.admin)
+        with self.assertNumQueries(5):
+            response = self.client.patch(f'/clap/cajas/{self.caja.id}/', {'price': '12.00'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(BroadcastNotification.objects.count(), 1)
+        self.assertEqual(Notification.objects.count(), 0)
+
+    def test_broadcast_is_delivered_once_on_feed_load(self):
+        BroadcastNotification.objects.create(message='Nueva temporada')
+        self.client.force_authenticate(self.residents[0])
+        self.client.get('/clap/notifications/')
+        response = self.client.get('/clap/notifications/')
+        self.assertEqual([n['message'] for n in response.data['results']], ['Nueva temporada'])
+        self.assertEqual(Notification.objects.filter(user=self.residents[0]).count(), 1)
+
+        notification_id = response.data['results'][0]['id']
+        self.client.post(f'/clap/notifications/{notification_id}/mark_as_read/')
+        self.assertTrue(Notification.objects.get(id=notification_id).read)
+
+    def test_broadcast_skips_admins_and_later_users(self):
+        BroadcastNotification.objects.create(message='Precio actualizado')
+        late_user = make_user(99)
+        for user in (self.admin, late_user):
+            self.client.force_authenticate(user)
+            self.assertEqual(self.client.get('/clap/notifications/').data['results'], [])
+
+
+class NotificationFeedTests(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.user = make_user(1)
+        self.other = make_user(2)
+        Notification.objects.bulk_create(
+            [Notification(user=self.user, message=f'Mensaje {n}') for n in range(25)]
+            + [Notification(user=self.other, message='Ajeno')]
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_feed_is_cursor_paginated(self):
+        first = self.client.get('/clap/notifications/')
+        self.assertEqual(len(first.data['results']), 20)
+        second = self.client.get(first.data['next'])
+        self.assertEqual(len(second.data['results']), 5)
+        self.assertIsNone(second.data['next'])
+
+    def test_unread_count_is_one_query_per_poll(self):
+        self.client.get('/clap/notifications/unread_count/')
+        with self.assertNumQueries(1):
+            response = self.client.get('/clap/notifications/unread_count/')
+        self.assertEqual(response.data, {'unread': 25})
+
+    def test_bulk_mark_as_read(self):
+        ids = list(Notification.objects.filter(user=self.user).values_list('id', flat=True)[:3])
+        other_id = Notification.objects.get(user=self.other).id
+        response = self.client.post('/clap/notifications/mark_read/', {'ids': ids + [other_id]}, format='json')
+        self.assertEqual(response.data['updated'], 3)
+        self.assertFalse(Notification.objects.get(id=other_id).read)
+
+        with self.assertNumQueries(1):
+            response = self.client.post('/clap/notifications/mark_all_read/')
+        self.assertEqual(response.data['updated'], 22)
+        self.assertEqual(self.client.get('/clap/notifications/unread_count/').data, {'unread': 0})
+
+    def test_cannot_mark_someone_elses_notification(self):
+        other_id = Notification.objects.get(user=self.other).id
+        response = self.client.post(f'/clap/notifications/{other_id}/mark_as_read/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_malformed_ids_are_rejected(self):
+        self.assertEqual(self.client.post('/clap/notifications/abc/mark_as_read/').status_code, 404)
+        for ids in (['abc'], [1, '2'], [True], 'abc'):
+            response = self.client.post('/clap/notifications/mark_read/', {'ids': ids}, format='json')
+            self.assertEqual(response.status_code, 400, ids)
+
+
+class NotificationStreamTests(ClearCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.resident = make_user(1)
+        self.admin = make_user(0, is_staff=True)
+
+    async def open_stream(self, user):
+        request = AsyncRequestFactory().get('/clap/notifications/stream/', {'token': str(AccessToken.for_user(user))})
+        response = await notification_stream(request)
+        stream = response.streaming_content
+        self.assertEqual(await stream.__anext__(), b'retry: 5000\n\n')
+        return stream
+
+    async def test_pushes_own_notifications_and_broadcasts(self):
+        resident_stream = await self.open_stream(self.resident)
+        admin_stream = await self.open_stream(self.admin)
+
+        await sync_to_async(Notification.objects.create)(user=self.resident, message='Tu pago ha sido aprobado')
+        await sync_to_async(BroadcastNotification.objects.create)(message='Nueva temporada')
+
+        first = await asyncio.wait_for(resident_stream.__anext__(), 1)
+        self.assertTrue(first.startswith(b'event: notification\n'))
+        self.assertIn('Tu pago ha sido aprobado', first.decode())
+        second = await asyncio.wait_for(resident_stream.__anext__(), 1)
+        self.assertTrue(second.startswith(b'event: broadcast\n'))
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(admin_stream.__anext__(), 0.2)
+
+    @override_settings(NOTIFICATION_STREAM_HEARTBEAT=0.05)
+    async def test_disconnect_ends_the_stream_and_its_subscription(self):
+        from config.asgi import application
+        token = str(CustomTokenObtainPairSerializer.get_token(self.resident).access_token)
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': '/clap/notifications/stream/', 'query_string': f'token={token}'.encode(),
+            'headers': [], 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 1), 'root_path': '',
+        }
+        gone, streaming = asyncio.Event(), asyncio.Event()
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            # Like uvicorn, anything sent after the disconnect is silently dropped
+            if message['type'] == 'http.response.body' and message['body'] == b'retry: 5000\n\n':
+                streaming.set()
+
+        handler = asyncio.ensure_future(application(scope, receive, send))
+        await asyncio.wait_for(streaming.wait(), 1)
+        subscriptions = get_broker()._subscriptions
+        self.assertEqual(len(subscriptions.get(self.resident.id, ())), 1)
+
+        gone.set()
+        await asyncio.wait_for(handler, 1)
+        self.assertNotIn(self.resident.id, subscriptions)
+
+    async def test_price_change_is_pushed_only_to_that_communitys_residents(self):
+        def setup():
+            north, south = Community.objects.create(name='Norte'), Community.objects.create(name='Sur')
+            north_resident, south_resident = make_user(2, community=north), make_user(3, community=south)
+            north_caja = caja.objects.create(price=10, stock=5, community=north)
+            return [str(CustomTokenObtainPairSerializer.get_token(user).access_token) for user in (north_resident, south_resident)], north_caja
+        (north_token, south_token), north_caja = await sync_to_async(setup)()
+        streams = []
+        for token in (north_token, south_token):
+            response = await notification_stream(AsyncRequestFactory().get('/clap/notifications/stream/', {'token': token}))
+            streams.append(response.streaming_content)
+            await streams[-1].__anext__()
+
+        def change_price():
+            client = APIClient()
+            client.force_authenticate(self.admin)
+            return client.patch(f'/clap/cajas/{north_caja.id}/', {'price': '12.00'}).status_code
+        self.assertEqual(await sync_to_async(change_price)(), 200)
+
+        north_stream, south_stream = streams
+        self.assertIn('Norte', (await asyncio.wait_for(north_stream.__anext__(), 1)).decode())
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(south_stream.__anext__(), 0.2)
+
+    def test_refused_under_wsgi(self):
+        token = CustomTokenObtainPairSerializer.get_token(self.resident).access_token
+        response = self.client.get('/clap/notifications/stream/', {'token': str(token)})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(get_broker()._subscriptions, {})
+
+    def test_tokens_are_hidden_from_the_access_log(self):
+        from config.asgi import HideTokens
+        record = logging.LogRecord('uvicorn.access', logging.INFO, '', 0, '%s - "%s %s HTTP/%s" %d',
+                                   ('127.0.0.1:1', 'GET', '/clap/notifications/stream/?token=a.b.c&x=1', '1.1', 200), None)
+        HideTokens().filter(record)
+        self.assertEqual(record.getMessage(), '127.0.0.1:1 - "GET /clap/notifications/stream/?token=[hidden]&x=1 HTTP/1.1" 200')
+
+    async def test_rejects_missing_or_bad_token(self):
+        request = AsyncRequestFactory().get('/clap/notifications/stream/', {'token': 'nope'})
+        response = await notification_stream(request)
+        self.assertEqual(response.status_code, 401)
+
+    @skipUnless(connection.vendor == 'postgresql', 'LISTEN/NOTIFY needs PostgreSQL')
+    def test_postgres_broker_sends_a_batch_in_one_statement(self):
+        listener = connection.get_new_connection(connection.get_connection_params())
+        listener.autocommit = True
+        try:
+            with listener.cursor() as cursor:
+                cursor.execute(f'LISTEN {PostgresBroker.CHANNEL}')
+            with CaptureQueriesContext(connection) as queries:
+                PostgresBroker().publish_many([(n, {'type': 'notification', 'data': {'id': n}}) for n in range(1, 4)])
+            self.assertEqual(len(queries), 1)
+
+            received = []
+            deadline = time.monotonic() + 2
+            while len(received) < 3 and time.monotonic() < deadline:
+                listener.poll()
+                received += [json.loads(notify.payload) for notify in listener.notifies]
+                listener.notifies.clear()
+                time.sleep(0.01)
+            self.assertEqual([message['user_id'] for message in received], [1, 2, 3])
+        finally:
+            listener.close()
+
+
+class CajaCounterTests(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.admin = make_user(0, is_staff=True)
+        self.residents = [make_user(n) for n in range(1, 4)]
+        self.caja = caja.objects.create(price=10, stock=5)
+        self.payments = [
+            cajaPersona.objects.create(cajaid=self.caja, user=user, payment_method='Pago Movil')
+            for user in self.residents
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def post(self, payment, action):
+        return self.client.post(f'/clap/cajaspersona/{payment.id}/{action}/')
+
+    def test_actions_keep_counters_in_sync(self):
+        self.post(self.payments[0], 'approve_payment')
+        self.post(self.payments[0], 'approve_payment')
+        self.post(self.payments[1], 'approve_payment')
+        self.post(self.payments[1], 'reject_payment')
+        self.post(self.payments[0], 'confirm_delivery')
+        self.post(self.payments[0], 'confirm_delivery')
+        self.caja.refresh_from_db()
+        self.assertEqual((self.caja.sold, self.caja.delivered_count), (1, 1))
+
+    def test_only_approved_undelivered_payments_are_confirmed(self):
+        pending, delivered = self.payments[0], self.payments[1]
+        self.post(delivered, 'approve_payment')
+        self.post(delivered, 'confirm_delivery')
+        notifications = Notification.objects.count()
+
+        response = self.post(pending, 'confirm_delivery')
+        self.assertEqual((response.status_code, response.data['error']), (409, 'Este pago no está aprobado.'))
+        response = self.post(delivered, 'confirm_delivery')
+        self.assertEqual((response.status_code, response.data['error']), (409, 'Esta caja ya fue entregada.'))
+
+        pending.refresh_from_db()
+        self.caja.refresh_from_db()
+        self.assertFalse(pending.delivered)
+        self.assertEqual(self.caja.delivered_count, 1)
+        self.assertEqual(Notification.objects.count(), notifications)
+
+    def test_approving_a_rejected_payment_superseded_by_another_is_refused(self):
+        old = self.payments[0]
+        old.status = 'REJECTED'
+        old.save()
+        cajaPersona.objects.create(cajaid=self.caja, user=old.user, payment_method='Pago Movil')
+        notifications = Notification.objects.count()
+
+        response = self.post(old, 'approve_payment')
+        self.assertEqual(response.status_code, 409)
+        old.refresh_from_db()
+        self.caja.refresh_from_db()
+        self.assertEqual((old.status, self.caja.sold, Notification.objects.count()), ('REJECTED', 0, notifications))
+
+    def test_bulk_approve_reports_conflicts_and_applies_the_rest(self):
+        superseded, twice, other = self.payments
+        cajaPersona.objects.filter(id__in=[superseded.id, twice.id]).update(status='REJECTED')
+        cajaPersona.objects.create(cajaid=self.caja, user=superseded.user, payment_method='Pago Movil')
+        second = cajaPersona.objects.create(cajaid=self.caja, user=twice.user, payment_method='Pago Movil', status='REJECTED')
+
+        response = self.bulk('bulk_approve', [superseded.id, twice.id, second.id, other.id])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [
+            {'id': superseded.id, 'result': 'conflict'}, {'id': twice.id, 'result': 'updated'},
+            {'id': second.id, 'result': 'conflict'}, {'id': other.id, 'result': 'updated'},
+        ])
+        self.caja.refresh_from_db()
+        self.assertEqual(self.caja.sold, 2)
+
+    def test_admin_created_payment_is_approved_and_counted(self):
+        user = make_user(50)
+        response = self.client.post('/clap/cajaspersona/admin_create_payment/', {'user_id': user.id, 'payment_method': 'Efectivo'})
+        self.assertEqual(response.data['status'], 'APPROVED')
+        self.caja.refresh_from_db()
+        self.assertEqual(self.caja.sold, 1)
+
+    def bulk(self, action, ids):
+        return self.client.post(f'/clap/cajaspersona/{action}/', {'ids': ids}, format='json')
+
+    def test_bulk_actions_only_touch_rows_in_a_valid_state(self):
+        ids = [payment.id for payment in self.payments]
+        cajaPersona.objects.filter(id=ids[2]).update(status='REJECTED')
+        response = self.bulk('bulk_approve', ids[:2] + [999])
+        self.assertEqual(response.data['results'], [
+            {'id': ids[0], 'result': 'updated'}, {'id': ids[1], 'result': 'updated'}, {'id': 999, 'result': 'not_found'},
+        ])
+        response = self.bulk('bulk_confirm_delivery', ids)
+        self.assertEqual([row['result'] for row in response.data['results']], ['updated', 'updated', 'skipped'])
+        response = self.bulk('bulk_reject', ids)
+        self.assertEqual([row['result'] for row in response.data['results']], ['updated', 'updated', 'skipped'])
+
+        self.caja.refresh_from_db()
+        self.assertEqual((self.caja.sold, self.caja.delivered_count), (0, 2))
+        self.assertEqual(Notification.objects.filter(user=self.residents[0]).count(), 3)
+        self.assertEqual(Notification.objects.filter(user=self.residents[2]).count(), 0)
+
+    def test_bulk_query_count_does_not_grow_with_the_batch(self):
+        SupportConfig.objects.create(id=1, email='soporte@example.com', phone_number='04141234567')
+        SupportConfig.load()
+        with self.assertNumQueries(6):
+            self.bulk('bulk_approve', [self.payments[0].id])
+        with self.assertNumQueries(6):
+            self.bulk('bulk_reject', [payment.id for payment in self.payments])
+
+    def test_bulk_rejects_bad_ids(self):
+        self.assertEqual(self.bulk('bulk_approve', 'todos').status_code, 400)
+        self.assertEqual(self.bulk('bulk_approve', []).status_code, 400)
+        self.assertEqual(self.bulk('bulk_approve', list(range(1, 1002))).status_code, 400)
+
+    def test_stats_are_one_cached_query_refreshed_by_payment_writes(self):
+        cajaPersona.objects.filter(id=self.payments[0].id).update(status='APPROVED', amount=10, delivered=True)
+        cajaPersona.objects.filter(id=self.payments[1].id).update(status='APPROVED', amount=10, moneda='USD', payment_method='Efectivo')
+        caja.current()
+        with self.assertNumQueries(1):
+            stats = self.client.get('/clap/cajas/stats/').data
+        self.assertEqual(stats['by_status'], {'PENDING': 1, 'APPROVED': 2, 'REJECTED': 0})
+        self.assertEqual((stats['payments'], stats['residents'], stats['delivered'], stats['pending_delivery']), (3, 3, 1, 1))
+        self.assertEqual(stats['by_moneda']['Bs'], {'count': 2, 'approved_amount': '10.00'})
+        self.assertEqual(stats['by_payment_method']['Efectivo'], {'count': 1, 'approved_amount': '10.00'})
+        self.assertEqual(stats['stock'], 5)
+        with self.assertNumQueries(0):
+            self.client.get('/clap/cajas/stats/')
+
+        self.post(self.payments[2], 'approve_payment')
+        self.assertEqual(self.client.get('/clap/cajas/stats/').data['by_status']['APPROVED'], 3)
+        self.payments[2].delete()
+        self.assertEqual(self.client.get('/clap/cajas/stats/').data['payments'], 2)
+
+    def test_moving_a_payment_recounts_both_cajas(self):
+        self.post(self.payments[0], 'approve_payment')
+        other = caja.objects.create(price=10, stock=5)
+        response = self.client.patch(f'/clap/cajaspersona/{self.payments[0].id}/', {'cajaid': other.id})
+        self.assertEqual(response.status_code, 200)
+        self.caja.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.caja.sold, other.sold), (0, 1))
+
+    def test_rebuild_command(self):
+        cajaPersona.objects.filter(id=self.payments[0].id).update(status='APPROVED', delivered=True)
+        call_command('rebuild_caja_counters', stdout=open('/dev/null', 'w'))
+        self.caja.refresh_from_db()
+        self.assertEqual((self.caja.sold, self.caja.delivered_count), (1, 1))
+
+    def test_list_and_payment_details_query_count_is_constant(self):
+        for _ in range(5):
+            caja.objects.create(price=10, stock=5)
+        with self.assertNumQueries(1):
+            self.client.get('/clap/cajas/')
+        # The first call creates the Pago Móvil singleton, which invalidates it once
+        self.client.get('/clap/cajas/payment-details/')
+        self.client.get('/clap/cajas/payment-details/')
+        with self.assertNumQueries(0):
+            self.client.get('/clap/cajas/payment-details/')
+
+
+class AdminPaymentListTests(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.admin = make_user(0, is_staff=True)
+        self.caja = caja.objects.create(price=10, stock=500)
+        cajaPersona.objects.bulk_create([
+            cajaPersona(
+                cajaid=self.caja, user=make_user(n), payment_method='Pago Movil' if n % 2 else 'Efectivo',
+                status='APPROVED' if n % 3 == 0 else 'PENDING', delivered=n % 6 == 0,
+            )
+            for n in range(1, 121)
+        ])
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_page_costs_one_query_and_hides_password(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/clap/cajaspersona/', {'page_size': 50})
+        self.assertEqual(len(response.data['results']), 50)
+        self.assertNotIn('password', response.data['results'][0]['user'])
+
+        seen = {row['id'] for row in response.data['results']}
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen |= {row['id'] for row in response.data['results']}
+        self.assertEqual(len(seen), 120)
+
+    def test_unpaginated_list_is_still_a_plain_list(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/clap/cajaspersona/')
+        self.assertEqual(len(response.data), 120)
+
+    def test_filters(self):
+        response = self.client.get('/clap/cajaspersona/', {'status': 'APPROVED', 'delivered': 'true', 'payment_method': 'Efectivo'})
+        self.assertEqual(len(response.data), 20)
+        response = self.client.get('/clap/cajaspersona/', {'caja': self.caja.id + 1})
+        self.assertEqual(response.data, [])
+        self.assertEqual(self.client.get('/clap/cajaspersona/', {'caja': 'x'}).status_code, 400)
+
+    def test_export_streams_filtered_csv(self):
+        UsersCustom.objects.filter(username='user3').update(fullname='=HYPERLINK("x")', cedula='V-3')
+        response = self.client.get('/clap/cajaspersona/export/', {'status': 'APPROVED'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        with self.assertNumQueries(1):
+            rows = list(csv.reader(b''.join(response.streaming_content).decode('utf-8-sig').splitlines()))
+        self.assertEqual(rows[0], ['ID', 'Fecha', 'Nombre', 'Cédula', 'Teléfono', 'Monto', 'Moneda', 'Referencia', 'Estado', 'Entregado'])
+        self.assertEqual(len(rows), 41)
+        self.assertEqual(rows[1][2:5], ["'=HYPERLINK(\"x\")", 'V-3', '04140000003'])
+        self.assertEqual(rows[1][8:], ['APPROVED', 'No'])
+
+    def test_export_writes_in_chunks_and_is_admin_only(self):
+        chunks = list(payment_csv(cajaPersona.objects.all(), chunk_size=50))
+        self.assertEqual(len(chunks), 4)  # Header, then 50 + 50 + 20 rows
+        resident = APIClient()
+        resident.force_authenticate(UsersCustom.objects.get(username='user1'))
+        self.assertEqual(resident.get('/clap/cajaspersona/export/').status_code, 403)
+
+
+class SeasonRolloverTests(ClearCacheMixin, TestCase):
+    def setUp(self):
+        media = override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+        media.enable()
+        self.addCleanup(media.disable)
+        self.admin = make_user(0, is_staff=True)
+        self.old_caja = caja.objects.create(price=10, stock=5)
+        for n in range(1, 8):
+            payment = cajaPersona.objects.create(cajaid=self.old_caja, user=make_user(n), payment_method='Pago Movil')
+            payment.img.save(f'recibo{n}.jpg', ContentFile(b'jpeg'))
+            Notification.objects.create(user=payment.user, message='Pago recibido')
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def start(self):
+        with mock.patch.object(season, 'run_in_background', season.run), self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/clap/cajas/clear_season_data/', {'price': '15.00', 'stock': 40})
+
+    @mock.patch.object(season, 'BATCH_SIZE', 3)
+    def test_rollover_runs_in_batches_and_reports_progress(self):
+        response = self.start()
+        self.assertEqual(response.status_code, 202)
+
+        job = self.client.get('/clap/cajas/season_rollover/', {'job': response.data['job']['id']}).data
+        self.assertEqual(job['status'], 'DONE')
+        self.assertEqual((job['payments_total'], job['payments_deleted'], job['notifications_deleted']), (7, 7, 7))
+        self.assertEqual(cajaPersona.objects.count(), 0)
+        self.assertEqual(ArchivedPayment.objects.count(), 7)
+        self.assertEqual(list(caja.objects.values_list('id', 'stock')), [(job['new_caja'], 40)])
+        self.assertEqual(default_storage.listdir('caja_images')[1], [])
+        self.assertEqual(BroadcastNotification.objects.count(), 1)
+
+    @mock.patch.object(season, 'BATCH_SIZE', 3)
+    def test_failed_rollover_resumes_where_it_stopped(self):
+        calls = []
+        real_bulk_create = ArchivedPayment.objects.bulk_create
+
+        def flaky_bulk_create(objs):
+            calls.append(objs)
+            if len(calls) == 2:
+                raise OSError('worker lost')
+            return real_bulk_create(objs)
+
+        job = SeasonRollover.objects.create(price=15, stock=40)
+        with mock.patch.object(ArchivedPayment.objects, 'bulk_create', flaky_bulk_create), self.assertRaises(OSError), \
+                self.captureOnCommitCallbacks(execute=True):
+            season.run(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.payments_deleted), ('FAILED', 3))
+        self.assertFalse(caja.objects.get().payments_enabled)
+        # Only the committed batch lost its receipts; the payments left still have theirs
+        left = cajaPersona.objects.all()
+        self.assertEqual(len(left), 4)
+        self.assertTrue(all(default_storage.exists(payment.img.name) for payment in left))
+        self.assertEqual(len(default_storage.listdir('caja_images')[1]), 4)
+
+        call_command('run_season_rollover', stdout=open('/dev/null', 'w'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.payments_deleted), ('DONE', 7))
+        self.assertEqual(cajaPersona.objects.count(), 0)
+        self.assertEqual((SeasonArchive.objects.count(), ArchivedPayment.objects.count()), (1, 7))
+
+    @mock.patch.object(season, 'BATCH_SIZE', 3)
+    def test_receipt_that_cannot_be_deleted_does_not_stop_the_rollover(self):
+        real_delete = default_storage.delete
+
+        def flaky_delete(name):
+            if name.endswith('recibo2.jpg'):
+                raise OSError('disk unavailable')
+            real_delete(name)
+
+        with mock.patch.object(default_storage, 'delete', flaky_delete), self.assertLogs('clap.season', 'ERROR'):
+            self.start()
+        self.assertEqual(SeasonRollover.objects.get().status, 'DONE')
+        self.assertEqual(default_storage.listdir('caja_images')[1], ['recibo2.jpg'])
+
+    def test_payment_arriving_during_the_rollover_is_archived(self):
+        real_delete_notifications = season._delete_notifications
+
+        def admin_registers_a_payment(job):
+            # After the archive batches are done, before the old caja goes
+            cajaPersona.objects.create(cajaid=self.old_caja, user=make_user(99), payment_method='Efectivo', status='APPROVED')
+            real_delete_notifications(job)
+
+        with mock.patch.object(season, '_delete_notifications', admin_registers_a_payment):
+            self.start()
+        job = SeasonRollover.objects.get()
+        self.assertEqual((job.status, job.payments_total, job.payments_deleted), ('DONE', 8, 8))
+        self.assertEqual(ArchivedPayment.objects.filter(season__caja_number=self.old_caja.id).count(), 8)
+        self.assertTrue(ArchivedPayment.objects.filter(user__username='user99', status='APPROVED').exists())
+
+    @mock.patch.object(season, 'BATCH_SIZE', 3)
+    def test_closed_season_stays_queryable(self):
+        first = cajaPersona.objects.order_by('id').first()
+        cajaPersona.objects.filter(pk=first.pk).update(status='APPROVED', amount=10, delivered=True, reference='0001')
+        self.start()
+
+        archive = SeasonArchive.objects.get()
+        self.assertEqual((archive.caja_number, archive.price, archive.stats['payments']), (self.old_caja.id, 10, 7))
+        self.assertEqual(archive.stats['by_status'], {'PENDING': 6, 'APPROVED': 1, 'REJECTED': 0})
+        self.assertEqual(ArchivedPayment.objects.filter(season=archive).count(), 7)
+
+        seasons = self.client.get('/clap/seasons/').data
+        self.assertEqual([season['id'] for season in seasons], [archive.id])
+        with self.assertNumQueries(1):
+            page = self.client.get('/clap/archived-payments/', {'season': archive.id, 'status': 'APPROVED'}).data
+        self.assertEqual([(p['user']['id'], p['reference'], p['delivered']) for p in page['results']], [(first.user_id, '0001', True)])
+
+        resident = APIClient()
+        resident.force_authenticate(first.user)
+        self.assertEqual([p['amount'] for p in resident.get('/clap/archived-payments/').data['results']], ['10.00'])
+        self.assertEqual(resident.get('/clap/seasons/').status_code, 403)
+
+    def test_only_one_rollover_at_a_time(self):
+        job = SeasonRollover.objects.create(price=10, stock=5, status='RUNNING')
+        response = self.start()
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(SeasonRollover.objects.get().status, 'RUNNING')
+        with self.assertRaises(CommandError):
+            call_command('run_season_rollover', job=job.id, stdout=open('/dev/null', 'w'))
+
+    def test_rollover_whose_worker_died_is_taken_over(self):
+        lapsed = timezone.now() - datetime.timedelta(seconds=settings.SEASON_ROLLOVER_LEASE + 1)
+        job = SeasonRollover.objects.create(price=12, stock=30, status='RUNNING', heartbeat=lapsed)
+
+        response = self.start()
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['job']['id'], job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.payments_deleted), ('DONE', 7))
+        self.assertEqual(SeasonRollover.objects.count(), 1)
+        self.assertEqual(list(caja.objects.values_list('price', 'stock')), [(12, 30)])
+
+
+class ReceiptProcessingTests(ClearCacheMixin, TestCase):
+    def setUp(self):
+        media = override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+        media.enable()
+        self.addCleanup(media.disable)
+        self.caja = caja.objects.create(price=10, stock=5)
+        self.client = APIClient()
+        self.client.force_authenticate(make_user(1))
+
+    def photo(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90° clockwise
+        exif[0x010F] = 'PhoneMaker'
+        buffer = BytesIO()
+        Image.new('RGB', (4000, 3000), 'white').save(buffer, 'JPEG', quality=95, exif=exif)
+        return SimpleUploadedFile('recibo.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def test_upload_is_downscaled_rotated_and_stripped(self):
+        response = self.client.post('/clap/cajaspersona/', {
+            'cajaid': self.caja.id, 'payment_method': 'Pago Movil', 'img': self.photo(),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201)
+
+        payment = cajaPersona.objects.get()
+        with Image.open(payment.img.path) as stored:
+            self.assertEqual(stored.size, (1200, 1600))
+            self.assertEqual(len(stored.getexif()), 0)
+        with Image.open(payment.thumbnail.path) as thumbnail:
+            self.assertLessEqual(max(thumbnail.size), 320)
+
+        listed = self.client.get('/clap/cajaspersona/').data[0]
+        self.assertTrue(listed['thumbnail'].endswith(payment.thumbnail.name))
+
+
+class StockReservationTests(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.caja = caja.objects.create(price=10, stock=1)
+        self.client = APIClient()
+
+    def submit(self, user):
+        self.client.force_authenticate(user)
+        return self.client.post('/clap/cajaspersona/', {'cajaid': self.caja.id, 'payment_method': 'Efectivo'})
+
+    def test_payment_takes_exactly_one_unit(self):
+        self.assertEqual(self.submit(make_user(1)).status_code, 201)
+        self.caja.refresh_from_db()
+        self.assertEqual(self.caja.stock, 0)
+
+    def test_sold_out_caja_rejects_without_going_negative(self):
+        self.submit(make_user(1))
+        response = self.submit(make_user(2))
+        self.assertEqual(response.status_code, 400)
+        self.caja.refresh_from_db()
+        self.assertEqual(self.caja.stock, 0)
+        self.assertEqual(cajaPersona.objects.count(), 1)
+
+    def test_disabled_payments_are_refused_even_with_a_stale_cached_caja(self):
+        self.assertTrue(caja.current().payments_enabled)
+        # Another worker's write, whose invalidation this process never saw
+        with mock.patch.object(caching, 'invalidate'):
+            caja.objects.filter(pk=self.caja.pk).update(payments_enabled=False)
+        self.assertTrue(caja.current().payments_enabled)
+
+        response = self.submit(make_user(1))
+        self.assertEqual(response.status_code, 403)
+        self.caja.refresh_from_db()
+        self.assertEqual(self.caja.stock, 1)
+        self.assertFalse(cajaPersona.objects.exists())
+
+    def test_second_active_payment_is_refused_by_the_database(self):
+        self.caja.stock = 5
+        self.caja.save()
+        user = make_user(1)
+        self.assertEqual(self.submit(user).status_code, 201)
+        response = self.submit(user)
+        self.assertEqual(response.data['error'], 'Ya tienes un pago registrado para la caja de esta temporada.')
+        self.caja.refresh_from_db()
+        self.assertEqual(self.caja.stock, 4)
+
+        # A rejected payment does not count, so the resident can pay again
+        cajaPersona.objects.update(status='REJECTED')
+        self.assertEqual(self.submit(user).status_code, 201)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            cajaPersona.objects.create(cajaid=self.caja, user=user, payment_method='Efectivo', status='APPROVED')
+
+
+class PaymentIndexTests(ClearCacheMixin, TestCase):
+    def plan(self, queryset):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')  # Tables this small would be scanned anyway
+                # Without statistics every (cajaid, ...) index costs the same and the planner picks any of them
+                cursor.execute('ANALYZE clap_cajapersona')
+        return queryset.explain()
+
+    def test_access_paths_use_their_index(self):
+        box, user = caja.objects.create(price=10, stock=5), make_user(1)
+        cajaPersona.objects.create(cajaid=box, user=user, payment_method='Pago Movil', reference='0001', bank_name='Banesco')
+        for n, status in enumerate(['APPROVED', 'APPROVED', 'REJECTED'], 2):
+            cajaPersona.objects.create(cajaid=box, user=make_user(n), payment_method='Pago Movil', status=status, delivered=True)
+        payments = cajaPersona.objects.all()
+        self.assertIn('payment_caja_status_idx', self.plan(payments.filter(cajaid=box, status='PENDING')))
+        self.assertIn('payment_caja_delivered_idx', self.plan(payments.filter(cajaid=box, delivered=False)))
+        self.assertIn('payment_user_caja_idx', self.plan(payments.filter(user=user, cajaid=box)))
+        self.assertIn('payment_reference_idx', self.plan(payments.filter(reference='0001', bank_name='Banesco')))
+        # caja.current()'s lookup, with and without a community
+        point = Community.objects.create(name='Norte')
+        self.assertIn('caja_community_date_idx', self.plan(caja.objects.filter(community=point).order_by('-date')[:1]))
+        self.assertIn('caja_community_date_idx', self.plan(caja.objects.filter(community=None).order_by('-date')[:1]))
+
+
+class ConcurrentStockReservationTests(ClearCacheMixin, TransactionTestCase):
+    SUBMISSIONS = 40
+    INITIAL_STOCK = 15
+
+    def submit(self, user):
+        try:
+            client = APIClient()
+            client.force_authenticate(user)
+            return client.post('/clap/cajaspersona/', {'cajaid': self.caja.id, 'payment_method': 'Efectivo'}).status_code
+        finally:
+            connection.close()
+
+    # SQLite locks the whole database for every write, so only Postgres' row locks put the conditional UPDATE to the test
+    @skipUnless(connection.vendor == 'postgresql', 'needs PostgreSQL row locking')
+    def test_parallel_submissions_never_oversell(self):
+        self.caja = caja.objects.create(price=10, stock=self.INITIAL_STOCK)
+        users = [make_user(n) for n in range(1, self.SUBMISSIONS + 1)]
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            codes = list(pool.map(self.submit, users))
+
+        self.caja.refresh_from_db()
+        payments = cajaPersona.objects.filter(cajaid=self.caja).count()
+        self.assertEqual(self.caja.stock + payments, self.INITIAL_STOCK)
+        self.assertEqual(codes.count(201), payments)
+        self.assertGreaterEqual(self.caja.stock, 0)
+
+    def test_parallel_submissions_by_one_resident_create_one_payment(self):
+        self.caja = caja.objects.create(price=10, stock=self.INITIAL_STOCK)
+        user = make_user(1)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            codes = list(pool.map(self.submit, [user] * 8))
+
+        self.assertEqual(sorted(codes), [201] + [400] * 7)
+        self.caja.refresh_from_db()
+        self.assertEqual(self.caja.stock, self.INITIAL_STOCK - 1)
+
+
+class DeliveryScanTests(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.admin = make_user(0, is_staff=True)
+        self.resident = make_user(1)
+        self.caja = caja.objects.create(price=10, stock=5)
+        self.payment = cajaPersona.objects.create(cajaid=self.caja, user=self.resident, payment_method='Efectivo', status='APPROVED')
+        self.client = APIClient()
+
+    def scan(self, token):
+        self.client.force_authenticate(self.admin)
+        return self.client.post('/clap/cajaspersona/scan_delivery/', {'token': token}, format='json')
+
+    def test_resident_gets_a_qr_only_for_their_approved_payment(self):
+        self.client.force_authenticate(self.resident)
+        response = self.client.get(f'/clap/cajaspersona/{self.payment.id}/delivery_qr/')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response.content.startswith(b'\x89PNG'))
+
+        other = cajaPersona.objects.create(cajaid=self.caja, user=make_user(2), payment_method='Efectivo', status='APPROVED')
+        self.assertEqual(self.client.get(f'/clap/cajaspersona/{other.id}/delivery_qr/').status_code, 404)
+        cajaPersona.objects.filter(pk=self.payment.pk).update(status='PENDING')
+        self.assertEqual(self.client.get(f'/clap/cajaspersona/{self.payment.id}/delivery_qr/').status_code, 409)
+
+    def test_scan_confirms_once_and_rejects_replays(self):
+        token = delivery.make_token(self.payment)
+        response = self.scan(token)
+        self.assertEqual((response.status_code, response.data['cedula']), (200, 'V1'))
+        self.assertEqual(self.scan(token).data['error'], 'Esta caja ya fue entregada.')
+
+        self.caja.refresh_from_db()
+        self.assertEqual(self.caja.delivered_count, 1)
+        self.assertEqual(Notification.objects.filter(user=self.resident).count(), 1)
+
+    def test_forged_and_stale_codes_are_refused(self):
+        token = delivery.make_token(self.payment)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.scan(f'{self.payment.id}:{self.payment.delivery_nonce}:firma').status_code, 400)
+            self.assertEqual(self.scan({'id': self.payment.id}).status_code, 400)
+
+        # A new payment reusing the id after a season rollover does not match the old code
+        cajaPersona.objects.filter(pk=self.payment.pk).update(delivery_nonce=delivery.new_nonce())
+        self.assertEqual(self.scan(token).status_code, 404)
+        cajaPersona.objects.filter(pk=self.payment.pk).update(status='REJECTED')
+        self.assertEqual(self.scan(delivery.make_token(cajaPersona.objects.get(pk=self.payment.pk))).status_code, 409)
+
+
+class ConcurrentDeliveryScanTests(ClearCacheMixin, TransactionTestCase):
+    def scan(self, token):
+        try:
+            client = APIClient()
+            client.force_authenticate(self.admin)
+            return client.post('/clap/cajaspersona/scan_delivery/', {'token': token}, format='json').status_code
+        finally:
+            connection.close()
+
+    def test_parallel_scans_of_one_code_confirm_it_once(self):
+        self.admin = make_user(0, is_staff=True)
+        self.caja = caja.objects.create(price=10, stock=5)
+        payment = cajaPersona.objects.create(cajaid=self.caja, user=make_user(1), payment_method='Efectivo', status='APPROVED')
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            codes = list(pool.map(self.scan, [delivery.make_token(payment)] * 16))
+
+        self.assertEqual(sorted(codes), [200] + [409] * 15)
+        self.caja.refresh_from_db()
+        self.assertEqual(self.caja.delivered_count, 1)
+
+
+class ConditionalGetTests(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.resident = make_user(1)
+        self.caja = caja.objects.create(price=10, stock=5)
+        PagoMovilConfig.load()
+        self.client = APIClient()
+        self.client.force_authenticate(self.resident)
+
+    def revalidate(self, path):
+        etag = self.client.get(path)['ETag']
+        return self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_payment_details_are_a_304_without_queries(self):
+        self.client.get('/clap/cajas/payment-details/')
+        etag = self.client.get('/clap/cajas/payment-details/')['ETag']
+        with self.assertNumQueries(0), mock.patch('clap.views.CajaSerializer.to_representation') as serialize:
+            response = self.client.get('/clap/cajas/payment-details/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.content, response['ETag']), (304, b'', etag))
+        serialize.assert_not_called()
+
+        caja.objects.filter(pk=self.caja.pk).reserve_stock()
+        response = self.client.get('/clap/cajas/payment-details/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.data['caja']['stock']), (200, 4))
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_notifications_change_their_etag_when_read_or_added(self):
+        notification = Notification.objects.create(user=self.resident, message='Pago recibido')
+        self.assertEqual(self.revalidate('/clap/notifications/').status_code, 304)
+        etag = self.client.get('/clap/notifications/')['ETag']
+
+        self.client.post(f'/clap/notifications/{notification.id}/mark_as_read/')
+        self.assertEqual(self.client.get('/clap/notifications/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = self.client.get('/clap/notifications/')['ETag']
+        Notification.objects.create(user=self.resident, message='Pago aprobado')
+        self.assertEqual(self.client.get('/clap/notifications/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_lists_and_configs_revalidate(self):
+        self.assertEqual(self.revalidate('/clap/cajas/').status_code, 304)
+        self.assertEqual(self.revalidate(f'/clap/cajas/{self.caja.id}/').status_code, 304)
+        self.client.force_authenticate(make_user(0, is_staff=True))
+        response = self.revalidate('/clap/support-config/')
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+
+class CommunityTests(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.north = Community.objects.create(name='Norte')
+        self.south = Community.objects.create(name='Sur')
+        self.north_caja = caja.objects.create(price=10, stock=5, community=self.north)
+        self.south_caja = caja.objects.create(price=12, stock=1, community=self.south)
+        self.general_caja = caja.objects.create(price=8, stock=3)  # The newest of all
+        self.client = APIClient()
+
+    def login(self, n, community, **extra):
+        # A real login token, so the community comes from its claim
+        user = make_user(n, community=community, **extra)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {CustomTokenObtainPairSerializer.get_token(user).access_token}')
+        return user
+
+    def pay(self):
+        return self.client.post('/clap/cajaspersona/', {'cajaid': self.north_caja.id, 'payment_method': 'Efectivo'})
+
+    def test_residents_see_and_pay_for_their_own_caja(self):
+        self.login(1, self.south)
+        self.assertEqual(self.client.get('/clap/cajas/payment-details/').data['caja']['id'], self.south_caja.id)
+        self.assertEqual([box['id'] for box in self.client.get('/clap/cajas/').data], [self.south_caja.id])
+        response = self.pay()
+        self.assertEqual((response.status_code, response.data['cajaid']), (201, self.south_caja.id))
+
+        self.login(2, self.south)
+        self.assertEqual(self.pay().data['error'], 'No hay stock disponible.')
+        self.login(3, self.north)
+        self.assertEqual(self.pay().data['cajaid'], self.north_caja.id)
+        self.login(4, None)
+        self.assertEqual(self.client.get('/clap/cajas/payment-details/').data['caja']['id'], self.general_caja.id)
+        stocks = dict(caja.objects.values_list('id', 'stock'))
+        self.assertEqual((stocks[self.north_caja.id], stocks[self.south_caja.id], stocks[self.general_caja.id]), (4, 0, 3))
+
+    def test_admins_pick_the_community(self):
+        self.login(0, self.north, is_staff=True)
+        self.assertEqual(self.client.get('/clap/cajas/stats/').data['caja'], self.north_caja.id)
+        self.assertEqual(self.client.get('/clap/cajas/stats/', {'community': self.south.id}).data['caja'], self.south_caja.id)
+        self.assertEqual(self.client.get('/clap/cajas/stats/', {'community': ''}).data['caja'], self.general_caja.id)
+        self.assertEqual(len(self.client.get('/clap/cajas/').data), 3)
+        self.assertEqual([box['id'] for box in self.client.get('/clap/cajas/', {'community': self.south.id}).data], [self.south_caja.id])
+        self.assertEqual(self.client.get('/clap/cajas/', {'community': 'sur'}).status_code, 400)
+
+        resident = make_user(5, community=self.south)
+        response = self.client.post('/clap/cajaspersona/admin_create_payment/', {'user_id': resident.id, 'payment_method': 'Efectivo'})
+        self.assertEqual(response.data['cajaid'], self.south_caja.id)
+
+    def test_communities_are_public_and_kept_while_in_use(self):
+        self.assertEqual([c['name'] for c in APIClient().get('/clap/communities/').data], ['Norte', 'Sur'])
+        self.login(0, None, is_staff=True)
+        self.assertEqual(self.client.delete(f'/clap/communities/{self.north.id}/').status_code, 409)
+        empty = Community.objects.create(name='Este')
+        self.assertEqual(self.client.delete(f'/clap/communities/{empty.id}/').status_code, 204)
+        self.login(1, None)
+        self.assertEqual(self.client.post('/clap/communities/', {'name': 'Oeste'}).status_code, 403)
+
+    def test_price_change_reaches_only_that_communitys_residents(self):
+        north, south, general = make_user(1, community=self.north), make_user(2, community=self.south), make_user(3)
+        BroadcastNotification.objects.create(message='Nueva temporada')
+        self.login(0, None, is_staff=True)
+        self.client.patch(f'/clap/cajas/{self.north_caja.id}/', {'price': '11.00'})
+        self.client.patch(f'/clap/cajas/{self.general_caja.id}/', {'price': '9.00'})
+
+        feeds = {}
+        for user in (north, south, general):
+            self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {CustomTokenObtainPairSerializer.get_token(user).access_token}')
+            feeds[user.username] = sorted(n['message'] for n in self.client.get('/clap/notifications/').data['results'])
+        self.assertEqual(feeds, {
+            north.username: ['El precio de la caja de Norte ha sido actualizado a $11.00.', 'Nueva temporada'],
+            south.username: ['Nueva temporada'],
+            general.username: ['El precio de la caja ha sido actualizado a $9.00.', 'Nueva temporada'],
+        })
+
+    def test_rollover_opens_a_caja_at_every_point(self):
+        job = SeasonRollover.objects.create(price=15, stock=40)
+        season.run(job)
+        self.assertEqual(
+            sorted(caja.objects.values_list('community', 'price', 'stock'), key=lambda row: row[0] or 0),
+            [(None, 15, 40), (self.north.id, 15, 40), (self.south.id, 15, 40)],
+        )
+        self.assertEqual(
+            dict(SeasonArchive.objects.values_list('caja_number', 'community')),
+            {self.north_caja.id: self.north.id, self.south_caja.id: self.south.id, self.general_caja.id: None},
+        )
+
+
+class FastListTests(ClearCacheMixin, TestCase):
+    """The .values() lists and the orjson renderer must send what the serializers and JSONRenderer sent."""
+
+    def setUp(self):
+        self.admin = make_user(0, is_staff=True)
+        self.resident = make_user(1, fullname='José\u2028Pérez')
+        self.caja = caja.objects.create(price=10, stock=5)
+        cajaPersona.objects.create(
+            cajaid=self.caja, user=self.resident, payment_method='Pago Movil', amount='12.50', reference='0001',
+            bank_name='Banco de Venezuela', img='caja_images/recibo.jpg', thumbnail='caja_images/thumbnails/recibo.jpg',
+        )
+        cajaPersona.objects.create(cajaid=self.caja, user=make_user(2), payment_method='Efectivo', status='REJECTED')
+        broadcast = BroadcastNotification.objects.create(message='Aviso')
+        Notification.objects.create(user=self.resident, message='Pago recibido ✓')
+        Notification.objects.create(user=self.resident, message='Aviso', broadcast=broadcast, read=True)
+        self.client = APIClient()
+
+    def expected(self, response, serializer_class, queryset):
+        data = serializer_class(queryset, many=True, context={'request': response.wsgi_request}).data
+        if isinstance(response.data, dict):
+            data = {**response.data, 'results': data}
+        return JSONRenderer().render(data)
+
+    def test_payment_lists_match_the_serializer(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get('/clap/cajaspersona/', {'page_size': 1})
+        self.assertEqual(response.content, self.expected(response, CajaPersonaListSerializer, cajaPersona.objects.order_by('-id')[:1]))
+        response = self.client.get('/clap/cajaspersona/')
+        self.assertEqual(response.content, self.expected(response, CajaPersonaListSerializer, cajaPersona.objects.all()))
+        self.assertIn(b'"img":"http://testserver/media/caja_images/recibo.jpg"', response.content)
+        self.assertIn(b'\\u2028', response.content)
+
+    def test_notification_list_matches_the_serializer(self):
+        self.client.force_authenticate(self.resident)
+        response = self.client.get('/clap/notifications/')
+        expected = self.expected(response, NotificationSerializer, Notification.objects.filter(user=self.resident).order_by('-timestamp', '-id'))
+        self.assertEqual(response.content, expected)
+
+    def test_renderer_matches_json_renderer(self):
+        data = {
+            'when': timezone.now(), 'day': datetime.date(2024, 1, 31), 'amount': Decimal('1.50'),
+            'id': uuid.uuid4(), 'label': gettext_lazy('Hola'), 'text': 'Año\u2029', 'list': (1, None, True),
+            'error': ErrorDetail('Inválido'), 'nested': {'big': 2 ** 70},
+        }
+        for value in (data, {1: 'int keys'}, [data, data]):
+            self.assertEqual(FastJSONRenderer().render(value), JSONRenderer().render(value))
+        self.assertEqual(FastJSONRenderer().render(data, 'application/json; indent=2'), JSONRenderer().render(data, 'application/json; indent=2'))
+
+
+class CachedConfigTests(ClearCacheMixin, TestCase):
+    def test_current_caja_is_cached_until_written(self):
+        first = caja.objects.create(price=10, stock=5)
+        self.assertEqual(caja.current().stock, 5)
+        with self.assertNumQueries(0):
+            caja.current()
+
+        caja.objects.filter(pk=first.pk).reserve_stock()
+        self.assertEqual(caja.current().stock, 4)
+
+        newer = caja.objects.create(price=12, stock=5)
+        self.assertEqual(caja.current().id, newer.id)
+
+    def test_singletons_are_invalidated_on_save_and_delete(self):
+        SupportConfig.load()
+        self.assertEqual(SupportConfig.load().email, 'support@example.com')
+        SupportConfig.objects.filter(id=1).update(email='stale@example.com')
+        self.assertEqual(SupportConfig.load().email, 'support@example.com')
+
+        config = PagoMovilConfig.load()
+        config.banco = 'Banco de Venezuela'
+        config.save()
+        self.assertEqual(PagoMovilConfig.load().banco, 'Banco de Venezuela')
+        config.delete()
+        self.assertEqual(PagoMovilConfig.load().banco, '')
+
+
+class StubDolarApi(BaseHTTPRequestHandler):
+    rate = 36.5
+    hits = 0
+
+    def do_GET(self):
+        type(self).hits += 1
+        if self.rate is None:
+            self.send_response(502)
+            self.end_headers()
+            return
+        body = json.dumps({'promedio': self.rate}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DollarRateServiceTests(ClearCacheMixin, TestCase):
+    def setUp(self):
+        StubDolarApi.rate, StubDolarApi.hits = 36.5, 0
+        self.server = HTTPServer(('127.0.0.1', 0), StubDolarApi)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        url = f'http://127.0.0.1:{self.server.server_port}/v1/dolares/oficial'
+        self.client = DolarApiClient(url=url, timeout=1)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fresh_rate_is_served_from_cache(self):
+        service = DollarRateService(self.client, ttl=60)
+        self.assertEqual(service.get()[0], 36.5)
+        self.assertEqual(service.get()[0], 36.5)
+        self.assertEqual(StubDolarApi.hits, 1)
+
+    def test_stale_rate_is_served_while_refreshing(self):
+        service = DollarRateService(self.client, ttl=0)
+        service.get()
+        StubDolarApi.rate = 40.0
+        self.assertEqual(service.get()[0], 36.5)
+        deadline = time.time() + 2
+        while cache.get(RATE_KEY)['rate'] != 40.0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cache.get(RATE_KEY)['rate'], 40.0)
+        self.assertEqual(StubDolarApi.hits, 2)
+
+    def test_only_one_refresh_runs_at_a_time(self):
+        cache.add(REFRESH_LOCK_KEY, True)
+        self.assertIsNone(DollarRateService(self.client).refresh_in_background())
+
+    def test_upstream_failure_keeps_last_good_rate(self):
+        service = DollarRateService(self.client, ttl=0)
+        service.get()
+        StubDolarApi.rate = None
+        service.refresh_in_background().join(timeout=2)
+        self.assertEqual(service.get()[0], 36.5)
+
+    def test_error_without_any_cached_rate(self):
+        StubDolarApi.rate = None
+        with self.assertRaises(RateUnavailable):
+            DollarRateService(self.client).get()
+
+
+class QueryBudgetTests(ClearCacheMixin, TransactionTestCase):
+    """Runs the API benchmark on a small dataset; query counts must not depend on its size."""
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_every_endpoint_stays_within_its_query_budget(self):
+        report = benchmarks.run(users=80, notifications_per_user=2, iterations=2)
+        self.assertEqual(report['violations'], [])
+
+
+@override_settings(METRICS_ENABLED=True, METRICS_SLOW_REQUEST_MS=10 ** 6)
+class RequestMetricsTests(ClearCacheMixin, TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+        self.user = make_user(1)
+        caja.objects.create(price=10, stock=5)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_records_latency_queries_and_size_per_view(self):
+        self.client.get('/clap/cajas/')
+        self.client.get('/clap/cajas/')
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('clap_http_requests_total{view="caja-list",method="GET",status="200"} 2', body)
+        self.assertIn('clap_http_request_duration_seconds_count{view="caja-list",method="GET"} 2', body)
+        self.assertIn('clap_http_db_queries_bucket{view="caja-list",method="GET",le="+Inf"} 2', body)
+        self.assertIn('clap_http_response_size_bytes_count{view="caja-list",method="GET"} 2', body)
+        self.assertIn('clap_http_db_duration_seconds_total{view="caja-list",method="GET"}', body)
+
+    def test_unknown_paths_share_one_series(self):
+        self.client.get('/clap/nope/1/')
+        self.client.get('/clap/nope/2/')
+        self.assertIn('view="unmatched",method="GET",status="404"} 2', self.client.get('/metrics').content.decode())
+
+    def test_slow_requests_are_logged_with_their_queries(self):
+        with override_settings(METRICS_SLOW_REQUEST_MS=0), self.assertLogs('clap.metrics', 'WARNING') as logs:
+            APIClient().get('/clap/cajas/', HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.assertIn('caja-list', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    @override_settings(METRICS_TOKEN='secreto')
+    def test_token_protects_the_endpoint(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secreto').status_code, 200)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled_middleware_unloads_itself(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        client.get('/clap/cajas/')
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        self.assertEqual(metrics.registry.render().count('caja-list'), 0)
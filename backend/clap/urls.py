@@ -3,14 +3,18 @@ from rest_framework.routers import DefaultRouter
 from . import views
 
 router = DefaultRouter()
+router.register(r'communities', views.CommunityViewSet, basename='community')
 router.register(r'cajas', views.CajaViewSet, basename='caja')
 router.register(r'cajaspersona', views.CajaPersonaViewSet, basename='cajapersona')
 router.register(r'notifications', views.NotificationViewSet, basename='notification')
 router.register(r'pago-movil-config', views.PagoMovilConfigViewSet, basename='pagomovilconfig')
 router.register(r'support-config', views.SupportConfigViewSet, basename='supportconfig')
+router.register(r'seasons', views.SeasonArchiveViewSet, basename='seasonarchive')
+router.register(r'archived-payments', views.ArchivedPaymentViewSet, basename='archivedpayment')
 
 urlpatterns = [
     path('cajas/payment-details/', views.CajaViewSet.as_view({'get': 'payment_details'}), name='caja-payment-details'),
     path('dollar-rate/', views.get_dollar_rate, name='dollar-rate'),
+    path('notifications/stream/', views.notification_stream, name='notification-stream'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
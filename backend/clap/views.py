@@ -1,16 +1,33 @@
-import os
-import requests
+import asyncio
+import json
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import JsonResponse
+from django.db import IntegrityError, transaction
+from django.db.models import ProtectedError
+from django.db.models import Count, F, Max, Q
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
+from collections import Counter
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, IsAdminUser
-from .models import caja, cajaPersona, Notification, PagoMovilConfig, SupportConfig
-from .serializers import CajaSerializer, CajaPersonaSerializer, NotificationSerializer, PagoMovilConfigSerializer, SupportConfigSerializer
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken
+from .models import Community, caja, cajaPersona, Notification, BroadcastNotification, PagoMovilConfig, SupportConfig, SeasonRollover, SeasonArchive, ArchivedPayment
+from .pagination import ArchiveCursorPagination, NotificationCursorPagination, PaymentCursorPagination
+from .serializers import CommunitySerializer, CajaSerializer, CajaPersonaSerializer, CajaPersonaListSerializer, NotificationSerializer, PagoMovilConfigSerializer, SupportConfigSerializer, SeasonRolloverSerializer, SeasonArchiveSerializer, ArchivedPaymentSerializer
 from users.models import UsersCustom
+from users.authentication import ClaimsJWTAuthentication
 from rest_framework import serializers
+from . import caching, conditional, delivery, metrics as request_metrics, season
+from .fastlist import ValuesListMixin
+from .events import get_broker
+from .signals import push_notifications
+from .exports import payment_csv
+from .dollar_rate import RateUnavailable, get_service as get_dollar_rate_service
 
 # Create your views here.
 
@@ -18,10 +35,28 @@ class PaymentDetailsSerializer(serializers.Serializer):
     caja = CajaSerializer()
     pago_movil_config = PagoMovilConfigSerializer()
 
+def requested_community(request):
+    """
+    The id of the community whose caja a request works with. Residents always get
+    their own; admins may pick one with ?community= (empty for the cajas without one).
+    """
+    if request.user.is_staff and 'community' in request.query_params:
+        value = request.query_params['community']
+        if value and not value.isdigit():
+            raise serializers.ValidationError({'community': 'Debe ser un número.'})
+        return int(value) if value else None
+    return request.user.community_id
+
 class CajaViewSet(viewsets.ModelViewSet):
-    queryset = caja.objects.all()
     serializer_class = CajaSerializer
 
+    def get_queryset(self):
+        queryset = caja.objects.order_by('-date')
+        # Residents only see their own distribution point's cajas, newest first
+        if not self.request.user.is_staff or 'community' in self.request.query_params:
+            return queryset.filter(community_id=requested_community(self.request))
+        return queryset
+
     def get_permissions(self):
         if self.action == 'list' or self.action == 'retrieve' or self.action == 'payment_details':
             permission_classes = [IsAuthenticated]
@@ -29,6 +64,14 @@ class CajaViewSet(viewsets.ModelViewSet):
             permission_classes = [IsAdminUser]
         return [permission() for permission in permission_classes]
 
+    def list(self, request, *args, **kwargs):
+        cajas = list(self.filter_queryset(self.get_queryset()))
+        return conditional.respond(request, conditional.fingerprint(*cajas), lambda: Response(self.get_serializer(cajas, many=True).data))
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        return conditional.respond(request, conditional.fingerprint(instance), lambda: Response(self.get_serializer(instance).data))
+
     def update(self, request, *args, **kwargs):
         instance = self.get_object()
         old_price = instance.price
@@ -37,21 +80,18 @@ class CajaViewSet(viewsets.ModelViewSet):
         new_price = instance.price
 
         if old_price != new_price:
-            users = UsersCustom.objects.filter(is_staff=False) # Notify only non-admin users
-            for user in users:
-                Notification.objects.create(
-                    user=user,
-                    message=f"El precio de la caja ha sido actualizado a ${new_price}."
-                )
+            # One row for the caja's residents; they receive it when they load their notifications
+            where = f" de {instance.community.name}" if instance.community_id else ""
+            BroadcastNotification.objects.create(
+                message=f"El precio de la caja{where} ha sido actualizado a ${new_price}.",
+                scoped=True, community_id=instance.community_id,
+            )
         return response
 
     @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
     def payment_details(self, request):
-        main_caja = caja.objects.order_by('-date').first()
-        pago_movil_config, created = PagoMovilConfig.objects.get_or_create(
-            id=1,
-            defaults={'cedula': '', 'telefono': '', 'banco': ''}
-        )
+        main_caja = caja.current(requested_community(request))
+        pago_movil_config = PagoMovilConfig.load()
 
         if not main_caja:
             return Response(
@@ -59,104 +99,172 @@ class CajaViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        caja_serializer = CajaSerializer(main_caja)
-        pago_movil_serializer = PagoMovilConfigSerializer(pago_movil_config)
+        def build():
+            caja_serializer = CajaSerializer(main_caja)
+            pago_movil_serializer = PagoMovilConfigSerializer(pago_movil_config)
 
-        response_data = {
-            'caja': caja_serializer.data,
-            'pago_movil_config': pago_movil_serializer.data
-        }
-        return Response(response_data)
+            response_data = {
+                'caja': caja_serializer.data,
+                'pago_movil_config': pago_movil_serializer.data
+            }
+            return Response(response_data)
+
+        # Both come from the cache, so an unchanged page costs no query at all
+        return conditional.respond(request, conditional.fingerprint(main_caja, pago_movil_config), build)
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def stats(self, request):
+        """
+        Season totals of a community's caja (the admin's own, or ?community=) for the
+        admin dashboard; the payment aggregates are cached until a payment changes.
+        """
+        main_caja = caja.current(requested_community(request))
+        if not main_caja:
+            return Response(
+                {"error": "No hay una caja principal disponible."},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        stats = caching.get_or_load(caching.PAYMENT_STATS, main_caja.payment_stats, scope=main_caja.pk)
+        return Response({**stats, 'community': main_caja.community_id, 'price': str(main_caja.price), 'stock': main_caja.stock})
 
     @action(detail=False, methods=['post'], permission_classes=[IsAdminUser])
     def clear_season_data(self, request):
         """
-        Deletes all payments, associated images, and boxes to start a new season.
-        Creates a new box with a specified price and stock.
+        Starts moving all payments to the season archive and deleting their images,
+        the notifications and the boxes, to start a new season. A new box with the
+        specified price and stock is created once the old data is gone.
+        Progress is reported by season_rollover.
         """
-        try:
-            # Data from request
-            new_price = request.data.get('price')
-            new_stock = request.data.get('stock')
+        new_price = request.data.get('price')
+        new_stock = request.data.get('stock')
+
+        if new_price is None or new_stock is None:
+            return Response(
+                {"error": "Price and stock for the new season are required."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        serializer = SeasonRolloverSerializer(data={'price': new_price, 'stock': new_stock})
+        serializer.is_valid(raise_exception=True)
 
-            if new_price is None or new_stock is None:
+        with transaction.atomic():
+            active = SeasonRollover.objects.select_for_update().exclude(status__in=['DONE', 'FAILED']).first()
+            if active:
+                if not season.lease_expired(active):
+                    return Response(
+                        {"error": "A season rollover is already in progress."},
+                        status=status.HTTP_409_CONFLICT
+                    )
+                # Its worker died (restart, recycled gunicorn worker); finish that one rather than start another
+                transaction.on_commit(lambda: season.run_in_background(active))
                 return Response(
-                    {"error": "Price and stock for the new season are required."},
-                    status=status.HTTP_400_BAD_REQUEST
+                    {"error": "A season rollover had stopped and has been resumed.", "job": SeasonRolloverSerializer(active).data},
+                    status=status.HTTP_409_CONFLICT
                 )
+            job = serializer.save()
+            transaction.on_commit(lambda: season.run_in_background(job))
 
-            # Delete payment images
-            payments = cajaPersona.objects.all()
-            for payment in payments:
-                if payment.img:
-                    image_path = os.path.join(settings.MEDIA_ROOT, str(payment.img))
-                    if os.path.exists(image_path):
-                        os.remove(image_path)
+        return Response(
+            {"status": "Season rollover started.", "job": SeasonRolloverSerializer(job).data},
+            status=status.HTTP_202_ACCEPTED
+        )
 
-            # Delete all payments
-            payments.delete()
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def season_rollover(self, request):
+        jobs = SeasonRollover.objects.order_by('-created')
+        if 'job' in request.query_params:
+            jobs = jobs.filter(pk=request.query_params['job'])
+        job = jobs.first()
+        if not job:
+            return Response({"error": "Season rollover not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(SeasonRolloverSerializer(job).data)
 
-            # Delete all existing boxes
-            caja.objects.all().delete()
+class OutOfStock(Exception):
+    pass
 
-            # Delete all notifications
-            Notification.objects.all().delete()
+class PaymentsDisabled(Exception):
+    pass
 
-            # Create a new box for the new season
-            new_caja = caja.objects.create(
-                price=new_price,
-                stock=new_stock,
-                payments_enabled=True
-            )
+class DuplicatePayment(Exception):
+    pass
 
-            # Notify all non-admin users
-            users = UsersCustom.objects.filter(is_staff=False)
-            for user in users:
-                Notification.objects.create(
-                    user=user,
-                    message="¡Nueva temporada de cajas disponible! Ya puedes realizar tu pago."
-                )
+APPROVED_MESSAGE = "Tu pago ha sido aprobado, Retira tu caja"
+DELIVERED_MESSAGE = "La entrega de tu caja ha sido confirmada."
+BULK_LIMIT = 1000
 
-            return Response(
-                {"status": "Season data cleared and new season started.", "new_box_id": new_caja.id},
-                status=status.HTTP_200_OK
-            )
-        except Exception as e:
-            return Response(
-                {"error": f"An error occurred: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+def rejected_message():
+    support_config = SupportConfig.load()
+    return f"Tu pago ha sido rechazado. Si crees que esto es un error, por favor contacta a soporte: {support_config.email} o {support_config.phone_number}"
 
-class CajaPersonaViewSet(viewsets.ModelViewSet):
+class CajaPersonaViewSet(ValuesListMixin, viewsets.ModelViewSet):
     serializer_class = CajaPersonaSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = PaymentCursorPagination
+    filter_fields = ('status', 'payment_method', 'moneda')
+
+    def save_with_reservation(self, serializer, main_caja, enabled_only=False, **kwargs):
+        """
+        Saves the payment and takes its unit of stock in one transaction.
+        The caja row is locked last, so concurrent submissions only wait on each other for the commit.
+        Raises OutOfStock when the caja sold out in the meantime, PaymentsDisabled (with enabled_only)
+        when its payments were disabled, and DuplicatePayment when the user already has a pending or
+        approved payment for it (one_active_payment_per_caja).
+        """
+        # Built here rather than by serializer.save(), so the receipt files it wrote can be removed on failure
+        instance = cajaPersona(**{**serializer.validated_data, 'cajaid': main_caja, **kwargs})
+        try:
+            with transaction.atomic():
+                instance.save()
+                if not caja.objects.filter(pk=main_caja.pk).reserve_stock(enabled_only):
+                    # The cached caja may predate the change, so the database has the last word
+                    if enabled_only and not caja.objects.filter(pk=main_caja.pk, payments_enabled=True).exists():
+                        raise PaymentsDisabled
+                    raise OutOfStock
+                if instance.status == 'APPROVED':
+                    caja.objects.filter(pk=main_caja.pk).update(sold=F('sold') + 1)
+        except (OutOfStock, PaymentsDisabled, IntegrityError) as e:
+            for field in (instance.img, instance.thumbnail):
+                if field:
+                    field.delete(save=False)
+            if isinstance(e, IntegrityError):
+                active = cajaPersona.objects.filter(user=instance.user, cajaid=main_caja, status__in=['PENDING', 'APPROVED'])
+                if active.exists():
+                    raise DuplicatePayment from e
+            raise
+        serializer.instance = instance
+        return instance
 
     def get_queryset(self):
-        if self.request.user.is_staff:
-            return cajaPersona.objects.all()
-        return cajaPersona.objects.filter(user=self.request.user)
+        queryset = cajaPersona.objects.select_related('user', 'cajaid')
+        if not self.request.user.is_staff:
+            return queryset.filter(user=self.request.user)
+        return queryset
+
+    def filter_queryset(self, queryset):
+        params = self.request.query_params
+        filters = {field: params[field] for field in self.filter_fields if field in params}
+        if 'caja' in params:
+            if not params['caja'].isdigit():
+                raise serializers.ValidationError({'caja': 'Debe ser un número.'})
+            filters['cajaid'] = params['caja']
+        if 'delivered' in params:
+            filters['delivered'] = params['delivered'].lower() in ('true', '1')
+        return queryset.filter(**filters)
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return CajaPersonaListSerializer
+        return super().get_serializer_class()
 
     def create(self, request, *args, **kwargs):
-        main_caja = caja.objects.order_by('-date').first()
+        # The caja of the resident's distribution point; each point takes stock from its own row
+        main_caja = caja.current(request.user.community_id)
         if not main_caja:
             return Response(
                 {"error": "No hay una caja principal disponible."},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Check if the user already has a pending or approved payment for this season's box
-        existing_payment = cajaPersona.objects.filter(
-            user=request.user,
-            cajaid=main_caja,
-            status__in=['PENDING', 'APPROVED']
-        ).exists()
-
-        if existing_payment:
-            return Response(
-                {"error": "Ya tienes un pago registrado para la caja de esta temporada."},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
         # Check if payments are enabled
         if not main_caja.payments_enabled:
             return Response(
@@ -175,46 +283,228 @@ class CajaPersonaViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        # Decrement the stock
-        main_caja.stock -= 1
-        main_caja.save()
-
-        # Save the CajaPersona instance
-        serializer.save(user=request.user, cajaid=main_caja)
+        # Save the CajaPersona instance and decrement the stock; the database rejects a second
+        # pending or approved payment for this season's box
+        try:
+            self.save_with_reservation(serializer, main_caja, enabled_only=True, user=request.user)
+        except DuplicatePayment:
+            return Response(
+                {"error": "Ya tienes un pago registrado para la caja de esta temporada."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except PaymentsDisabled:
+            return Response(
+                {"error": "Los pagos se encuentran deshabilitados en este momento."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        except OutOfStock:
+            return Response(
+                {"error": "No hay stock disponible."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
+    def perform_update(self, serializer):
+        # An admin may move the payment to another caja, whose counters change too
+        old_caja = serializer.instance.cajaid_id
+        super().perform_update(serializer)
+        caja.objects.filter(pk__in={old_caja, serializer.instance.cajaid_id}).rebuild_counters()
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        caja.objects.filter(pk=instance.cajaid_id).rebuild_counters()
+
     @action(detail=True, methods=['post'], permission_classes=[IsAdminUser])
     def approve_payment(self, request, pk=None):
         caja_persona = self.get_object()
-        caja_persona.status = 'APPROVED'
-        caja_persona.save()
-        Notification.objects.create(user=caja_persona.user, message="Tu pago ha sido aprobado, Retira tu caja")
+        try:
+            with transaction.atomic():
+                # Only the request that actually flips the status moves the counter
+                if cajaPersona.objects.filter(pk=caja_persona.pk).exclude(status='APPROVED').update(status='APPROVED'):
+                    caja.objects.filter(pk=caja_persona.cajaid_id).update(sold=F('sold') + 1)
+                Notification.objects.create(user=caja_persona.user, message=APPROVED_MESSAGE)
+        except IntegrityError:
+            # A rejected payment whose owner has since sent another one (one_active_payment_per_caja)
+            return Response(
+                {"error": "El usuario ya tiene otro pago registrado para la caja de esta temporada."},
+                status=status.HTTP_409_CONFLICT
+            )
         return Response({'status': 'Payment approved'})
 
     @action(detail=True, methods=['post'], permission_classes=[IsAdminUser])
     def reject_payment(self, request, pk=None):
         caja_persona = self.get_object()
-        caja_persona.status = 'REJECTED'
-        caja_persona.save()
-
-        support_config, created = SupportConfig.objects.get_or_create(id=1)
-        support_email = support_config.email
-        support_phone = support_config.phone_number
-
-        message = f"Tu pago ha sido rechazado. Si crees que esto es un error, por favor contacta a soporte: {support_email} o {support_phone}"
-        Notification.objects.create(user=caja_persona.user, message=message)
+        with transaction.atomic():
+            if cajaPersona.objects.filter(pk=caja_persona.pk, status='APPROVED').update(status='REJECTED'):
+                caja.objects.filter(pk=caja_persona.cajaid_id).update(sold=F('sold') - 1)
+            else:
+                cajaPersona.objects.filter(pk=caja_persona.pk).update(status='REJECTED')
+            Notification.objects.create(user=caja_persona.user, message=rejected_message())
 
         return Response({'status': 'Payment rejected'})
 
     @action(detail=True, methods=['post'], permission_classes=[IsAdminUser])
     def confirm_delivery(self, request, pk=None):
         caja_persona = self.get_object()
-        caja_persona.delivered = True
-        caja_persona.save()
-        Notification.objects.create(user=caja_persona.user, message="La entrega de tu caja ha sido confirmada.")
-        return Response({'status': 'Delivery confirmed'})
+        with transaction.atomic():
+            # Same rule as bulk_confirm_delivery and scan_delivery: only an approved, undelivered payment flips
+            confirmed = cajaPersona.objects.filter(pk=caja_persona.pk, status='APPROVED', delivered=False).update(delivered=True)
+            if confirmed:
+                caja.objects.filter(pk=caja_persona.cajaid_id).update(delivered_count=F('delivered_count') + 1)
+                Notification.objects.create(user=caja_persona.user, message=DELIVERED_MESSAGE)
+        if confirmed:
+            return Response({'status': 'Delivery confirmed'})
+        caja_persona.refresh_from_db(fields=['status'])
+        if caja_persona.status != 'APPROVED':
+            return Response({"error": "Este pago no está aprobado."}, status=status.HTTP_409_CONFLICT)
+        return Response({"error": "Esta caja ya fue entregada."}, status=status.HTTP_409_CONFLICT)
+
+    @action(detail=True, methods=['get'])
+    def delivery_qr(self, request, pk=None):
+        """PNG QR code the resident shows at the distribution point to collect their caja."""
+        caja_persona = self.get_object()
+        if caja_persona.status != 'APPROVED' or caja_persona.delivered:
+            return Response(
+                {"error": "Solo los pagos aprobados y no entregados tienen código de entrega."},
+                status=status.HTTP_409_CONFLICT
+            )
+        response = HttpResponse(delivery.qr_png(delivery.make_token(caja_persona)), content_type='image/png')
+        response['Cache-Control'] = 'private, no-store'  # The code is as good as the caja itself
+        return response
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminUser])
+    def scan_delivery(self, request):
+        """Confirms the delivery of the payment a scanned QR code belongs to; each code works once."""
+        token = request.data.get('token')
+        try:
+            pk, nonce = delivery.read_token(token if isinstance(token, str) else '')
+        except delivery.InvalidToken:
+            return Response({"error": "Código de entrega inválido."}, status=status.HTTP_400_BAD_REQUEST)
+
+        payment = cajaPersona.objects.filter(pk=pk, delivery_nonce=nonce)
+        with transaction.atomic():
+            # The UPDATE decides: of several scanners reading the same code, only one flips the row
+            confirmed = payment.filter(status='APPROVED', delivered=False).update(delivered=True)
+            row = payment.values('id', 'cajaid_id', 'user_id', 'status', 'user__fullname', 'user__cedula').first()
+            if row is None:
+                return Response({"error": "El pago de este código ya no existe."}, status=status.HTTP_404_NOT_FOUND)
+            if confirmed:
+                caja.objects.filter(pk=row['cajaid_id']).update(delivered_count=F('delivered_count') + 1)
+                Notification.objects.create(user_id=row['user_id'], message=DELIVERED_MESSAGE)
+
+        resident = {'payment': row['id'], 'fullname': row['user__fullname'], 'cedula': row['user__cedula']}
+        if confirmed:
+            return Response({'status': 'Delivery confirmed', **resident})
+        if row['status'] != 'APPROVED':
+            return Response({"error": "Este pago no está aprobado.", **resident}, status=status.HTTP_409_CONFLICT)
+        return Response({"error": "Esta caja ya fue entregada.", **resident}, status=status.HTTP_409_CONFLICT)
+
+    def _bulk_ids(self, request):
+        ids = request.data.get('ids')
+        if not isinstance(ids, list) or not ids or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise serializers.ValidationError({'ids': 'Debe ser una lista de ids de pagos.'})
+        if len(ids) > BULK_LIMIT:
+            raise serializers.ValidationError({'ids': f'Máximo {BULK_LIMIT} pagos por solicitud.'})
+        return list(dict.fromkeys(ids))
+
+    def _bulk_update(self, ids, eligible, changes, message, conflicts=None):
+        """
+        Locks the payments, applies `changes` with one UPDATE to those for which
+        eligible(row) holds and bulk-inserts their owners' notifications.
+        conflicts(rows), given the eligible rows, returns the ids the update must leave out.
+        Must run inside the caller's transaction. Returns (per-id results, updated rows).
+        """
+        found = {
+            row['id']: row
+            for row in cajaPersona.objects.select_for_update().filter(pk__in=ids).values('id', 'user_id', 'cajaid_id', 'status', 'delivered')
+        }
+        updated = [found[i] for i in ids if i in found and eligible(found[i])]
+        conflicting = conflicts(updated) if conflicts else set()
+        updated = [row for row in updated if row['id'] not in conflicting]
+        cajaPersona.objects.filter(pk__in=[row['id'] for row in updated]).update(**changes)
+        push_notifications(Notification.objects.bulk_create([Notification(user_id=row['user_id'], message=message) for row in updated]))
+
+        updated_ids = {row['id'] for row in updated}
+        results = [
+            {
+                'id': i,
+                'result': 'updated' if i in updated_ids else 'conflict' if i in conflicting else 'skipped' if i in found else 'not_found',
+            }
+            for i in ids
+        ]
+        return results, updated
+
+    def _approval_conflicts(self, rows):
+        """
+        Ids of the rejected payments whose approval would give their owner a second
+        pending or approved payment for the caja (one_active_payment_per_caja),
+        counting the ones approved earlier in the same batch.
+        """
+        revived = [row for row in rows if row['status'] == 'REJECTED']
+        if not revived:
+            return set()
+        active = set(cajaPersona.objects.filter(
+            user_id__in={row['user_id'] for row in revived},
+            cajaid_id__in={row['cajaid_id'] for row in revived},
+            status__in=['PENDING', 'APPROVED'],
+        ).values_list('user_id', 'cajaid_id'))
+        conflicting = set()
+        for row in revived:
+            key = (row['user_id'], row['cajaid_id'])
+            if key in active:
+                conflicting.add(row['id'])
+            else:
+                active.add(key)
+        return conflicting
+
+    def _move_counter(self, rows, field, delta):
+        for caja_id, count in Counter(row['cajaid_id'] for row in rows).items():
+            caja.objects.filter(pk=caja_id).update(**{field: F(field) + delta * count})
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminUser])
+    def bulk_approve(self, request):
+        ids = self._bulk_ids(request)
+        try:
+            with transaction.atomic():
+                results, updated = self._bulk_update(
+                    ids, lambda row: row['status'] != 'APPROVED', {'status': 'APPROVED'}, APPROVED_MESSAGE, self._approval_conflicts,
+                )
+                self._move_counter(updated, 'sold', 1)
+        except IntegrityError:
+            # A payment sent while the batch ran; nothing was applied, so the batch can simply be retried
+            return Response(
+                {"error": "Otro pago cambió mientras se aprobaba el lote. Inténtalo de nuevo."},
+                status=status.HTTP_409_CONFLICT
+            )
+        return Response({'results': results})
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminUser])
+    def bulk_reject(self, request):
+        ids = self._bulk_ids(request)
+        with transaction.atomic():
+            results, updated = self._bulk_update(ids, lambda row: row['status'] != 'REJECTED', {'status': 'REJECTED'}, rejected_message())
+            self._move_counter([row for row in updated if row['status'] == 'APPROVED'], 'sold', -1)
+        return Response({'results': results})
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminUser])
+    def bulk_confirm_delivery(self, request):
+        ids = self._bulk_ids(request)
+        with transaction.atomic():
+            results, updated = self._bulk_update(
+                ids, lambda row: row['status'] == 'APPROVED' and not row['delivered'], {'delivered': True}, DELIVERED_MESSAGE,
+            )
+            self._move_counter(updated, 'delivered_count', 1)
+        return Response({'results': results})
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def export(self, request):
+        """CSV of the payments, with the same filters as the list."""
+        queryset = self.filter_queryset(self.get_queryset())
+        response = StreamingHttpResponse(payment_csv(queryset), content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="pagos.csv"'
+        return response
 
     @action(detail=False, methods=['post'], permission_classes=[IsAdminUser])
     def admin_create_payment(self, request):
@@ -232,25 +522,13 @@ class CajaPersonaViewSet(viewsets.ModelViewSet):
         except UsersCustom.DoesNotExist:
             return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        main_caja = caja.objects.order_by('-date').first()
+        main_caja = caja.current(user.community_id)
         if not main_caja:
             return Response(
                 {"error": "No hay una caja principal disponible."},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        existing_payment = cajaPersona.objects.filter(
-            user=user,
-            cajaid=main_caja,
-            status__in=['PENDING', 'APPROVED']
-        ).exists()
-
-        if existing_payment:
-            return Response(
-                {"error": "El usuario ya tiene un pago registrado para la caja de esta temporada."},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
         if main_caja.stock <= 0:
             return Response(
                 {"error": "No hay stock disponible."},
@@ -269,39 +547,71 @@ class CajaPersonaViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(data=payment_data)
         serializer.is_valid(raise_exception=True)
 
-        main_caja.stock -= 1
-        main_caja.save()
-
-        serializer.save(user=user, cajaid=main_caja)
+        # status is read-only on the serializer, so it has to be set here
+        try:
+            self.save_with_reservation(serializer, main_caja, user=user, status='APPROVED')
+        except DuplicatePayment:
+            return Response(
+                {"error": "El usuario ya tiene un pago registrado para la caja de esta temporada."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except OutOfStock:
+            return Response(
+                {"error": "No hay stock disponible."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
         Notification.objects.create(user=user, message=f"Un administrador ha registrado un pago de '{payment_method}' para tu caja.")
 
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
+class NotificationViewSet(ValuesListMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = NotificationSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = NotificationCursorPagination
 
     def get_queryset(self):
         return Notification.objects.filter(user=self.request.user).order_by('-timestamp')
 
+    def list(self, request, *args, **kwargs):
+        BroadcastNotification.deliver_pending(request.user)
+        # New rows raise the newest id, deletions lower the count and marking as read lowers the unread count
+        state = self.get_queryset().aggregate(latest=Max('id'), total=Count('id'), unread=Count('id', filter=Q(read=False)))
+        validator = f"{request.user.pk}-{state['latest']}-{state['total']}-{state['unread']}"
+        return conditional.respond(request, validator, lambda: super(NotificationViewSet, self).list(request, *args, **kwargs))
+
+    @action(detail=False, methods=['get'])
+    def unread_count(self, request):
+        BroadcastNotification.deliver_pending(request.user)
+        return Response({'unread': self.get_queryset().filter(read=False).count()})
+
     @action(detail=True, methods=['post'])
     def mark_as_read(self, request, pk=None):
-        notification = self.get_object()
-        notification.read = True
-        notification.save()
+        # The router accepts any pk; a non-numeric one is as missing as an unknown one
+        if not pk.isdigit() or not self.get_queryset().filter(pk=pk).update(read=True):
+            return Response({'error': 'Notification not found.'}, status=status.HTTP_404_NOT_FOUND)
         return Response({'status': 'Notification marked as read'})
 
+    @action(detail=False, methods=['post'])
+    def mark_read(self, request):
+        ids = request.data.get('ids')
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return Response({"error": "A list of notification ids is required."}, status=status.HTTP_400_BAD_REQUEST)
+        updated = self.get_queryset().filter(id__in=ids, read=False).update(read=True)
+        return Response({'status': 'Notifications marked as read', 'updated': updated})
+
+    @action(detail=False, methods=['post'])
+    def mark_all_read(self, request):
+        updated = self.get_queryset().filter(read=False).update(read=True)
+        return Response({'status': 'Notifications marked as read', 'updated': updated})
+
 class PagoMovilConfigViewSet(viewsets.ModelViewSet):
     queryset = PagoMovilConfig.objects.all()
     serializer_class = PagoMovilConfigSerializer
     permission_classes = [IsAdminUser]
 
     def list(self, request, *args, **kwargs):
-        config, created = PagoMovilConfig.objects.get_or_create(
-            id=1,
-            defaults={'cedula': '', 'telefono': '', 'banco': ''}
-        )
+        config = PagoMovilConfig.load()
         serializer = self.get_serializer(config)
         return Response(serializer.data)
 
@@ -336,12 +646,8 @@ class SupportConfigViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAdminUser]
 
     def list(self, request, *args, **kwargs):
-        config, created = SupportConfig.objects.get_or_create(
-            id=1,
-            defaults={'email': 'support@example.com', 'phone_number': '1234567890'}
-        )
-        serializer = self.get_serializer(config)
-        return Response(serializer.data)
+        config = SupportConfig.load()
+        return conditional.respond(request, conditional.fingerprint(config), lambda: Response(self.get_serializer(config).data))
 
     def retrieve(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
@@ -356,11 +662,112 @@ class SupportConfigViewSet(viewsets.ModelViewSet):
         self.perform_update(serializer)
         return Response(serializer.data)
 
+class CommunityViewSet(viewsets.ModelViewSet):
+    """Distribution points. Anyone may list them, so residents can pick theirs when registering."""
+    queryset = Community.objects.order_by('name')
+    serializer_class = CommunitySerializer
+
+    def get_permissions(self):
+        if self.action == 'list' or self.action == 'retrieve':
+            return [AllowAny()]
+        return [IsAdminUser()]
+
+    def destroy(self, request, *args, **kwargs):
+        try:
+            return super().destroy(request, *args, **kwargs)
+        except ProtectedError:
+            return Response(
+                {"error": "La comunidad todavía tiene cajas o residentes asignados."},
+                status=status.HTTP_409_CONFLICT
+            )
+
+class SeasonArchiveViewSet(viewsets.ReadOnlyModelViewSet):
+    """Closed seasons and their totals, newest first."""
+    queryset = SeasonArchive.objects.order_by('-id')
+    serializer_class = SeasonArchiveSerializer
+    permission_classes = [IsAdminUser]
+
+class ArchivedPaymentViewSet(viewsets.ReadOnlyModelViewSet):
+    """Payments of closed seasons: a resident's own, or everyone's for admins."""
+    serializer_class = ArchivedPaymentSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = ArchiveCursorPagination
+    filter_fields = ('status',)
+
+    def get_queryset(self):
+        queryset = ArchivedPayment.objects.select_related('user', 'season')
+        if not self.request.user.is_staff:
+            return queryset.filter(user=self.request.user)
+        return queryset
+
+    def filter_queryset(self, queryset):
+        params = self.request.query_params
+        filters = {field: params[field] for field in self.filter_fields if field in params}
+        for param in ('season', 'user'):
+            if param in params:
+                if not params[param].isdigit():
+                    raise serializers.ValidationError({param: 'Debe ser un número.'})
+                filters[param] = params[param]
+        return queryset.filter(**filters)
+
 def get_dollar_rate(request):
     try:
-        response = requests.get('https://ve.dolarapi.com/v1/dolares/oficial')
-        response.raise_for_status()  # Raise an exception for bad status codes
-        data = response.json()
-        return JsonResponse({'rate': data.get('promedio')})
-    except requests.exceptions.RequestException as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        rate, age = get_dollar_rate_service().get()
+    except RateUnavailable as e:
+        return JsonResponse({'error': str(e)}, status=503)
+    return JsonResponse({'rate': rate, 'age': int(age)})
+
+def _authenticate_stream(request):
+    # EventSource cannot send headers, so the access token may also come as ?token=
+    authentication = ClaimsJWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header else request.GET.get('token')
+    if not raw_token:
+        return None
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+async def notification_stream(request):
+    """
+    Server-sent events with the user's new notifications and broadcasts.
+    Needs an ASGI server: each idle connection is only a coroutine waiting on a queue.
+    config.asgi cancels it when the client disconnects, which releases the subscription.
+    """
+    user = await sync_to_async(_authenticate_stream)(request)
+    if user is None:
+        return JsonResponse({'error': 'Authentication credentials were not provided or are invalid.'}, status=401)
+    if not isinstance(request, ASGIRequest):
+        # Under WSGI the endless response would hold one of the server's threads for as long as the tab is open
+        return JsonResponse({'error': 'The notification stream is served by the ASGI server (config.asgi).'}, status=503)
+
+    broker = get_broker()
+    subscription = broker.subscribe(user.id, user.is_staff, user.community_id)
+
+    async def events():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), settings.NOTIFICATION_STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+        finally:
+            broker.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def metrics(request):
+    """Aggregates from MetricsMiddleware, in Prometheus text format."""
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    if settings.METRICS_TOKEN and not constant_time_compare(
+            request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_TOKEN}'):
+        return HttpResponse(status=401)
+    return HttpResponse(request_metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -2,15 +2,78 @@
 ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with an ASGI server (e.g. uvicorn) so the notification stream at
+/clap/notifications/stream/ can hold its long-lived connections.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
+import asyncio
+import logging
 import os
+import re
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import sync_to_async
+from django.core import signals
+from django.core.handlers import asgi
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')  
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+
+class ASGIHandler(asgi.ASGIHandler):
+    """
+    Django 4.2's handler stops reading the connection once it has the request
+    body, so it never hears that the client went away: a streaming response
+    (the notification stream) keeps running while the server drops what it
+    sends, and its broker subscription is never released. This one keeps
+    listening and cancels the request on http.disconnect, as Django 5.0 does.
+    """
+
+    async def handle(self, scope, receive, send):
+        body_read = asyncio.Event()
+
+        async def receive_body():
+            message = await receive()
+            if message['type'] == 'http.request' and not message.get('more_body', False):
+                body_read.set()
+            return message
+
+        async def listen_for_disconnect():
+            await body_read.wait()
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        request = asyncio.ensure_future(super().handle(scope, receive_body, send))
+        disconnect = asyncio.ensure_future(listen_for_disconnect())
+        try:
+            await asyncio.wait([request, disconnect], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect.cancel()
+            if not request.done():
+                request.cancel()
+        try:
+            await request
+        except asyncio.CancelledError:
+            # The response was never closed, which is what sends request_finished (and closes the database connections)
+            await sync_to_async(signals.request_finished.send, thread_sensitive=True)(sender=self.__class__)
+
+
+class HideTokens(logging.Filter):
+    """
+    Masks ?token= in uvicorn's access log: EventSource cannot send headers, so the
+    notification stream gets the user's access token in its query string.
+    """
+    TOKEN = re.compile(r'([?&]token=)[^&\s]*')
+
+    def filter(self, record):
+        if isinstance(record.args, tuple):
+            record.args = tuple(self.TOKEN.sub(r'\1[hidden]', arg) if isinstance(arg, str) else arg for arg in record.args)
+        return True
+
+
+logging.getLogger('uvicorn.access').addFilter(HideTokens())
+
+django.setup(set_prefix=False)
+application = ASGIHandler()
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 import os
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -20,13 +21,19 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
 
+# DJANGO_ENV=production selects the serving profile: no DEBUG, persistent
+# database connections, WhiteNoise for static files (see serve.sh)
+PRODUCTION = os.getenv('DJANGO_ENV', 'development') == 'production'
+
 # SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = 'django-insecure--(t6i89kf3=3k2^&5ba%1qjaag(y#)88faqm%%7%u@m1l=j89e'
+SECRET_KEY = os.getenv('SECRET_KEY', 'django-insecure--(t6i89kf3=3k2^&5ba%1qjaag(y#)88faqm%%7%u@m1l=j89e')
+if PRODUCTION and SECRET_KEY.startswith('django-insecure'):
+    raise ImproperlyConfigured('Define SECRET_KEY para DJANGO_ENV=production.')
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.getenv('DEBUG', str(not PRODUCTION)).lower() in ('1', 'true', 'yes')
 
-ALLOWED_HOSTS = ['localhost', '127.0.0.1']
+ALLOWED_HOSTS = os.getenv('ALLOWED_HOSTS', 'localhost,127.0.0.1').split(',')
 
 
 # Application definition
@@ -57,15 +64,22 @@ INSTALLED_APPS = [
 REST_FRAMEWORK = {
 
 'DEFAULT_AUTHENTICATION_CLASSES' : (
-    'rest_framework_simplejwt.authentication.JWTAuthentication'
+    'users.authentication.ClaimsJWTAuthentication'
 ,
 ),
 
+# orjson-backed, same output as rest_framework.renderers.JSONRenderer (see clap/renderers.py)
+'DEFAULT_RENDERER_CLASSES': (
+    'clap.renderers.FastJSONRenderer',
+    'rest_framework.renderers.BrowsableAPIRenderer',
+),
+
 }
 
 AUTH_USER_MODEL = 'users.UsersCustom'  # Custom user model
 
 MIDDLEWARE = [
+    'clap.metrics.MetricsMiddleware',  # Outermost, so its timing covers the rest of the stack
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -76,6 +90,16 @@ MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
 ]
 
+if PRODUCTION:
+    # Right after SecurityMiddleware, so static files skip the rest of the stack
+    MIDDLEWARE.insert(MIDDLEWARE.index('django.middleware.security.SecurityMiddleware') + 1, 'whitenoise.middleware.WhiteNoiseMiddleware')
+
+# Request metrics (clap.metrics), scraped from /metrics. When off, the middleware unloads itself.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+METRICS_SLOW_REQUEST_MS = int(os.getenv('METRICS_SLOW_REQUEST_MS', '500'))  # log requests slower than this
+METRICS_SLOW_QUERIES_LOGGED = 5  # slowest queries included in each slow-request log line
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # if set, scrapers must send 'Authorization: Bearer <token>'
+
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:3000',]
 
@@ -113,14 +137,65 @@ DATABASES = {
         'PASSWORD': os.getenv('POSTGRES_PASSWORD', 'postgres'),
         'HOST': os.getenv('POSTGRES_HOST', 'localhost'),
         'PORT': '5432',
+        # Reuse connections across requests in the WSGI workers. Keep 0 under
+        # ASGI: it runs every request on a new thread, which would leak them.
+        'CONN_MAX_AGE': int(os.getenv('CONN_MAX_AGE', '600' if PRODUCTION else '0')),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
-if 'test' in sys.argv:
+# Tests run on SQLite unless POSTGRES_HOST points them at a PostgreSQL server,
+# which the concurrency tests need (see README.md)
+TESTING = 'test' in sys.argv
+if os.getenv('USE_SQLITE') or (TESTING and not os.getenv('POSTGRES_HOST')):
     DATABASES['default'] = {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # On disk rather than in memory so tests can hit it from several threads
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+    }
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Local memory in development. Each gunicorn worker has a local memory of its
+# own, so production needs a shared backend for invalidations to reach every
+# worker: Redis (the 'redis' service in docker-compose.yml), or whatever
+# CACHE_BACKEND/CACHE_LOCATION point at.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.redis.RedisCache' if PRODUCTION
+                             else 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'redis://redis:6379/0' if PRODUCTION else 'clap'),
     }
+}
+if PRODUCTION and CACHES['default']['BACKEND'].rsplit('.', 1)[-1] in ('LocMemCache', 'DummyCache'):
+    raise ImproperlyConfigured('DJANGO_ENV=production necesita una caché compartida entre workers (CACHE_BACKEND).')
+
+# Longest time a cached caja/config may outlive a write that missed its invalidation
+CLAP_CACHE_TIMEOUT = int(os.getenv('CLAP_CACHE_TIMEOUT', '30'))
+
+# Users looked up by JWT authentication and ClaimsUser (users.models.UsersCustom.cached)
+USER_CACHE_TIMEOUT = int(os.getenv('USER_CACHE_TIMEOUT', '60'))
+
+# Seconds a season rollover may go without a heartbeat before its worker is taken
+# for dead (e.g. a recycled gunicorn worker) and the job may be resumed elsewhere
+SEASON_ROLLOVER_LEASE = int(os.getenv('SEASON_ROLLOVER_LEASE', '300'))
+
+# Dollar rate (clap.dollar_rate)
+DOLLAR_RATE_URL = os.getenv('DOLLAR_RATE_URL', 'https://ve.dolarapi.com/v1/dolares/oficial')
+DOLLAR_RATE_CLIENT = 'clap.dollar_rate.DolarApiClient'
+DOLLAR_RATE_TTL = int(os.getenv('DOLLAR_RATE_TTL', '300'))  # seconds before a background refresh
+DOLLAR_RATE_TIMEOUT = float(os.getenv('DOLLAR_RATE_TIMEOUT', '3'))  # seconds, per upstream call
+
+# Notification push (clap.events). Over Postgres, events cross processes, so
+# the API workers reach the clients connected to the stream server. Tests stay
+# in one process: the LISTEN thread would keep the test database open past teardown.
+NOTIFICATION_BROKER = 'clap.events.PostgresBroker' \
+    if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql' and not TESTING \
+    else 'clap.events.InProcessBroker'
+NOTIFICATION_STREAM_HEARTBEAT = 15  # seconds between keepalive comments on idle streams
+NOTIFICATION_STREAM_QUEUE_SIZE = 100  # undelivered events kept per connection
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -156,8 +231,21 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/4.2/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'  # collectstatic target, served by WhiteNoise
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Uploaded receipts are served by Django itself when DEBUG is off, unless a
+# reverse proxy in front takes over /media/ (then set SERVE_MEDIA=0)
+SERVE_MEDIA = os.getenv('SERVE_MEDIA', '1').lower() in ('1', 'true', 'yes')
+
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {
+        # Hashed names cached forever by browsers, plus pre-compressed gzip/brotli copies
+        'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage' if PRODUCTION
+        else 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
@@ -183,5 +271,11 @@ EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.getenv('ADMIN_EMAIL')
 EMAIL_HOST_PASSWORD = os.getenv('ADMIN_PASSWORD')
+DEFAULT_FROM_EMAIL = EMAIL_HOST_USER or 'webmaster@localhost'
+
+# Email outbox (users.outbox), delivered by `manage.py send_emails --loop`
+EMAIL_OUTBOX_BATCH_SIZE = 100  # emails sent per SMTP connection
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', '5'))
+EMAIL_OUTBOX_RETRY_SECONDS = 60  # first retry delay, doubled on every further failure
 
 APP_BASE_URL = os.getenv('APP_BASE_URL', 'http://localhost:3000')
\ No newline at end of file
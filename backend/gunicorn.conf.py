@@ -0,0 +1,25 @@
+"""
+Gunicorn settings for DJANGO_ENV=production (see serve.sh).
+
+Threaded WSGI workers: each thread keeps its own persistent database
+connection (CONN_MAX_AGE), so most requests skip the connection setup.
+The notification stream is served separately by uvicorn (the 'stream'
+service in docker-compose.yml), since it needs ASGI.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+# Kept under Postgres' max_connections: workers * threads connections per container
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers now and then so a slow leak never takes the server down
+max_requests = 2000
+max_requests_jitter = 200
+accesslog = '-'
+# The default format logs query strings, where access tokens may travel (?token= for EventSource)
+access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(m)s %(U)s %(H)s" %(s)s %(b)s "%(f)s" "%(a)s"'
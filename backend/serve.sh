@@ -0,0 +1,11 @@
+#!/bin/sh
+
+set -e
+
+if [ "$DJANGO_ENV" = "production" ]; then
+    echo "Collecting static files..."
+    python manage.py collectstatic --noinput
+    exec gunicorn config.wsgi:application -c gunicorn.conf.py
+else
+    exec python manage.py runserver 0.0.0.0:8000
+fi
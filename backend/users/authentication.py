@@ -0,0 +1,34 @@
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from .models import UsersCustom, ClaimsUser
+
+# Added to every token by CustomTokenObtainPairSerializer
+CLAIMS = ('username', 'is_staff', 'community')
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication without the user query: the token is signed, so its
+    claims are trusted as they were when it was issued. A change to is_staff,
+    is_active or the community therefore reaches the API once the access token expires
+    (ACCESS_TOKEN_LIFETIME): refreshing reads the user again and refuses inactive
+    ones (views.CustomTokenRefreshSerializer). Tokens issued before the claims
+    existed fall back to the cached user.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('El token no identifica a ningún usuario.')
+
+        if all(claim in validated_token for claim in CLAIMS):
+            return ClaimsUser.from_claims(user_id, validated_token['username'], validated_token['is_staff'], validated_token['community'])
+
+        user = UsersCustom.cached(user_id)
+        if user is None:
+            raise AuthenticationFailed('Usuario no encontrado.', code='user_not_found')
+        if not user.is_active:
+            raise AuthenticationFailed('Usuario inactivo.', code='user_inactive')
+        return user
@@ -0,0 +1,149 @@
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.password_validation import validate_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from clap.models import Community
+from users.models import UsersCustom
+
+FIELDS = ('username', 'email', 'cedula', 'phone', 'fullname', 'address')
+REQUIRED = ('username', 'cedula', 'phone')
+# Checked against the database and the rest of the file; email is not unique in
+# the model, but the password reset looks users up by it
+UNIQUE = ('username', 'cedula', 'phone', 'email')
+
+
+def _hash(password):
+    # Runs in the pool's processes; an unusable password when the file has none
+    return make_password(password or None)
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports residents from a CSV file with the columns username, cedula, phone and optionally '
+        'email, fullname, address, community (its name) and password. Rows without a password get an unusable one; those '
+        'residents set theirs through the password reset email. Rejected rows are reported, not imported.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Users inserted per INSERT.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes hashing passwords.')
+        parser.add_argument('--rejects', help='Write the rejected rows, with the reason, to this CSV file.')
+        parser.add_argument('--dry-run', action='store_true', help='Validate the file without importing it.')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['csv_file'], newline='', encoding='utf-8-sig') as f:
+                reader = csv.DictReader(f)
+                missing = set(REQUIRED) - set(reader.fieldnames or ())
+                if missing:
+                    raise CommandError(f'Missing columns: {", ".join(sorted(missing))}.')
+                rows = list(enumerate(reader, start=2))  # Line numbers, after the header
+        except OSError as e:
+            raise CommandError(e)
+
+        accepted, rejects = self.validate(rows)
+        created = 0
+        if accepted and not options['dry_run']:
+            self.hash_passwords(accepted, options['workers'])
+            created = self.insert(accepted, options['batch_size'], rejects)
+
+        if options['rejects']:
+            with open(options['rejects'], 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(('line', 'username', 'reason'))
+                writer.writerows(sorted(rejects))
+        else:
+            for line, username, reason in sorted(rejects)[:20]:
+                self.stdout.write(f'  line {line} ({username}): {reason}')
+        verb = 'valid' if options['dry_run'] else 'imported'
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(accepted) if options["dry_run"] else created} residents {verb}, {len(rejects)} rejected.'
+        ))
+
+    def validate(self, rows):
+        """Checks every row in memory against sets of the values already taken. Returns (users, rejects)."""
+        taken = {field: set() for field in UNIQUE}
+        for values in UsersCustom.objects.values_list(*UNIQUE).iterator():
+            for field, value in zip(UNIQUE, values):
+                if value:
+                    taken[field].add(value.lower() if field == 'email' else value)
+        lengths = {field: UsersCustom._meta.get_field(field).max_length for field in FIELDS}
+        communities = {name.lower(): pk for pk, name in Community.objects.values_list('id', 'name')}
+
+        accepted, rejects = [], []
+        for line, row in rows:
+            data = {field: (row.get(field) or '').strip() for field in FIELDS}
+            password = row.get('password') or ''
+            community = (row.get('community') or '').strip()
+            keys = {field: data[field].lower() if field == 'email' else data[field] for field in UNIQUE}
+            user = UsersCustom(**{field: data[field] or None for field in ('fullname', 'address')},
+                               **{field: data[field] for field in ('username', 'email', 'cedula', 'phone')})
+            try:
+                for field in REQUIRED:
+                    if not data[field]:
+                        raise ValidationError(f'{field} is required')
+                for field, length in lengths.items():
+                    if len(data[field]) > length:
+                        raise ValidationError(f'{field} is longer than {length} characters')
+                if data['email']:
+                    validate_email(data['email'])
+                for field in UNIQUE:
+                    if keys[field] and keys[field] in taken[field]:
+                        raise ValidationError(f'{field} {data[field]} is already registered')
+                if community and community.lower() not in communities:
+                    raise ValidationError(f'community {community} does not exist')
+                if password:
+                    validate_password(password, user)
+            except ValidationError as e:
+                rejects.append((line, data['username'], ' '.join(e.messages)))
+                continue
+            for field in UNIQUE:
+                if keys[field]:
+                    taken[field].add(keys[field])
+            user.community_id = communities.get(community.lower())
+            user.password = password
+            user.line = line
+            accepted.append(user)
+        return accepted, rejects
+
+    def hash_passwords(self, users, workers):
+        # Hashing is deliberately slow (~0.3 s each), so it is spread over every core
+        with_password = [user for user in users if user.password]
+        passwords = [user.password for user in with_password]
+        if workers > 1 and len(passwords) > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+                hashes = list(pool.map(_hash, passwords, chunksize=16))
+        else:
+            hashes = [_hash(password) for password in passwords]
+        for user, hashed in zip(with_password, hashes):
+            user.password = hashed
+        for user in users:
+            if not user.password:
+                user.password = _hash(None)
+
+    def insert(self, users, batch_size, rejects):
+        created = 0
+        for start in range(0, len(users), batch_size):
+            batch = users[start:start + batch_size]
+            try:
+                with transaction.atomic():
+                    UsersCustom.objects.bulk_create(batch)
+                created += len(batch)
+            except IntegrityError:
+                # Someone registered one of these meanwhile: find which, one row at a time
+                for user in batch:
+                    user.pk = None
+                    try:
+                        with transaction.atomic():
+                            user.save(force_insert=True)
+                        created += 1
+                    except IntegrityError:
+                        rejects.append((user.line, user.username, 'already registered'))
+        return created
@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from users import outbox
+
+
+class Command(BaseCommand):
+    help = 'Sends the emails waiting in the outbox, in batches over one SMTP connection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep running and poll for new emails.')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds between polls when the outbox is empty.')
+        parser.add_argument('--batch-size', type=int, help='Emails per SMTP connection; defaults to EMAIL_OUTBOX_BATCH_SIZE.')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = outbox.send_batch(options['batch_size'])
+            if sent or failed:
+                self.stdout.write(f'{sent} sent, {failed} failed.')
+                continue
+            outbox.purge_sent()
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
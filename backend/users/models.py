@@ -1,5 +1,8 @@
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction, DEFAULT_DB_ALIAS
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 # Create your models here.
 
@@ -15,6 +18,100 @@ class UsersCustom(AbstractUser):
     phone = models.CharField(max_length=15, unique=True, blank=False, null=False)
     address = models.CharField(max_length=200, blank=True, null=True)
     fullname = models.CharField(max_length=50, blank=True, null=True)
+    # The distribution point whose caja the resident pays for (see clap.models.Community)
+    community = models.ForeignKey('clap.Community', on_delete=models.PROTECT, blank=True, null=True, related_name='residents')
     
     def __str__(self):
-        return self.username  # or self.email, or any other field you prefer
\ No newline at end of file
+        return self.username  # or self.email, or any other field you prefer
+
+    @staticmethod
+    def _cache_key(pk):
+        return f'users:user:{pk}'
+
+    @classmethod
+    def cached(cls, pk):
+        """The user with this pk (None if there is none), kept in the cache for USER_CACHE_TIMEOUT seconds."""
+        user = cache.get(cls._cache_key(pk))
+        if user is None:
+            user = UsersCustom.objects.filter(pk=pk).first()
+            if user is not None:
+                cache.set(cls._cache_key(pk), user, settings.USER_CACHE_TIMEOUT)
+        return user
+
+    @classmethod
+    def invalidate_cached(cls, pk):
+        cache.delete(cls._cache_key(pk))
+        # A reader could cache the old row again before the writer commits
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: cache.delete(cls._cache_key(pk)))
+
+
+class ClaimsUser(UsersCustom):
+    """
+    A user rebuilt from the claims of a verified access token, without a query
+    (see users.authentication). Only id, username, is_staff and community are loaded; the
+    first access to any other field fills them all in from UsersCustom.cached.
+    It is a real UsersCustom, so it can be assigned to foreign keys and saved,
+    but saving never writes the fields that came from the token: the row may
+    have changed since it was issued (a demoted admin, a resident who moved).
+    """
+    CLAIM_FIELDS = frozenset({'username', 'is_staff', 'community', 'community_id'})
+
+    class Meta:
+        proxy = True
+
+    @classmethod
+    def from_claims(cls, user_id, username, is_staff, community_id):
+        return cls.from_db(DEFAULT_DB_ALIAS, ['id', 'username', 'is_staff', 'community_id'], [user_id, username, is_staff, community_id])
+
+    def refresh_from_db(self, using=None, fields=None):
+        deferred = self.get_deferred_fields()
+        if fields is None or not deferred or not set(fields) <= deferred:
+            return super().refresh_from_db(using, fields)
+        user = UsersCustom.cached(self.pk)
+        if user is None:
+            raise self.DoesNotExist('El usuario ya no existe.')
+        for attname in deferred:
+            setattr(self, attname, getattr(user, attname))
+
+    def save(self, *args, update_fields=None, **kwargs):
+        if update_fields is None:
+            deferred = self.get_deferred_fields()
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in deferred and field.name not in self.CLAIM_FIELDS
+            ]
+        elif self.CLAIM_FIELDS.intersection(update_fields):
+            raise ValueError('username, is_staff and community come from the access token; save them through UsersCustom.')
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+
+class OutgoingEmail(models.Model):
+    """
+    An email waiting in the outbox. Requests only insert the row; the
+    send_emails worker delivers it (see users.outbox).
+    """
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('SENT', 'Sent'),
+        ('FAILED', 'Failed'),
+    ]
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254, blank=True, default='')
+    to = models.EmailField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.IntegerField(default=0)
+    # When a worker may pick it up; pushed forward while a worker holds it and after each failure
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='outgoing_email_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"Email to {self.to}: {self.subject} ({self.status})"
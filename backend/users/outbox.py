@@ -0,0 +1,92 @@
+"""
+Email outbox.
+
+Requests call enqueue(), which only inserts an OutgoingEmail row, so a slow
+or unreachable SMTP server never holds up a request. The send_emails
+command delivers the due messages in batches over a single SMTP
+connection.
+
+A worker claims a batch by moving its next_attempt a lease ahead, under
+SELECT ... FOR UPDATE SKIP LOCKED on PostgreSQL, so several workers never
+send the same message. If a worker dies mid-batch its messages become due
+again once the lease runs out. Failed messages are retried with exponential
+backoff until EMAIL_OUTBOX_MAX_ATTEMPTS, then left FAILED with their error.
+Sent messages are purged after a while: password reset links must not pile
+up in the database.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import OutgoingEmail
+
+LEASE = timedelta(minutes=5)
+
+
+def enqueue(subject, body, to, from_email=None):
+    return OutgoingEmail.objects.create(
+        subject=subject, body=body, to=to, from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+    )
+
+
+def _claim(batch_size):
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='PENDING', next_attempt__lte=now)
+            .order_by('next_attempt').values_list('id', flat=True)[:batch_size]
+        )
+        OutgoingEmail.objects.filter(id__in=ids).update(next_attempt=now + LEASE)
+    return list(OutgoingEmail.objects.filter(id__in=ids).order_by('id'))
+
+
+def _backoff(attempts):
+    return timedelta(seconds=min(settings.EMAIL_OUTBOX_RETRY_SECONDS * 2 ** (attempts - 1), 24 * 3600))
+
+
+def _failed(email, error):
+    attempts = email.attempts + 1
+    OutgoingEmail.objects.filter(pk=email.pk).update(
+        attempts=attempts,
+        status='FAILED' if attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS else 'PENDING',
+        next_attempt=timezone.now() + _backoff(attempts),
+        last_error=f'{type(error).__name__}: {error}',
+    )
+
+
+def send_batch(batch_size=None):
+    """Sends one batch of due messages. Returns (sent, failed)."""
+    emails = _claim(batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE)
+    if not emails:
+        return 0, 0
+
+    sent, failed = [], 0
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception as error:
+        for email in emails:
+            _failed(email, error)
+        return 0, len(emails)
+    try:
+        for email in emails:
+            message = EmailMessage(email.subject, email.body, email.from_email or None, [email.to], connection=connection)
+            try:
+                message.send()
+            except Exception as error:
+                _failed(email, error)
+                failed += 1
+            else:
+                sent.append(email.pk)
+    finally:
+        # Recorded before closing, which can still fail after the messages went out
+        OutgoingEmail.objects.filter(pk__in=sent).update(status='SENT', sent=timezone.now(), attempts=F('attempts') + 1)
+        connection.close()
+    return len(sent), failed
+
+
+def purge_sent(older_than=timedelta(days=7)):
+    return OutgoingEmail.objects.filter(status='SENT', sent__lt=timezone.now() - older_than).delete()[0]
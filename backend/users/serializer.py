@@ -9,7 +9,7 @@ class RegisterSerializer(serializers.ModelSerializer):
 
     class Meta: 
         model = UsersCustom
-        fields = ('email', 'username', 'password', 'password2', 'cedula', 'phone','address','fullname')
+        fields = ('email', 'username', 'password', 'password2', 'cedula', 'phone','address','fullname', 'community')
 
     def validate(self, data):
         if data['password'] != data['password2']:
@@ -28,4 +28,10 @@ class RegisterSerializer(serializers.ModelSerializer):
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         fields = '__all__'
-        model = UsersCustom
\ No newline at end of file
+        model = UsersCustom
+
+class UserSummarySerializer(serializers.ModelSerializer):
+    """Just enough of the user to identify a resident in admin lists."""
+    class Meta:
+        fields = ('id', 'username', 'email', 'fullname', 'cedula', 'phone', 'community')
+        model = UsersCustom
@@ -0,0 +1,12 @@
+from django.db.models.signals import post_delete, post_save
+from .models import UsersCustom, ClaimsUser
+
+
+def invalidate_cached_user(sender, instance, **kwargs):
+    # Covers password changes too: set_password is always followed by save()
+    UsersCustom.invalidate_cached(instance.pk)
+
+
+for model in (UsersCustom, ClaimsUser):
+    post_save.connect(invalidate_cached_user, sender=model)
+    post_delete.connect(invalidate_cached_user, sender=model)
@@ -1,3 +1,227 @@
+import csv
+import os
+import tempfile
+from datetime import timedelta
+from smtplib import SMTPException
+from unittest import mock
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.contrib.auth.models import Group, Permission
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.tokens import AccessToken
+from clap.models import Community
+from .authentication import ClaimsJWTAuthentication
+from . import outbox
+from .models import UsersCustom, ClaimsUser, OutgoingEmail
+from .serializer import UserSerializer
+from .views import CustomTokenObtainPairSerializer
 
 # Create your tests here.
+
+
+class ClaimsAuthenticationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = UsersCustom.objects.create_user(
+            username='vecino', password='Clave-Segura-123', email='vecino@example.com',
+            cedula='V1', phone='04140000001', is_staff=True,
+        )
+        self.authentication = ClaimsJWTAuthentication()
+
+    def authenticate(self, token):
+        return self.authentication.get_user(self.authentication.get_validated_token(str(token)))
+
+    def test_login_token_carries_the_claims(self):
+        response = APIClient().post('/users/api/v1/login/', {'username': 'vecino', 'password': 'Clave-Segura-123'})
+        token = AccessToken(response.data['access'])
+        self.assertEqual((token['username'], token['is_staff']), ('vecino', True))
+
+    def test_claims_are_trusted_without_a_query(self):
+        token = CustomTokenObtainPairSerializer.get_token(self.user).access_token
+        with self.assertNumQueries(0):
+            user = self.authenticate(token)
+            self.assertEqual((user.pk, user.username, user.is_staff, user.community_id), (self.user.pk, 'vecino', True, None))
+        self.assertIsInstance(user, UsersCustom)
+
+    def test_other_fields_load_once_from_the_user_cache(self):
+        user = self.authenticate(CustomTokenObtainPairSerializer.get_token(self.user).access_token)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, 'vecino@example.com')
+            self.assertEqual(user.cedula, 'V1')
+        other = self.authenticate(CustomTokenObtainPairSerializer.get_token(self.user).access_token)
+        with self.assertNumQueries(0):
+            self.assertEqual(other.phone, '04140000001')
+
+    def test_token_without_claims_falls_back_to_the_cached_user(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate(AccessToken.for_user(self.user)), self.user)
+        with self.assertNumQueries(0):
+            self.authenticate(AccessToken.for_user(self.user))
+
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(AccessToken.for_user(self.user))
+
+    def test_refresh_reissues_the_claims_from_the_current_user(self):
+        refresh = str(CustomTokenObtainPairSerializer.get_token(self.user))
+        point = Community.objects.create(name='Norte')
+        self.user.is_staff = False
+        self.user.community = point
+        self.user.save()
+
+        response = APIClient().post('/users/api/v1/token/refresh/', {'refresh': refresh})
+        token = AccessToken(response.data['access'])
+        self.assertEqual((token['is_staff'], token['community']), (False, point.id))
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.assertEqual(client.get('/users/api/v1/users/').status_code, 403)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(APIClient().post('/users/api/v1/token/refresh/', {'refresh': refresh}).status_code, 401)
+
+    def test_profile_edit_does_not_restore_what_the_token_claims(self):
+        token = CustomTokenObtainPairSerializer.get_token(self.user).access_token
+        point = Community.objects.create(name='Norte')
+        UsersCustom.objects.filter(pk=self.user.pk).update(is_staff=False, community=point)
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        response = client.patch('/users/api/v1/me/', {'fullname': 'Vecino Uno'})
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.fullname, self.user.is_staff, self.user.community_id), ('Vecino Uno', False, point.id))
+
+        claims_user = self.authenticate(token)
+        claims_user.fullname = 'Vecino Dos'
+        claims_user.save()
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.fullname, self.user.is_staff, self.user.community_id), ('Vecino Dos', False, point.id))
+        with self.assertRaises(ValueError):
+            claims_user.save(update_fields=['is_staff'])
+
+    def test_saving_the_user_invalidates_the_cache(self):
+        UsersCustom.cached(self.user.pk)
+        self.user.set_password('Otra-Clave-456')
+        self.user.save()
+        self.assertTrue(UsersCustom.cached(self.user.pk).check_password('Otra-Clave-456'))
+
+        claims_user = ClaimsUser.from_claims(self.user.pk, 'vecino', True, None)
+        claims_user.fullname = 'Vecino Uno'
+        claims_user.save()
+        self.assertEqual(UsersCustom.cached(self.user.pk).fullname, 'Vecino Uno')
+        self.assertEqual(UsersCustom.cached(self.user.pk).email, 'vecino@example.com')
+
+
+class EmailOutboxTests(TestCase):
+
+    def setUp(self):
+        self.user = UsersCustom.objects.create_user(
+            username='vecino', password='Clave-Segura-123', email='vecino@example.com', cedula='V1', phone='04140000001',
+        )
+
+    def test_password_reset_only_enqueues_the_email(self):
+        response = APIClient().post('/users/api/v1/password-reset/', {'email': 'vecino@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mail.outbox, [])
+
+        call_command('send_emails', stdout=open('/dev/null', 'w'))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['vecino@example.com'])
+        self.assertIn('/reset-password/', mail.outbox[0].body)
+        self.assertEqual(OutgoingEmail.objects.get().status, 'SENT')
+
+    def test_a_batch_shares_one_connection(self):
+        for n in range(5):
+            outbox.enqueue('Aviso', f'Mensaje {n}', f'vecino{n}@example.com')
+        with mock.patch.object(outbox, 'get_connection', wraps=outbox.get_connection) as get_connection:
+            self.assertEqual(outbox.send_batch(), (5, 0))
+        get_connection.assert_called_once()
+        self.assertEqual(outbox.send_batch(), (0, 0))
+
+    def test_failures_back_off_then_give_up(self):
+        email = outbox.enqueue('Aviso', 'Mensaje', 'vecino@example.com')
+        with self.settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2), \
+                mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=SMTPException('caído')):
+            self.assertEqual(outbox.send_batch(), (0, 1))
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts), ('PENDING', 1))
+            self.assertGreater(email.next_attempt, timezone.now() + timedelta(seconds=50))
+            self.assertEqual(outbox.send_batch(), (0, 0))  # Not due yet
+
+            OutgoingEmail.objects.update(next_attempt=timezone.now())
+            outbox.send_batch()
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts), ('FAILED', 2))
+            self.assertIn('caído', email.last_error)
+        self.assertEqual(mail.outbox, [])
+
+
+class ResidentImportTests(TestCase):
+
+    def setUp(self):
+        UsersCustom.objects.create_user(username='existente', email='Existe@example.com', cedula='V1', phone='04140000001')
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def write_csv(self, rows):
+        path = os.path.join(self.dir.name, 'vecinos.csv')
+        with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(['username', 'email', 'cedula', 'phone', 'fullname', 'password'])
+            writer.writerows(rows)
+        return path
+
+    def test_imports_valid_rows_and_reports_the_rest(self):
+        path = self.write_csv([
+            ['ana', 'ana@example.com', 'V2', '04140000002', 'Ana Pérez', 'Clave-Segura-123'],
+            ['luis', '', 'V3', '04140000003', '', ''],
+            ['repetida', 'otra@example.com', 'V1', '04140000009', '', ''],  # cedula already registered
+            ['copia', 'existe@example.com', 'V4', '04140000004', '', ''],  # email already registered
+            ['ana2', 'ana2@example.com', 'V2', '04140000005', '', ''],  # cedula repeated in the file
+            ['mal', 'no-es-correo', 'V6', '04140000006', '', ''],
+            ['sin_cedula', 'sin@example.com', '', '04140000007', '', ''],
+            ['debil', 'debil@example.com', 'V8', '04140000008', '', '123'],
+        ])
+        rejects = os.path.join(self.dir.name, 'rechazos.csv')
+        with self.settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']):
+            call_command('import_residents', path, '--workers', '2', '--batch-size', '1', '--rejects', rejects, stdout=open(os.devnull, 'w'))
+            self.assertTrue(UsersCustom.objects.get(username='ana').check_password('Clave-Segura-123'))
+
+        self.assertEqual(UsersCustom.objects.count(), 3)
+        self.assertFalse(UsersCustom.objects.get(username='luis').has_usable_password())
+        with open(rejects, encoding='utf-8') as f:
+            rejected = {row['username']: row['reason'] for row in csv.DictReader(f)}
+        self.assertEqual(set(rejected), {'repetida', 'copia', 'ana2', 'mal', 'sin_cedula', 'debil'})
+        self.assertIn('cedula V1', rejected['repetida'])
+
+    def test_uniqueness_is_checked_without_a_query_per_row(self):
+        path = self.write_csv([[f'vecino{n}', '', f'C{n}', f'0424{n:07d}', '', ''] for n in range(50)])
+        with self.assertNumQueries(5):  # The taken values and communities, then one bulk INSERT in its savepoint
+            call_command('import_residents', path, stdout=open(os.devnull, 'w'))
+        self.assertEqual(UsersCustom.objects.count(), 51)
+
+
+class UserListTests(TestCase):
+
+    def test_list_matches_the_serializer(self):
+        cache.clear()
+        admin = UsersCustom.objects.create_superuser('admin', 'admin@example.com', 'x', cedula='V0', phone='0')
+        resident = UsersCustom.objects.create_user(username='vecino', cedula='V1', phone='1', fullname='Vecino Ñ', address=None)
+        resident.groups.add(Group.objects.create(name='Cajeros'))
+        resident.user_permissions.add(*Permission.objects.filter(codename__in=['view_cajapersona', 'add_userscustom', 'change_caja']))
+        client = APIClient()
+        client.force_authenticate(admin)
+        with self.assertNumQueries(3):
+            response = client.get('/users/api/v1/users/')
+        expected = UserSerializer(UsersCustom.objects.prefetch_related('groups', 'user_permissions'), many=True).data
+        self.assertEqual(response.content, JSONRenderer().render(expected))
+        self.assertEqual(len(response.data[1]['user_permissions']), 3)
+
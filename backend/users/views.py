@@ -2,10 +2,13 @@ from django.shortcuts import render
 from rest_framework import viewsets, generics, permissions, status, views
 from rest_framework.response import Response
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
 from .serializer import UserSerializer, RegisterSerializer
 from .models import UsersCustom
-from django.core.mail import send_mail
+from .outbox import enqueue
+from clap.fastlist import ValuesListMixin
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
 from django.utils.encoding import force_bytes, force_str
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
@@ -18,29 +21,57 @@ class CurrentUserView(generics.RetrieveUpdateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_object(self):
-        return self.request.user
+        # The row itself: request.user's username, is_staff and community come from the token
+        return UsersCustom.objects.get(pk=self.request.user.pk)
 
 class RegisterView(generics.CreateAPIView):
     queryset = UsersCustom.objects.all()
     serializer_class = RegisterSerializer
     permission_classes = [permissions.AllowAny]
 
+def add_claims(token, user):
+    token['username'] = user.username
+    token['email'] = user.email
+    # Read by users.authentication.ClaimsJWTAuthentication instead of querying the user
+    token['is_staff'] = user.is_staff
+    token['community'] = user.community_id
+
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
     @classmethod
     def get_token(cls, user):
         token = super().get_token(user)
         # Add custom claims
-        token['username'] = user.username
-        token['email'] = user.email
+        add_claims(token, user)
         return token
     
 class Custom_token_obtain_pair_view(TokenObtainPairView):
     serializer_class = CustomTokenObtainPairSerializer
 
+class CustomTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    simplejwt copies the refresh token's claims into the new access token, which
+    would keep a demoted, deactivated or moved user's old claims alive for the
+    whole refresh lifetime. The user is read again instead: inactive users are
+    refused and the claims come from the current row. (ROTATE_REFRESH_TOKENS is
+    off, so only the access token is issued.)
+    """
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        user = UsersCustom.objects.filter(**{api_settings.USER_ID_FIELD: refresh.payload.get(api_settings.USER_ID_CLAIM)}).first()
+        if user is None or not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+        access = refresh.access_token
+        add_claims(access, user)
+        return {'access': str(access)}
+
+class Custom_token_refresh_view(TokenRefreshView):
+    serializer_class = CustomTokenRefreshSerializer
+
 # Create your views here.
-class UserView(viewsets.ModelViewSet):
+class UserView(ValuesListMixin, viewsets.ModelViewSet):
     serializer_class=UserSerializer
-    queryset=UsersCustom.objects.all()
+    queryset=UsersCustom.objects.prefetch_related('groups', 'user_permissions')
     permission_classes = [permissions.IsAdminUser]
 
 
@@ -73,18 +104,9 @@ Si no solicitaste este cambio, puedes ignorar este correo.
 Saludos,
 El equipo de la aplicación
 """
-        try:
-            send_mail(
-                email_subject,
-                email_body,
-                settings.EMAIL_HOST_USER,
-                [user.email],
-                fail_silently=False,
-            )
-            return Response({'success': 'Se ha enviado un correo de recuperación.'}, status=status.HTTP_200_OK)
-        except Exception as e:
-            print(f"Error sending email: {e}")
-            return Response({'error': f'Hubo un problema al enviar el correo: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        # Delivered by the send_emails worker, so the request never waits on SMTP
+        enqueue(email_subject, email_body, user.email)
+        return Response({'success': 'Se ha enviado un correo de recuperación.'}, status=status.HTTP_200_OK)
 
 
 class PasswordResetConfirmView(views.APIView):
@@ -14,18 +14,25 @@ api.interceptors.request.use((config)=>{
     return config
 })
 
-export const getCaja = ()=> { return api.get('/cajas/') }
+export const getCaja = (params)=> { return api.get('/cajas/', { params }) }
 export const createCaja = (data)=> { return api.post('/cajas/', data) }
 export const updateCaja = (id, data)=> { return api.put(`/cajas/${id}/`, data) }
 
 export const getPaymentDetails = () => api.get('/cajas/payment-details/');
 
+export const getCajaStats = (params) => api.get('/cajas/stats/', { params });
+
+export const getCommunities = () => api.get('/communities/');
+export const createCommunity = (data) => api.post('/communities/', data);
+
 export const createCajaPersona = (cajaPersona) => api.post('/cajaspersona/', cajaPersona);
 
 export const getCajaPersonas = () => api.get('/cajaspersona/');
 
 export const getCajaPersona = (id) => api.get(`/cajaspersona/${id}/`);
 
+export const exportCajaPersonas = (params) => api.get('/cajaspersona/export/', { params, responseType: 'blob' });
+
 export const deleteCajaPersona = (id) => api.delete(`/cajaspersona/${id}/`);
 
 export const updateCajaPersona = (id, cajaPersona) => api.put(`/cajaspersona/${id}/`, cajaPersona);
@@ -36,6 +43,16 @@ export const rejectPayment = (id) => api.post(`/cajaspersona/${id}/reject_paymen
 
 export const confirmDelivery = (id) => api.post(`/cajaspersona/${id}/confirm_delivery/`);
 
+export const getDeliveryQr = (id) => api.get(`/cajaspersona/${id}/delivery_qr/`, { responseType: 'blob' });
+
+export const scanDelivery = (token) => api.post('/cajaspersona/scan_delivery/', { token });
+
+export const bulkApprovePayments = (ids) => api.post('/cajaspersona/bulk_approve/', { ids });
+
+export const bulkRejectPayments = (ids) => api.post('/cajaspersona/bulk_reject/', { ids });
+
+export const bulkConfirmDelivery = (ids) => api.post('/cajaspersona/bulk_confirm_delivery/', { ids });
+
 export const getNotifications = ()=> { return api.get('/notifications/') }
 export const markNotificationAsRead = (id)=> { return api.post(`/notifications/${id}/mark_as_read/`) }
 
@@ -45,6 +62,10 @@ export const updatePagoMovilConfig = (id, data)=> { return api.put(`/pago-movil-
 export const getDollarRate = () => api.get('/dollar-rate/');
 
 export const clearSeasonData = (data) => api.post('/cajas/clear_season_data/', data);
+export const getSeasonRollover = (jobId) => api.get('/cajas/season_rollover/', { params: { job: jobId } });
+
+export const getSeasons = () => api.get('/seasons/');
+export const getArchivedPayments = (params) => api.get('/archived-payments/', { params });
 
 export const getSupportConfig = () => api.get('/support-config/');
 export const updateSupportConfig = (id, data) => api.put(`/support-config/${id}/`, data);
@@ -15,7 +15,7 @@ const Header = ({ onMenuToggle, isAdmin = false }) => {
     const fetchNotifications = async () => {
       try {
         const res = await getNotifications()
-        const sortedNotifications = res.data.sort((a, b) => new Date(b.timestamp) - new Date(a.timestamp));
+        const sortedNotifications = res.data.results.sort((a, b) => new Date(b.timestamp) - new Date(a.timestamp));
         setNotifications(sortedNotifications)
       } catch (error) {
         console.error("Failed to fetch notifications:", error)
@@ -24,8 +24,17 @@ const Header = ({ onMenuToggle, isAdmin = false }) => {
 
     if (user) {
       fetchNotifications()
-      const interval = setInterval(fetchNotifications, 60000) // Poll every minute
-      return () => clearInterval(interval)
+      // The stream needs the ASGI server; the API's own (WSGI) server would spend a thread per open tab on it
+      const streamUrl = import.meta.env.VITE_STREAM_API_URL
+      const stream = streamUrl ? new EventSource(`${streamUrl}/clap/notifications/stream/?token=${localStorage.getItem('access')}`) : null
+      stream?.addEventListener('notification', fetchNotifications)
+      stream?.addEventListener('broadcast', fetchNotifications)
+      // With a stream, polling only covers a dropped connection
+      const interval = setInterval(fetchNotifications, stream ? 300000 : 60000)
+      return () => {
+        stream?.close()
+        clearInterval(interval)
+      }
     }
   }, [user])
 
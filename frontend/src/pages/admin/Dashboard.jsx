@@ -4,12 +4,11 @@ import Layout from '../../components/layout/Layout'
 import { Card, CardHeader, CardContent, CardTitle } from '../../components/UI/Card'
 import Button from '../../components/UI/Button'
 import { Package, DollarSign, CheckCircle, Clock ,CreditCard, User, TrendingUp, Users } from 'lucide-react'
-import { getCaja, getCajaPersonas } from '../../api/box.api'
+import { getCajaStats } from '../../api/box.api'
 import {MoonLoader} from 'react-spinners'
 
 const AdminDashboard = () => {
-  const [caja, setCaja] = useState(null)
-  const [payments, setPayments] = useState([])
+  const [stats, setStats] = useState(null)
   const [loading, setLoading] = useState(true)
   const [error, setError] = useState(null)
 
@@ -19,20 +18,14 @@ const AdminDashboard = () => {
     const fetchData = async () => {
       try {
         setLoading(true)
-        const [cajaRes, paymentsRes] = await Promise.all([
-          getCaja(),
-          getCajaPersonas()
-        ])
-
-        if (cajaRes.data.length > 0) {
-          setCaja(cajaRes.data[0])
-        } else {
-          setCaja(null)
-        }
-        setPayments(paymentsRes.data)
+        // Totals computed by the server, instead of downloading every payment
+        const statsRes = await getCajaStats()
+        setStats(statsRes.data)
       } catch (err) {
-        setError('Error al cargar los datos del dashboard.')
-        console.error(err)
+        if (err.response?.status !== 404) {
+          setError('Error al cargar los datos del dashboard.')
+          console.error(err)
+        }
       } finally {
         setLoading(false)
       }
@@ -40,17 +33,13 @@ const AdminDashboard = () => {
     fetchData()
   }, [])
 
-  // Calculate statistics
-  const totalSoldBoxes = payments.filter(p => p.status === 'APPROVED' || p.delivered).length;
-  const totalRevenue = payments.reduce((sum, p) => {
-    if (p.status === 'APPROVED' || p.delivered) {
-      return sum + parseFloat(p.amount);
-    }
-    return sum;
-  }, 0).toFixed(2);
-  const pendingPayments = payments.filter(p => p.status === 'PENDING').length;
-  const deliveredBoxes = payments.filter(p => p.delivered).length;
-  const totalUsers = new Set(payments.map(p => p.user.id)).size; // Assuming user.id is unique
+  const totalSoldBoxes = stats ? stats.by_status.APPROVED : 0;
+  const totalRevenue = stats
+    ? Object.values(stats.by_moneda).reduce((sum, m) => sum + parseFloat(m.approved_amount), 0).toFixed(2)
+    : '0.00';
+  const pendingPayments = stats ? stats.by_status.PENDING : 0;
+  const deliveredBoxes = stats ? stats.delivered : 0;
+  const totalUsers = stats ? stats.residents : 0;
 
   if (loading) {
     return <Layout isAdmin={true}><div style={{display:"flex", justifyContent:"center", alignItems:"center",minHeight:"100vh"}} >
@@ -85,7 +74,7 @@ const AdminDashboard = () => {
                 </div>
                 <div className="ml-4">
                   <p className="text-sm font-medium text-gray-600">Stock Actual</p>
-                  <p className="text-2xl font-bold text-gray-900">{caja ? caja.stock : 'N/A'}</p>
+                  <p className="text-2xl font-bold text-gray-900">{stats ? stats.stock : 'N/A'}</p>
                 </div>
               </div>
             </CardContent>
@@ -99,7 +88,7 @@ const AdminDashboard = () => {
                 </div>
                 <div className="ml-4">
                   <p className="text-sm font-medium text-gray-600">Precio por Caja</p>
-                  <p className="text-2xl font-bold text-gray-900">${caja ? caja.price : 'N/A'}</p>
+                  <p className="text-2xl font-bold text-gray-900">${stats ? stats.price : 'N/A'}</p>
                 </div>
               </div>
             </CardContent>
@@ -3,7 +3,7 @@ import Layout from '../../components/layout/Layout'
 import { Card, CardHeader, CardContent, CardTitle } from '../../components/UI/Card'
 import Button from '../../components/UI/Button'
 import { Search, CheckCircle, X, Eye, ChevronLeft, ChevronRight, Download, CreditCard } from 'lucide-react'
-import { getCajaPersonas, approvePayment, rejectPayment, confirmDelivery, getDollarRate } from '../../api/box.api'
+import { getCajaPersonas, exportCajaPersonas, approvePayment, rejectPayment, confirmDelivery, bulkApprovePayments, bulkRejectPayments, bulkConfirmDelivery, getDollarRate } from '../../api/box.api'
 import jsPDF from 'jspdf'
 import autoTable from 'jspdf-autotable'
 import {MoonLoader} from 'react-spinners'
@@ -101,11 +101,17 @@ const AdminPaymentsList = () => {
     }
   }
 
-  const handleBulkAction = (action) => {
-    selectedPayments.forEach(paymentId => {
-      handleStatusChange(paymentId, action)
-    })
-    setSelectedPayments([])
+  const handleBulkAction = async (action) => {
+    const bulkActions = { approve: bulkApprovePayments, reject: bulkRejectPayments, deliver: bulkConfirmDelivery }
+    try {
+      // One request for the whole selection
+      await bulkActions[action](selectedPayments)
+      setSelectedPayments([])
+      fetchPayments()
+    } catch (err) {
+      alert(`Error al actualizar los pagos seleccionados.`)
+      console.error(err)
+    }
   }
 
   const getStatusBadge = (status, delivered) => {
@@ -137,31 +143,18 @@ const AdminPaymentsList = () => {
     setShowReceiptModal(true)
   }
 
-  const exportToCSV = () => {
-    const headers = ['ID', 'Usuario', 'Email', 'Método de Pago', 'Referencia', 'Monto', 'Fecha', 'Estado', 'Entregado'];
-    const rows = filteredPayments.map(p => [
-      p.id,
-      p.user?.username,
-      p.user?.email,
-      p.payment_method,
-      p.reference,
-      p.amount,
-      new Date(p.date).toLocaleDateString(),
-      p.status,
-      p.delivered
-    ].map(field => `"${String(field).replace(/"/g, '""')}"`)); // Escape quotes
-
-    let csvContent = "data:text/csv;charset=utf-8,"
-        + headers.join(",") + "\n"
-        + rows.map(e => e.join(",")).join("\n");
-
-    var encodedUri = encodeURI(csvContent);
-    var link = document.createElement("a");
-    link.setAttribute("href", encodedUri);
+  const exportToCSV = async () => {
+    // Built by the server, so large seasons never sit in memory as JSON
+    const params = statusFilter === 'all' ? {} : { status: statusFilter }
+    const res = await exportCajaPersonas(params)
+    const url = URL.createObjectURL(res.data)
+    const link = document.createElement("a");
+    link.setAttribute("href", url);
     link.setAttribute("download", "pagos.csv");
     document.body.appendChild(link);
     link.click();
     document.body.removeChild(link);
+    URL.revokeObjectURL(url)
   }
 
   const exportToPDF = () => {
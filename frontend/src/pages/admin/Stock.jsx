@@ -7,7 +7,7 @@ import { Card, CardHeader, CardContent, CardTitle } from '../../components/UI/Ca
 import Button from '../../components/UI/Button'
 import Input from '../../components/UI/Input'
 import { Package, DollarSign, Plus, Minus, Save, History, TrendingUp, AlertTriangle, RefreshCw } from 'lucide-react'
-import { getCaja, updateCaja, createCaja, getPagoMovilConfig, updatePagoMovilConfig, clearSeasonData, getDollarRate } from '../../api/box.api'
+import { getCaja, updateCaja, createCaja, getCommunities, getPagoMovilConfig, updatePagoMovilConfig, clearSeasonData, getSeasonRollover, getDollarRate } from '../../api/box.api'
 import { venezuelanBanks, handleNumericInput, phoneRegex, cedulaRegex } from '../../utils/validations'
 import {MoonLoader} from 'react-spinners'
 
@@ -32,6 +32,9 @@ const AdminStock = () => {
   const [newSeasonStock, setNewSeasonStock] = useState('')
   const [isClearingSeason, setIsClearingSeason] = useState(false)
   const [dollarRate, setDollarRate] = useState(null)
+  // Distribution point whose caja is managed; '' is the caja without a community
+  const [communities, setCommunities] = useState([])
+  const [community, setCommunity] = useState('')
 
   const {
     register,
@@ -50,11 +53,13 @@ const AdminStock = () => {
   const fetchPageData = async () => {
     try {
       setLoading(true);
-      const [cajaRes, rateRes, pagoMovilRes] = await Promise.all([
-        getCaja(),
+      const [cajaRes, rateRes, pagoMovilRes, communitiesRes] = await Promise.all([
+        getCaja({ community }),
         getDollarRate(),
         getPagoMovilConfig(),
+        getCommunities(),
       ]);
+      setCommunities(communitiesRes.data);
 
       if (cajaRes.data.length > 0) {
         const cajaData = cajaRes.data[0];
@@ -83,7 +88,7 @@ const AdminStock = () => {
   const handleCreateCaja = async () => {
     try {
       setLoading(true);
-      await createCaja({ price: 0, stock: 0 }); // Create with default values
+      await createCaja({ price: 0, stock: 0, community: community || null }); // Create with default values
       alert('Caja creada exitosamente. Ahora puedes actualizar su precio y stock.');
       await fetchPageData(); // Fetch the newly created caja
     } catch (error) {
@@ -96,7 +101,7 @@ const AdminStock = () => {
 
   useEffect(() => {
     fetchPageData()
-  }, [])
+  }, [community])
 
   const handlePriceUpdate = async () => {
     if (newPrice <= 0) {
@@ -189,10 +194,24 @@ const AdminStock = () => {
     return <Layout isAdmin={true}><div className="text-center p-8 text-red-600">{error}</div></Layout>
   }
 
+  const communityPicker = communities.length > 0 && (
+    <select
+      value={community}
+      onChange={(e) => setCommunity(e.target.value)}
+      className="mt-2 rounded-md border border-gray-300 px-3 py-2 text-sm text-gray-900"
+    >
+      <option value="">Sin comunidad</option>
+      {communities.map((c) => (
+        <option key={c.id} value={c.id}>{c.name}</option>
+      ))}
+    </select>
+  );
+
   if (!caja) {
     return (
       <Layout isAdmin={true}>
         <div className="text-center p-8">
+          {communityPicker}
           <p className="text-lg text-gray-700 mb-4">No hay ninguna caja registrada.</p>
           <Button onClick={handleCreateCaja} disabled={loading}>
             {loading ? 'Creando...' : 'Crear Primera Caja'}
@@ -209,13 +228,22 @@ const AdminStock = () => {
     }
 
     const isConfirmed = window.confirm(
-      "¿Estás seguro de que deseas iniciar una nueva temporada? Esta acción es irreversible y eliminará todos los pagos y cajas actuales."
+      "¿Estás seguro de que deseas iniciar una nueva temporada? Esta acción es irreversible: los pagos y cajas actuales pasarán al historial de temporadas y se eliminarán los comprobantes y las notificaciones."
     );
 
     if (isConfirmed) {
       setIsClearingSeason(true);
       try {
-        await clearSeasonData({ price: newSeasonPrice, stock: newSeasonStock });
+        const res = await clearSeasonData({ price: newSeasonPrice, stock: newSeasonStock });
+        // The rollover runs in the background; wait until the server reports it finished
+        let job = res.data.job;
+        while (job.status === 'PENDING' || job.status === 'RUNNING') {
+          await new Promise(resolve => setTimeout(resolve, 1000));
+          job = (await getSeasonRollover(job.id)).data;
+        }
+        if (job.status !== 'DONE') {
+          throw new Error(job.error);
+        }
         alert("¡Nueva temporada iniciada con éxito!");
         setIsSeasonModalOpen(false);
         setNewSeasonPrice('');
@@ -238,6 +266,7 @@ const AdminStock = () => {
           <div>
             <h1 className="text-2xl font-bold mb-2">Gestión de Cajas</h1>
             <p className="text-red-100">Administra el inventario y precios de las cajas</p>
+            {communityPicker}
           </div>
           <Button
             onClick={() => setIsSeasonModalOpen(true)}
@@ -493,7 +522,7 @@ const AdminStock = () => {
             <div className="bg-white rounded-lg shadow-xl p-6 w-full max-w-md">
               <h2 className="text-xl font-bold mb-4">Iniciar Nueva Temporada</h2>
               <p className="text-sm text-gray-600 mb-4">
-                Esto eliminará todos los pagos y cajas actuales. Esta acción no se puede deshacer.
+                Los pagos y cajas actuales pasarán al historial de temporadas; los comprobantes y las notificaciones se eliminarán. Esta acción no se puede deshacer.
               </p>
               <div className="space-y-4">
                 <Input
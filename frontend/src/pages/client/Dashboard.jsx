@@ -43,7 +43,7 @@ const ClientDashboard = () => {
         setUserPayments(paymentsRes.data)
 
         const notificationsRes = await getNotifications()
-        setNotifications(notificationsRes.data)
+        setNotifications(notificationsRes.data.results)
       } catch (error) {
         console.error(error)
       }
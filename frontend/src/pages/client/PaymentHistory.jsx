@@ -1,8 +1,8 @@
 import { useState, useEffect } from 'react';
-import { getCajaPersonas, getDollarRate } from '../../api/box.api';
+import { getCajaPersonas, getDollarRate, getDeliveryQr } from '../../api/box.api';
 import { Card, CardContent } from '../../components/UI/Card';
 import Button from '../../components/UI/Button';
-import { Download, FileText, Calendar, ChevronLeft, ChevronRight } from 'lucide-react';
+import { Download, FileText, Calendar, ChevronLeft, ChevronRight, QrCode } from 'lucide-react';
 import jsPDF from 'jspdf';
 import autoTable from 'jspdf-autotable';
 import {MoonLoader} from 'react-spinners'
@@ -49,6 +49,15 @@ const PaymentHistory = () => {
     );
   };
 
+  const showDeliveryQr = async (id) => {
+    try {
+      const response = await getDeliveryQr(id);
+      window.open(URL.createObjectURL(response.data), '_blank');
+    } catch (err) {
+      console.error('Error al obtener el código de entrega:', err);
+    }
+  };
+
   const filteredPayments = payments.filter(p => {
     if (!filter) return true;
     const paymentDate = new Date(p.date);
@@ -167,6 +176,7 @@ const PaymentHistory = () => {
                   <th className="px-6 py-3 text-left font-medium text-gray-900">Método</th>
                   <th className="px-6 py-3 text-left font-medium text-gray-900">Referencia</th>
                   <th className="px-6 py-3 text-left font-medium text-gray-900">Estado</th>
+                  <th className="px-6 py-3 text-left font-medium text-gray-900">Entrega</th>
                 </tr>
               </thead>
               <tbody className="divide-y divide-gray-200">
@@ -181,11 +191,19 @@ const PaymentHistory = () => {
                       <td className="px-6 py-4">{payment.payment_method}</td>
                       <td className="px-6 py-4">{payment.reference || 'N/A'}</td>
                       <td className="px-6 py-4">{getStatusBadge(payment.status)}</td>
+                      <td className="px-6 py-4">
+                        {payment.delivered ? 'Entregada' : payment.status === 'APPROVED' && (
+                          <Button onClick={() => showDeliveryQr(payment.id)} variant="outline" size="sm">
+                            <QrCode className="h-4 w-4 mr-2" />
+                            Código QR
+                          </Button>
+                        )}
+                      </td>
                     </tr>
                   ))
                 ) : (
                   <tr>
-                    <td colSpan="5" className="text-center py-12 text-gray-500">
+                    <td colSpan="6" className="text-center py-12 text-gray-500">
                       No hay pagos que coincidan con el filtro.
                     </td>
                   </tr>
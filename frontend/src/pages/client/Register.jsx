@@ -1,4 +1,4 @@
-import { useState } from 'react';
+import { useState, useEffect } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
 import { useForm } from 'react-hook-form';
 import { zodResolver } from '@hookform/resolvers/zod';
@@ -7,6 +7,7 @@ import Button from '../../components/UI/Button';
 import Input from '../../components/UI/Input';
 import { Eye, EyeOff, UserPlus } from 'lucide-react';
 import { registerUser } from '../../api/users.api';
+import { getCommunities } from '../../api/box.api';
 
 const registerSchema = z.object({
   username: z.string().min(1, 'El nombre de usuario es requerido'),
@@ -15,6 +16,7 @@ const registerSchema = z.object({
   phone: z.string().min(1, 'El teléfono es requerido').regex(/^04(12|14|16|24|26)\d{7}$/, 'El formato del teléfono no es válido (04XX-XXXXXXX)'),
   cedula: z.string().min(7, 'La cédula debe tener entre 7 y 8 dígitos').max(8, 'La cédula debe tener entre 7 y 8 dígitos').regex(/^\d+$/, 'La cédula solo puede contener números'),
   address: z.string().min(1, 'La dirección es requerida'),
+  community: z.string().optional(),
   password: z.string().min(6, 'La contraseña debe tener al menos 6 caracteres'),
   password2: z.string(),
   terms: z.boolean().refine(val => val === true, { message: 'Debes aceptar los términos y condiciones' })
@@ -27,8 +29,13 @@ const ClientRegister = () => {
   const [showPassword, setShowPassword] = useState(false);
   const [showConfirmPassword, setShowConfirmPassword] = useState(false);
   const [serverError, setServerError] = useState('');
+  const [communities, setCommunities] = useState([]);
   const navigate = useNavigate();
 
+  useEffect(() => {
+    getCommunities().then((res) => setCommunities(res.data)).catch(console.error);
+  }, []);
+
   const { register, handleSubmit, formState: { errors, isSubmitting } } = useForm({
     resolver: zodResolver(registerSchema),
   });
@@ -42,6 +49,7 @@ const ClientRegister = () => {
     const submissionData = {
       ...data,
       address: `Urb Ciudad varyna sector I Araguaney, ${data.address}`,
+      community: data.community ? Number(data.community) : null,
     };
 
     try {
@@ -136,6 +144,21 @@ const ClientRegister = () => {
               {errors.address && <p className="mt-2 text-sm text-red-600">{errors.address.message}</p>}
             </div>
 
+            {communities.length > 0 && (
+              <div className="relative">
+                <label className="block text-sm font-medium text-gray-700">Comunidad o punto de entrega</label>
+                <select
+                  {...register("community")}
+                  className="mt-1 block w-full px-3 py-2 rounded-md border border-gray-300 focus:ring-red-500 focus:border-red-500 sm:text-sm"
+                >
+                  <option value="">Selecciona tu comunidad</option>
+                  {communities.map((c) => (
+                    <option key={c.id} value={c.id}>{c.name}</option>
+                  ))}
+                </select>
+              </div>
+            )}
+
             <div className="relative">
               <Input
                 label="Contraseña"